@@ -6,7 +6,7 @@ from .models import (
     ZentraDevice,
     ModelVersion,
     RiverChannel,
-    RiverFlowPrediction,
+    RiverFlowCalculationOutput,
     FloodModelParameters,
 )
 
@@ -16,12 +16,9 @@ class FloodModelParametersAdmin(admin.ModelAdmin):
     list_display = ["id", "model_version_id"] + [f"beta{i}" for i in range(12)]
 
 
-@admin.register(RiverFlowPrediction)
-class RiverFlowPredictionAdmin(admin.ModelAdmin):
-    list_display = ("prediction_index", "forecast_time", "river_flow")
-
-    def forecast_time(self, obj):
-        return obj.calculation_output.forecast_time
+@admin.register(RiverFlowCalculationOutput)
+class RiverFlowCalculationOutputAdmin(admin.ModelAdmin):
+    list_display = ("prediction_date", "forecast_time", "rain_fall")
 
 
 @admin.register(ZentraDevice)
@@ -68,3 +65,7 @@ class ModelVersionAdmin(admin.ModelAdmin):
 @admin.register(RiverChannel)
 class RiverChannelAdmin(LeafletGeoAdmin):
     display_raw = True
+
+    def delete_queryset(self, request, queryset):
+        queryset.delete()
+        FloodModelParameters.queue_update_channel_overlap()
@@ -1,75 +1,200 @@
+import hashlib
+
 from django.conf import settings
-from django.contrib.gis.db.models import Max, Min, Union
 from django.db import connection
 from django.utils import timezone
 
-from webapp.alerts import TwilioAlerts
-from webapp.models import UserAlert, UserPhoneNumber, AlertType
+from webapp.alerts import TwilioMessageDispatcher, log_dispatch_report
+from webapp.models import AlertType, SentAlert, UserAlert
 
-from .models import DepthPrediction, RiverChannel
+from .models import ChannelOverlap
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Find the flooding in each phone number's alert locations, excluding cells covered by
+# the river channel. The footprint of the flooded cells in the window is found first,
+# then the alerts which intersect each flooded cell are looked up through the spatial
+# index on the alert locations, so the cost scales with the size of the flood rather
+# than the number of alerts. The flooded cells identify the flood event for each phone
+# number, independent of the alert window. Alerts are combined by the number itself, as
+# several users can register the same number.
+ALERT_MESSAGES_SQL = """
+    WITH flooded AS MATERIALIZED (
+        SELECT p.id, p.bounding_box,
+            min(d.date) AS start_date,
+            max(d.date) AS end_date,
+            max(d.median_depth) AS max_depth
+        FROM calculations_depthprediction d
+        JOIN calculations_floodmodelparameters p ON p.id = d.parameters_id
+        WHERE d.date >= %s
+            AND d.date <= %s
+            AND d.mid_lower_centile >= %s
+            AND p.channel_overlap != %s
+        GROUP BY p.id
+    )
+    SELECT n.phone_number, a.alert_type,
+        min(f.start_date), max(f.end_date), max(f.max_depth),
+        array_agg(DISTINCT f.id ORDER BY f.id)
+    FROM flooded f
+    JOIN webapp_useralert a ON ST_Intersects(a.location, f.bounding_box)
+    JOIN webapp_userphonenumber n ON n.id = a.phone_number_id
+    WHERE a.id IN ({alerts})
+    GROUP BY n.phone_number, a.alert_type
+"""
 
-def send_phone_alerts_for_user(user_id, phone_number_id, alert_type=AlertType.SMS):
-    """Send alerts to a user's phone number, i.e. via WhatsApp or SMS"""
-    user_sms_alerts = (
-        UserAlert.objects.filter(
-            user_id=user_id, phone_number_id=phone_number_id, alert_type=alert_type
+
+def get_alert_messages(start_date, end_date, alerts):
+    """
+    Get the messages to send for a set of alerts, combining the alerts for each phone number
+    @param alerts: UserAlert queryset
+    @return: list of (phone number, alert type, message, event hash) for phone numbers
+        with floods, where the event hash identifies the flooded cells and depth
+    """
+    alerts_sql, alerts_params = alerts.values("id").query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            ALERT_MESSAGES_SQL.format(alerts=alerts_sql),
+            [
+                start_date,
+                end_date,
+                settings.ALERT_DEPTH_THRESHOLD,
+                ChannelOverlap.COVERED,
+                *alerts_params,
+            ],
         )
-        .values("user", "phone_number")
-        .annotate(all_locations=Union("location"))
+        return [
+            (
+                phone_number,
+                alert_type,
+                format_message(flood_start, flood_end, max_depth),
+                get_event_hash(cell_ids, max_depth),
+            )
+            for (
+                phone_number,
+                alert_type,
+                flood_start,
+                flood_end,
+                max_depth,
+                cell_ids,
+            ) in cursor
+        ]
+
+
+def format_message(start_date, end_date, max_depth):
+    return settings.ALERT_TEXT.format(
+        max_depth=f"{max_depth:.1f}",
+        start_date=start_date.strftime(settings.ALERT_DATE_FORMAT),
+        end_date=end_date.strftime(settings.ALERT_DATE_FORMAT),
+        site_url=settings.SITE_URL,
     )
 
+
+def get_alert_window():
+    """
+    Get the start and end dates of the predictions covered by alerts sent today
+    """
     today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
-    five_days_ahead = today + timezone.timedelta(days=5)
-    twilio_alerts = TwilioAlerts()
-    for alert in user_sms_alerts:
-        try:
-            message = get_message(today, five_days_ahead, alert["all_locations"])
-            if message:
-                phone_number = str(
-                    UserPhoneNumber.objects.get(id=alert["phone_number"]).phone_number
-                )
-                if alert_type == AlertType.SMS:
-                    twilio_alerts.send_alert_sms(phone_number, message)
-                else:
-                    twilio_alerts.send_alert_whatsapp(phone_number, message)
-        except Exception as e:
-            logger.error(
-                f"Unable to send message for phone number id {alert['phone_number']}: {e}"
-            )
+    return today, today + timezone.timedelta(days=settings.ALERT_DAYS)
 
 
-def get_message(start_date, end_date, location):
-    # Get river channel data to exclude
-    with connection.cursor() as cursor:
-        cursor.execute(
-            "SELECT ST_Union(ST_Buffer(channel_location, 0)) FROM calculations_riverchannel"
-        )
-        channel_data = cursor.fetchone()[0]
-
-    # Find values in DepthPrediction in future which match the current location
-    predictions = DepthPrediction.objects.filter(
-        date__gte=start_date,
-        date__lte=end_date,
-        parameters__bounding_box__intersects=location,
-        mid_lower_centile__gte=settings.ALERT_DEPTH_THRESHOLD,
+def get_event_hash(cell_ids, max_depth):
+    """
+    Get a hash identifying a flood event by its flooded cells and its maximum depth, as
+    shown in messages. The dates of the event are left out, as the start date of an
+    ongoing flood moves forward with the alert window.
+    @param cell_ids: sorted ids of the FloodModelParameters of the flooded cells
+    """
+    event = f"{max_depth:.1f}:{','.join(str(i) for i in cell_ids)}"
+    return hashlib.sha256(event.encode()).hexdigest()
+
+
+def send_alert_messages(messages, dispatcher=None):
+    """
+    Send alert messages, skipping messages for the same flood event as the last message
+    sent to the phone number
+    @param messages: list of (phone number, alert type, message, event hash)
+    @param dispatcher: TwilioMessageDispatcher to send through, so that its rate limit
+        covers every call sending messages for a run
+    @return: dict of the number of messages sent, failed, unchanged and duplicate, and
+        the seconds taken
+    """
+    last_sent = {
+        (phone_number.as_e164, alert_type, message_hash)
+        for phone_number, alert_type, message_hash in SentAlert.objects.filter(
+            phone_number__in={phone_number for phone_number, _, _, _ in messages}
+        ).values_list("phone_number", "alert_type", "message_hash")
+    }
+    changed = []
+    hashes = []
+    seen = set()
+    duplicates = 0
+    for phone_number, alert_type, message, event_hash in messages:
+        # Only send one message to each number, which is also what the upsert of the
+        # SentAlerts requires
+        if (phone_number, alert_type) in seen:
+            duplicates += 1
+            continue
+        seen.add((phone_number, alert_type))
+        if (phone_number, alert_type, event_hash) not in last_sent:
+            changed.append((phone_number, alert_type, message))
+            hashes.append(event_hash)
+
+    results, report = (dispatcher or TwilioMessageDispatcher()).send(changed)
+
+    SentAlert.objects.bulk_create(
+        [
+            SentAlert(
+                phone_number=phone_number,
+                alert_type=alert_type,
+                message_hash=event_hash,
+            )
+            for (phone_number, alert_type, _), event_hash, sent in zip(
+                changed, hashes, results
+            )
+            if sent
+        ],
+        update_conflicts=True,
+        unique_fields=["phone_number", "alert_type"],
+        update_fields=["message_hash", "sent_at"],
     )
-    if channel_data:
-        predictions = predictions.exclude(
-            parameters__bounding_box__coveredby=channel_data
-        )
 
-    predictions = predictions.aggregate(Min("date"), Max("date"), Max("median_depth"))
-    if predictions["median_depth__max"]:
-        return settings.ALERT_TEXT.format(
-            max_depth=f"{predictions['median_depth__max']:.1f}",
-            start_date=predictions["date__min"].strftime(settings.ALERT_DATE_FORMAT),
-            end_date=predictions["date__max"].strftime(settings.ALERT_DATE_FORMAT),
-            site_url=settings.SITE_URL,
+    if duplicates:
+        logger.warning(f"Skipped {duplicates} duplicate alert messages")
+    report["unchanged"] = len(seen) - len(changed)
+    report["duplicate"] = duplicates
+    return report
+
+
+def expire_sent_alerts(messages):
+    """
+    Delete the SentAlerts of phone numbers and alert types with no current flood event,
+    so that an identical flood which recurs after the event ends is alerted again
+    @param messages: list of (phone number, alert type, message, event hash) of all
+        current alerts
+    @return: number of SentAlerts deleted
+    """
+    current = {
+        (phone_number, alert_type) for phone_number, alert_type, _, _ in messages
+    }
+    expired = [
+        sent_alert_id
+        for sent_alert_id, phone_number, alert_type in SentAlert.objects.values_list(
+            "id", "phone_number", "alert_type"
         )
-    else:
-        return None
+        if (phone_number.as_e164, alert_type) not in current
+    ]
+    if expired:
+        SentAlert.objects.filter(id__in=expired).delete()
+    return len(expired)
+
+
+def send_phone_alerts_for_user(user_id, phone_number_id, alert_type=AlertType.SMS):
+    """Send alerts to a user's phone number, i.e. via WhatsApp or SMS"""
+    alerts = UserAlert.objects.filter(
+        user_id=user_id, phone_number_id=phone_number_id, alert_type=alert_type
+    )
+    log_dispatch_report(
+        send_alert_messages(get_alert_messages(*get_alert_window(), alerts))
+    )
@@ -0,0 +1,159 @@
+"""
+On-disk cache of the flood model coefficients for a ModelVersion.
+
+The coefficients of every cell outside the river channel are written once to a
+NumPy file, which each flood model task then memory-maps read-only rather than
+loading all FloodModelParameters rows from the database.
+"""
+import glob
+import os
+import tempfile
+
+from django.conf import settings
+from django.db.models import F, FloatField, Func
+import numpy as np
+
+from .models import ChannelOverlap, CoefficientCacheVersion, FloodModelParameters
+
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+
+# Generate list of [beta0..beta4]
+BETA_ARGS = [f"beta{i}" for i in range(5)]
+
+# Bounds of each cell are stored as (xmin, ymin, xmax, ymax)
+CACHE_DTYPE = np.dtype(
+    [
+        ("id", np.int64),
+        ("betas", np.float64, (len(BETA_ARGS),)),
+        ("bounds", np.float64, (4,)),
+    ]
+)
+
+BOUNDS_FUNCTIONS = {
+    "xmin": "ST_XMin",
+    "ymin": "ST_YMin",
+    "xmax": "ST_XMax",
+    "ymax": "ST_YMax",
+}
+
+
+def get_cache_version():
+    return (
+        CoefficientCacheVersion.objects.values_list("version", flat=True)
+        .filter(pk=1)
+        .first()
+        or 0
+    )
+
+
+def coefficient_cache_path(model_version_id, cache_version):
+    return os.path.join(
+        settings.FLOOD_MODEL_CACHE_DIR,
+        f"coefficients-{model_version_id}-{cache_version}.npy",
+    )
+
+
+def build_coefficient_cache(model_version_id, cache_version):
+    """
+    Write the coefficients of a model version to the cache file, replacing any
+    existing file atomically so that running tasks are not affected, and remove
+    files for older cache versions.
+    """
+    params = (
+        FloodModelParameters.objects.filter(
+            model_version_id=model_version_id, channel_overlap=ChannelOverlap.NONE
+        )
+        .annotate(
+            **{
+                name: Func("bounding_box", function=function, output_field=FloatField())
+                for name, function in BOUNDS_FUNCTIONS.items()
+            }
+        )
+        .order_by("id")
+        .values_list("id", *BETA_ARGS, *BOUNDS_FUNCTIONS)
+    )
+
+    # Missing betas are treated as 0
+    data = np.array(
+        [
+            (
+                row[0],
+                tuple(0 if b is None else b for b in row[1 : len(BETA_ARGS) + 1]),
+                row[len(BETA_ARGS) + 1 :],
+            )
+            for row in params.iterator(chunk_size=settings.DATABASE_CHUNK_SIZE)
+        ],
+        dtype=CACHE_DTYPE,
+    )
+
+    os.makedirs(settings.FLOOD_MODEL_CACHE_DIR, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        dir=settings.FLOOD_MODEL_CACHE_DIR, suffix=".npy", delete=False
+    ) as f:
+        np.save(f, data)
+    path = coefficient_cache_path(model_version_id, cache_version)
+    os.replace(f.name, path)
+
+    for old_path in glob.glob(
+        os.path.join(
+            settings.FLOOD_MODEL_CACHE_DIR, f"coefficients-{model_version_id}-*.npy"
+        )
+    ):
+        if old_path != path:
+            remove_cache_file(old_path)
+
+    logger.info(
+        f"Cached coefficients for {len(data)} cells of model version {model_version_id}"
+    )
+
+
+def load_cells(model_version_id):
+    """
+    Get the cached cells for a model version, building the cache if needed.
+    @param model_version_id: id of the ModelVersion
+    @return: array with CACHE_DTYPE, memory-mapped read-only from the cache file
+    """
+    cache_version = get_cache_version()
+    path = coefficient_cache_path(model_version_id, cache_version)
+    if not os.path.exists(path):
+        build_coefficient_cache(model_version_id, cache_version)
+
+    try:
+        return np.load(path, mmap_mode="r")
+    except ValueError:
+        # Older versions of numpy cannot memory-map an empty array
+        return np.load(path)
+
+
+def load_coefficients(model_version_id):
+    """
+    Get the coefficients for a model version, building the cache if needed.
+    @param model_version_id: id of the ModelVersion
+    @return: tuple of (array of FloodModelParameters ids, (N_cells x 5) array of beta0..beta4)
+    """
+    data = load_cells(model_version_id)
+    return data["id"], data["betas"]
+
+
+def remove_cache_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def invalidate_coefficient_cache():
+    """
+    Invalidate all cached coefficients, e.g. when parameters or river channels change.
+    The cache version is stored in the database, so the caches of the web server and
+    every celery worker are rebuilt when they are next loaded.
+    """
+    CoefficientCacheVersion.objects.get_or_create(pk=1)
+    CoefficientCacheVersion.objects.filter(pk=1).update(version=F("version") + 1)
+
+    for path in glob.glob(
+        os.path.join(settings.FLOOD_MODEL_CACHE_DIR, "coefficients-*.npy")
+    ):
+        remove_cache_file(path)
@@ -0,0 +1,389 @@
+import math
+import os
+from pathlib import Path
+import shutil
+import struct
+import tempfile
+import time
+import zlib
+
+from celery import shared_task
+from celery.utils.log import get_task_logger
+from django.conf import settings
+from django.db.models import FloatField, Func
+from django.utils import timezone
+import numpy as np
+
+from .coefficient_cache import BOUNDS_FUNCTIONS
+from .models import AggregatedDepthPrediction, DepthPrediction
+
+logger = get_task_logger(__name__)
+
+TILE_SIZE = 256
+
+# Approximate number of tiles across a map, used to choose the aggregation level of a tile
+TILES_PER_VIEW = 4
+
+# Colours of d3-scale-chromatic's YlGnBu scheme, as used by interpolateYlGnBu in maps.js
+YLGNBU_COLOURS = np.array(
+    [
+        [255, 255, 217],
+        [237, 248, 177],
+        [199, 233, 180],
+        [127, 205, 187],
+        [65, 182, 196],
+        [29, 145, 192],
+        [34, 94, 168],
+        [37, 52, 148],
+        [8, 29, 88],
+    ],
+    dtype=float,
+)
+
+# Transparent tile served for tiles with no predictions
+EMPTY_TILE_NAME = "empty.png"
+
+# Age in seconds after which an unlinked render directory is assumed to be left over
+# from a render that was killed, rather than still being rendered
+STALE_RENDER_AGE = 6 * 60 * 60
+
+
+def get_aggregation_level(size):
+    """
+    Get the aggregation level to show for a map extent
+    @param size: size of the smaller side of the extent, in degrees
+    @return: aggregation level of the AggregatedDepthPredictions, or -1 for DepthPredictions
+    """
+    if size < 0.001:
+        return -1
+    elif size < 0.0025:
+        return 256
+    elif size < 0.005:
+        return 128
+    elif size < 0.01:
+        return 64
+    return 32
+
+
+def estimate_prediction_count(level_stats, extent):
+    """
+    Get an upper bound on the number of predictions at an aggregation level within an extent
+    @param level_stats: AggregationLevelStats of the level
+    @param extent: (xmin, ymin, xmax, ymax) of the extent
+    """
+    if not level_stats.count:
+        return 0
+
+    xmin, ymin, xmax, ymax = level_stats.bounding_box.extent
+    width = min(extent[2], xmax) - max(extent[0], xmin)
+    height = min(extent[3], ymax) - max(extent[1], ymin)
+    if width < 0 or height < 0:
+        return 0
+
+    # Non-overlapping predictions at least block_size across can only intersect
+    # this many positions along each side
+    columns = math.floor(width / level_stats.block_size) + 2
+    rows = math.floor(height / level_stats.block_size) + 2
+    return min(level_stats.count, columns * rows)
+
+
+def plan_aggregation_level(level_stats, bounding_box):
+    """
+    Choose the finest aggregation level to show for a map extent which has at most
+    DEPTH_MAX_CELLS predictions in the extent, or the coarsest level if none do
+    @param level_stats: AggregationLevelStats for the date being shown
+    @param bounding_box: Polygon of the map extent
+    @return: aggregation level of the AggregatedDepthPredictions, or -1 for DepthPredictions
+    """
+    extent = bounding_box.extent
+    if not level_stats:
+        return get_aggregation_level(min(extent[2] - extent[0], extent[3] - extent[1]))
+
+    # Level -1 is the finest, then the levels with the most blocks
+    levels = sorted(
+        level_stats,
+        key=lambda s: math.inf if s.aggregation_level < 0 else s.aggregation_level,
+        reverse=True,
+    )
+    for stats in levels:
+        if estimate_prediction_count(stats, extent) <= settings.DEPTH_MAX_CELLS:
+            return stats.aggregation_level
+    return levels[-1].aggregation_level
+
+
+def get_tile_aggregation_level(zoom):
+    """
+    Get the aggregation level to show for map tiles at a zoom level, as if the map
+    were showing tiles of this zoom
+    """
+    return get_aggregation_level(TILES_PER_VIEW * 360 / 2**zoom)
+
+
+def get_depth_tile_key(date):
+    """
+    Get the name of the directory for the tiles of a forecast time, as used in tile URLs
+    """
+    if timezone.is_naive(date):
+        date = timezone.make_aware(date)
+    return date.astimezone(timezone.utc).strftime("%Y%m%d%H")
+
+
+def interpolate_ylgnbu(t):
+    """
+    Vectorised equivalent of d3-scale-chromatic's interpolateYlGnBu, which
+    interpolates the scheme with a uniform B-spline
+    @param t: array of values between 0 and 1
+    @return: (N x 3) array of RGB colours as uint8
+    """
+    n = len(YLGNBU_COLOURS) - 1
+    t = np.clip(np.asarray(t, dtype=float), 0, 1)
+    i = np.minimum(np.floor(t * n).astype(int), n - 1)
+
+    # Extend the colours at each end as d3's interpolateRgbBasis does
+    colours = np.vstack(
+        [
+            2 * YLGNBU_COLOURS[0] - YLGNBU_COLOURS[1],
+            YLGNBU_COLOURS,
+            2 * YLGNBU_COLOURS[-1] - YLGNBU_COLOURS[-2],
+        ]
+    )
+    v0, v1, v2, v3 = (colours[i + k] for k in range(4))
+
+    t1 = ((t - i / n) * n)[:, np.newaxis]
+    t2 = t1 * t1
+    t3 = t2 * t1
+    rgb = (
+        (1 - 3 * t1 + 3 * t2 - t3) * v0
+        + (4 - 6 * t2 + 3 * t3) * v1
+        + (1 + 3 * t1 + 3 * t2 - 3 * t3) * v2
+        + t3 * v3
+    ) / 6
+    return np.clip(np.floor(rgb + 0.5), 0, 255).astype(np.uint8)
+
+
+def get_depth_colours(depth, lower_centile, upper_centile, max_depth):
+    """
+    Get the colours of depth predictions, using the same colouring as maps.js:
+    colour by depth, and opacity by the spread between the lower and upper centiles
+    @return: (N x 4) array of RGBA colours as uint8
+    """
+    spread = upper_centile - lower_centile
+    opacity = np.where(spread > max_depth, 0, 1 - spread / max_depth)
+    alpha = np.clip(np.floor(opacity * 255 + 0.5), 0, 255).astype(np.uint8)
+    return np.column_stack([interpolate_ylgnbu(depth / max_depth), alpha])
+
+
+def encode_png(rgba):
+    """
+    Encode an image as a PNG
+    @param rgba: (height x width x 4) array of uint8
+    @return: PNG file contents as bytes
+    """
+    height, width, _ = rgba.shape
+
+    def chunk(chunk_type, data):
+        return (
+            struct.pack(">I", len(data))
+            + chunk_type
+            + data
+            + struct.pack(">I", zlib.crc32(chunk_type + data))
+        )
+
+    # Each row starts with filter type 0 (none)
+    raw = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    raw[:, 1:] = rgba.reshape(height, width * 4)
+
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw.tobytes(), 6))
+        + chunk(b"IEND", b"")
+    )
+
+
+def render_tiles(bounds, colours, zoom):
+    """
+    Render rectangles into Web Mercator map tiles. Each pixel is coloured by the
+    rectangle containing its centre.
+    @param bounds: (N x 4) array of rectangle bounds (xmin, ymin, xmax, ymax) in degrees
+    @param colours: (N x 4) array of RGBA colours as uint8
+    @param zoom: zoom level of the tiles
+    @return: generator of (x, y, rgba) for each tile containing a rectangle
+    """
+    if not len(bounds):
+        return
+
+    # Bounds in pixels from the top left of the map
+    scale = TILE_SIZE * 2**zoom
+
+    def to_pixel_x(lon):
+        return np.ceil((lon + 180) / 360 * scale - 0.5).astype(np.int64)
+
+    def to_pixel_y(lat):
+        y = (1 - np.arcsinh(np.tan(np.radians(lat))) / math.pi) / 2 * scale
+        return np.ceil(y - 0.5).astype(np.int64)
+
+    px0 = to_pixel_x(bounds[:, 0])
+    px1 = np.maximum(to_pixel_x(bounds[:, 2]), px0 + 1)
+    py0 = to_pixel_y(bounds[:, 3])
+    py1 = np.maximum(to_pixel_y(bounds[:, 1]), py0 + 1)
+
+    # Pair each rectangle with each tile it overlaps, grouped by tile
+    tx0, tx1 = px0 // TILE_SIZE, (px1 - 1) // TILE_SIZE
+    ty0, ty1 = py0 // TILE_SIZE, (py1 - 1) // TILE_SIZE
+    columns = tx1 - tx0 + 1
+    counts = columns * (ty1 - ty0 + 1)
+    rects = np.repeat(np.arange(len(bounds)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    tile_x = tx0[rects] + offsets % columns[rects]
+    tile_y = ty0[rects] + offsets // columns[rects]
+
+    order = np.lexsort((tile_y, tile_x))
+    rects, tile_x, tile_y = rects[order], tile_x[order], tile_y[order]
+    starts = np.flatnonzero(
+        np.diff(tile_x, prepend=-1) | np.diff(tile_y, prepend=-1)
+    ).tolist() + [len(rects)]
+
+    for start, end in zip(starts[:-1], starts[1:]):
+        x, y = int(tile_x[start]), int(tile_y[start])
+        left, top = x * TILE_SIZE, y * TILE_SIZE
+        rgba = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+        for r in rects[start:end]:
+            rgba[
+                max(py0[r] - top, 0) : min(py1[r] - top, TILE_SIZE),
+                max(px0[r] - left, 0) : min(px1[r] - left, TILE_SIZE),
+            ] = colours[r]
+        yield x, y, rgba
+
+
+def get_depth_predictions(date, aggregation_level, bounding_box=None):
+    """
+    Get the bounds and centiles of the depth predictions at a date with a single query
+    @param aggregation_level: level of the AggregatedDepthPredictions, or -1 for DepthPredictions
+    @param bounding_box: optional Polygon which the predictions must intersect
+    @return: values_list QuerySet of (xmin, ymin, xmax, ymax, lower_centile,
+        median_depth, upper_centile) for each prediction
+    """
+    if aggregation_level > 0:
+        predictions = AggregatedDepthPrediction.objects.filter(
+            date=date, aggregation_level=aggregation_level
+        )
+        geometry = "bounding_box"
+    else:
+        predictions = DepthPrediction.objects.filter(date=date)
+        geometry = "parameters__bounding_box"
+
+    if bounding_box is not None:
+        predictions = predictions.filter(**{f"{geometry}__intersects": bounding_box})
+
+    return predictions.annotate(
+        **{
+            name: Func(geometry, function=function, output_field=FloatField())
+            for name, function in BOUNDS_FUNCTIONS.items()
+        }
+    ).values_list(*BOUNDS_FUNCTIONS, "lower_centile", "median_depth", "upper_centile")
+
+
+def get_depth_rectangles(date, aggregation_level):
+    """
+    Get the bounds and centiles of the depth predictions at a date
+    @param aggregation_level: level of the AggregatedDepthPredictions, or -1 for DepthPredictions
+    @return: tuple of ((N x 4) array of bounds, (N x 3) array of lower, median and upper depths)
+    """
+    rows = get_depth_predictions(date, aggregation_level)
+    data = np.array(list(rows), dtype=float).reshape(-1, 7)
+    return data[:, :4], data[:, 4:]
+
+
+def remove_stale_renders(tile_dir):
+    """
+    Remove render directories in tile_dir which no tile URL links to and which were
+    last modified more than STALE_RENDER_AGE ago, as left by renders that were killed
+    @param tile_dir: Path of DEPTH_TILE_DIR
+    """
+    linked = {os.readlink(path) for path in tile_dir.iterdir() if path.is_symlink()}
+    for path in tile_dir.glob(".*-*"):
+        if (
+            path.is_dir()
+            and not path.is_symlink()
+            and path.name not in linked
+            and time.time() - path.stat().st_mtime > STALE_RENDER_AGE
+        ):
+            logger.info(f"Removing stale depth tile render {path.name}")
+            shutil.rmtree(path, ignore_errors=True)
+
+
+@shared_task(name="render_depth_tiles")
+def render_depth_tiles(date):
+    """
+    Render PNG map tiles of the depth predictions at a date into
+    DEPTH_TILE_DIR/<YYYYmmddHH>/<z>/<x>/<y>.png, for serving directly by the web
+    server. The tiles for the date are replaced all at once by switching a symlink,
+    and tiles for dates before today are removed.
+    """
+    logger.info(f"Rendering depth tiles for {date}")
+    start = time.time()
+
+    tile_dir = Path(settings.DEPTH_TILE_DIR)
+    tile_dir.mkdir(parents=True, exist_ok=True)
+    empty_tile = tile_dir.joinpath(EMPTY_TILE_NAME)
+    if not empty_tile.exists():
+        empty_tile.write_bytes(
+            encode_png(np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8))
+        )
+
+    remove_stale_renders(tile_dir)
+
+    key = get_depth_tile_key(date)
+    render_dir = Path(tempfile.mkdtemp(prefix=f".{key}-", dir=tile_dir))
+    try:
+        render_dir.chmod(0o755)
+
+        rectangles = {}
+        count = 0
+        for zoom in range(
+            settings.DEPTH_TILE_MIN_ZOOM, settings.DEPTH_TILE_MAX_ZOOM + 1
+        ):
+            level = get_tile_aggregation_level(zoom)
+            if level not in rectangles:
+                bounds, centiles = get_depth_rectangles(date, level)
+                colours = get_depth_colours(
+                    centiles[:, 1],
+                    centiles[:, 0],
+                    centiles[:, 2],
+                    settings.MAX_FLOOD_DEPTH,
+                )
+                rectangles[level] = (bounds, colours)
+
+            for x, y, rgba in render_tiles(*rectangles[level], zoom):
+                path = render_dir.joinpath(str(zoom), str(x), f"{y}.png")
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_bytes(encode_png(rgba))
+                count += 1
+    except BaseException:
+        shutil.rmtree(render_dir, ignore_errors=True)
+        raise
+
+    # Point the tile URL for the date at the new tiles
+    link = tile_dir.joinpath(key)
+    previous = os.readlink(link) if link.is_symlink() else None
+    new_link = tile_dir.joinpath(f".{key}.link")
+    if new_link.is_symlink():
+        new_link.unlink()
+    new_link.symlink_to(render_dir.name)
+    os.replace(new_link, link)
+    if previous:
+        shutil.rmtree(tile_dir.joinpath(previous), ignore_errors=True)
+
+    # Remove tiles for dates which can no longer be shown
+    today = get_depth_tile_key(
+        timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    )
+    for path in tile_dir.iterdir():
+        if path.is_symlink() and path.name < today:
+            shutil.rmtree(tile_dir.joinpath(os.readlink(path)), ignore_errors=True)
+            path.unlink()
+
+    logger.info(
+        f"Rendered {count} depth tiles for {date} in {(time.time()-start):.2f}s"
+    )
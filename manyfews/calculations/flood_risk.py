@@ -1,33 +1,34 @@
 from datetime import timedelta
+import io
 import math
 import time
 
-from celery import shared_task
+from celery import chord, group, shared_task, signature
 from django.conf import settings
-from django.contrib.gis.db.models import Extent
 from django.contrib.gis.geos import Polygon
-from django.db.models import Avg, Count, Max
+from django.db import connection, transaction
+from django.db.models import Max
 from django.utils import timezone
 import numpy as np
-from numba import jit
 
-from .bulk_create_manager import BulkCreateUpdateManager
+from webapp.depth_cache import invalidate_daily_risks, invalidate_depth_predictions
+from .coefficient_cache import BETA_ARGS, load_cells, load_coefficients
+from .depth_tiles import render_depth_tiles
 from .models import (
     AggregatedDepthPrediction,
+    AggregationLevelStats,
+    ChannelOverlap,
     DepthPrediction,
-    FloodModelParameters,
     ModelVersion,
-    PercentageFloodRisk,
     RiverFlowCalculationOutput,
-    RiverChannel,
 )
 
 from celery.utils.log import get_task_logger
 
 logger = get_task_logger(__name__)
 
-# Generate list of [beta0..beta4]
-BETA_ARGS = [f"beta{i}" for i in range(5)]
+# Number of blocks across the smaller side of the flood extent at each aggregation level
+AGGREGATION_LEVELS = [32, 64, 128, 256]
 
 
 def run_all_flood_models():
@@ -53,8 +54,30 @@ def run_all_flood_models():
         )
 
     logger.info(f"Found {len(outputs_by_time)} sets of output data.")
+
+    # Make sure the coefficient cache exists before the tasks start, so they don't
+    # all try to build it
+    load_coefficients(ModelVersion.get_current_id())
+
+    # Alerts only cover the first ALERT_DAYS, so send them as soon as those forecast
+    # times are complete, while the later forecast times carry on
+    alert_end = today + timedelta(days=settings.ALERT_DAYS)
+    alert_tasks = []
+    other_tasks = []
     for output in outputs_by_time:
-        run_flood_model_for_time.delay(latest_prediction_date, output.forecast_time)
+        task = run_flood_model_for_time.si(latest_prediction_date, output.forecast_time)
+        if output.forecast_time <= alert_end:
+            alert_tasks.append(task)
+        else:
+            other_tasks.append(task)
+
+    if alert_tasks:
+        # Alerts are still sent for the other forecast times if one of them fails
+        send_alerts = signature("Send all alerts", immutable=True)
+        send_alerts.link_error(signature("Send alerts after flood model failure"))
+        chord(alert_tasks)(send_alerts)
+    if other_tasks:
+        group(other_tasks).delay()
 
 
 @shared_task(name="Run flood model for time")
@@ -63,10 +86,7 @@ def run_flood_model_for_time(prediction_date, forecast_time):
     output = RiverFlowCalculationOutput.objects.filter(
         prediction_date=prediction_date, forecast_time=forecast_time
     ).first()
-    flow_values_iter = output.riverflowprediction_set.values_list(
-        "river_flow", flat=True
-    )
-    flow_values = np.fromiter(flow_values_iter, np.dtype("float_"))
+    flow_values = np.array(output.river_flows, dtype=np.dtype("float_"))
     logger.info(
         f"Got river flow values: "
         f"[{', '.join(format(x, '2.5f') for x in flow_values[:2])} ... "
@@ -74,19 +94,20 @@ def run_flood_model_for_time(prediction_date, forecast_time):
     )
 
     latest_model_id = ModelVersion.get_current_id()
-    params = FloodModelParameters.objects.filter(model_version_id=latest_model_id)
+    param_ids, betas = load_coefficients(latest_model_id)
 
     # Check if we have FloodModel parameters (common error in app setup)
-    if not len(params):
-        raise RuntimeError(
+    if not len(param_ids):
+        logger.warning(
             "There are no FloodModelParameters populated"
             f" for {prediction_date.strftime('%Y-%m-%d')} {forecast_time.strftime('%H:%M:%S')}"
             " and therefore nothing to do."
             "\nHave you added a ModelVersion? You may need to load the model parameters from CSV."
         )
+        return
 
     # Perform check: will depth be zero for all cells? beta4 is minQ. Early-out if so.
-    elif max(flow_values) < min(params.only("beta4").values_list("beta4", flat=True)):
+    if max(flow_values) < betas[:, 4].min():
         logger.warning(
             "No floods (flow_rate < minQ).\n"
             "Maximum predicted river flow rate"
@@ -96,328 +117,448 @@ def run_flood_model_for_time(prediction_date, forecast_time):
         )
 
         DepthPrediction.objects.filter(
-            date=forecast_time, parameters_id__in=params
+            date=forecast_time, parameters__model_version_id=latest_model_id
         ).delete()
+        AggregatedDepthPrediction.objects.filter(date=forecast_time).delete()
+        AggregationLevelStats.objects.filter(date=forecast_time).delete()
+        invalidate_depth_predictions(forecast_time)
+        calculate_risk_percentages(forecast_time)
+        if settings.DEPTH_TILE_DIR:
+            render_depth_tiles.delay(forecast_time)
 
         return
 
-    # FIXME: this is slow (both with celery in batches of 1000, and running in series
-    # (took several hours for 1 time))
-    predict_depths(forecast_time, [p.id for p in params.only("id").all()], flow_values)
+    predict_depths(forecast_time, latest_model_id, flow_values)
+    calculate_risk_percentages(forecast_time)
 
     # count the total number of processed pixels.
-    total_pixel_count = DepthPrediction.objects.count()
+    total_pixel_count = DepthPrediction.objects.filter(date=forecast_time).count()
     logger.info(f"Total Depth Predictions made: {total_pixel_count}")
 
-    if total_pixel_count == 0:
-        raise RuntimeError(
-            "There are no floods that occurred, or check the parameter file."
-        )
-    else:
-        aggregate_flood_models(forecast_time)
 
-    # TODO: join results to call aggregate_flood_models
+@shared_task(name="Predict depths")
+def predict_depths(forecast_time, model_version_id, flow_values):
+    """
+    Predict depths for every cell of a model version at a forecast time, and save
+    them as DepthPredictions, along with their aggregations for responsive tiling.
+    Cells which overlap a river channel are skipped, and existing predictions for
+    cells which are no longer flooded are deleted.
+    @param forecast_time: forecast time to save predictions for
+    @param model_version_id: ModelVersion of the FloodModelParameters to use
+    @param flow_values: array of river flows, one per rainfall-runoff parameter set
+    """
+    start = time.time()
 
+    # Coefficients of all cells outside the river channel as an (N_cells x 5) array
+    cells = load_cells(model_version_id)
+    param_ids = cells["id"]
+    betas = cells["betas"]
 
-@shared_task(name="Predict depths")
-def predict_depths(forecast_time, param_ids, flow_values):
-    bulk_mgr = BulkCreateUpdateManager(
-        chunk_size=settings.DATABASE_CHUNK_SIZE,
-        fields=(
-            "model_version",
-            "median_depth",
-            "lower_centile",
-            "mid_lower_centile",
-            "upper_centile",
-        ),
+    logger.info(
+        f"Loaded parameters for {len(param_ids)} cells in {(time.time()-start):.2f}s"
     )
 
-    channels = RiverChannel.objects.all()
-    if not channels:
-        logger.warning("No river channels found")
-
-    predictions_to_delete = []
-    batch_size = settings.DATABASE_CHUNK_SIZE
-    total_batches = int(math.ceil(len(param_ids) / batch_size))
-
-    for batch in range(total_batches):
-        start = time.time()
-
-        params_batch = FloodModelParameters.objects.defer("bounding_box").filter(
-            id__in=param_ids
-        )[batch * batch_size : (batch + 1) * batch_size]
-
-        # Preload existing predictions for batch and insert into dictionary by parameters_id
-        # Do a single database SELECT query for batch instead of making a SELECT query
-        #   for each pixel (by default up to 1,000 records)
-        # Note that if the Flood Model has not run, this will return with len() == 0!
-        existing_predictions = {
-            rec.parameters_id: rec
-            for rec in DepthPrediction.objects.filter(
-                date=forecast_time, parameters_id__in=params_batch
-            )
-            .only("parameters_id")
-            .all()
-        }
-
-        for i, param in enumerate(params_batch):
-            prediction = None
-            if param.id in existing_predictions:
-                prediction = existing_predictions[param.id]
-
-            process_pixel(
-                param,
-                flow_values,
-                channels,
-                forecast_time,
-                predictions_to_delete,
-                bulk_mgr,
-                prediction,
-            )
+    # Evaluate in batches to bound the size of the (cells x flows) depth matrix
+    batch_size = settings.FLOOD_MODEL_BATCH_SIZE
+    centiles = np.empty((len(param_ids), 4))
+    for batch_start in range(0, len(param_ids), batch_size):
+        batch = slice(batch_start, batch_start + batch_size)
+        centiles[batch] = predict_depth_centiles(flow_values, betas[batch])
 
-        # Clean up cell depth predictions to delete once per patch
-        if len(predictions_to_delete) > settings.DATABASE_CHUNK_SIZE:
-            logger.debug(
-                f"Cleaning up {len(predictions_to_delete)} no-longer flooded cells"
-            )
-            DepthPrediction.objects.filter(pk__in=predictions_to_delete).delete()
-            predictions_to_delete = []
+    logger.info(
+        f"Calculated {len(param_ids)} pixels for {forecast_time.strftime('%y-%m-%d %H:%M')}"
+        f" in {(time.time()-start):.2f}s"
+    )
 
-        end = time.time()
+    save_depth_predictions(forecast_time, model_version_id, param_ids, centiles)
 
-        logger.info(
-            f"Calculated {(batch+1) * batch_size} of {total_batches * batch_size} pixels "
-            f"in batch {batch+1}/{total_batches} ({(batch / total_batches) * 100 :.1f}%) "
-            f"for {forecast_time.strftime('%y-%m-%d %H:%M')}. Executed in {(end-start):.2f}s"
-        )
+    logger.info(
+        f"Saved depth predictions for {forecast_time.strftime('%y-%m-%d %H:%M')}"
+        f" in {(time.time()-start):.2f}s"
+    )
 
-    if len(predictions_to_delete):
-        logger.debug(
-            f"Cleaning up {len(predictions_to_delete)} remaining no-longer flooded cells"
-        )
-        DepthPrediction.objects.filter(pk__in=predictions_to_delete).delete()
-
-    bulk_mgr.done()
-
-
-def process_pixel(
-    param,
-    flow_values,
-    channels,
-    forecast_time,
-    predictions_to_delete,
-    bulk_mgr,
-    prediction,
-):
-
-    # Break out of loop if current param is within a river channel
-    # (there may be more than one river channel returned)
-    for channel in channels:
-        # Check if param is within RiverChannel
-        if channel.channel_location.intersects(param.bounding_box):
-            return
-
-    (
-        lower_centile,
-        mid_lower_centile,
-        median,
-        upper_centile,
-    ) = predict_depth(flow_values, param)
-
-    # Replace current object if there is one
-    if upper_centile <= 0:
-        if prediction:
-            predictions_to_delete.append(prediction.pk)
+    # Aggregate the flooded cells for responsive tiling. This is the only place
+    # aggregations are built, so re-running predict_depths re-aggregates a forecast time
+    flooded = centiles[:, 3] > 0
+    pyramid = build_depth_pyramid(
+        cells["bounds"][flooded], centiles[flooded], AGGREGATION_LEVELS
+    )
+    save_aggregated_depth_predictions(forecast_time, model_version_id, pyramid)
+    save_aggregation_level_stats(
+        forecast_time,
+        [get_aggregation_level_stats(forecast_time, -1, cells["bounds"][flooded])]
+        + [
+            get_aggregation_level_stats(forecast_time, level, block_bounds)
+            for level, (block_bounds, _) in pyramid.items()
+        ],
+    )
+    invalidate_depth_predictions(forecast_time)
+    if settings.DEPTH_TILE_DIR:
+        render_depth_tiles.delay(forecast_time)
 
-    else:
-        new_prediction = DepthPrediction(
-            date=forecast_time,
-            parameters_id=param.id,
-            model_version=param.model_version,
-            median_depth=median,
-            lower_centile=lower_centile,
-            mid_lower_centile=mid_lower_centile,
-            upper_centile=upper_centile,
+    logger.info(
+        f"Saved aggregated depth predictions for {forecast_time.strftime('%y-%m-%d %H:%M')}"
+        f" in {(time.time()-start):.2f}s"
+    )
+
+
+def save_depth_predictions(forecast_time, model_version_id, param_ids, centiles):
+    """
+    Save the DepthPredictions for a forecast time: COPY the flooded cells into a
+    staging table, upsert them in one statement, then delete predictions for any
+    other cells of the model version, which are no longer flooded.
+    @param forecast_time: forecast time of the predictions
+    @param model_version_id: ModelVersion of the predictions
+    @param param_ids: array of FloodModelParameters ids
+    @param centiles: (N_cells x 4) array of lower, mid-lower, median and upper depths
+    """
+    flooded = centiles[:, 3] > 0
+
+    buffer = io.StringIO()
+    for param_id, (lower_centile, mid_lower_centile, median, upper_centile) in zip(
+        param_ids[flooded].tolist(), centiles[flooded].tolist()
+    ):
+        buffer.write(
+            f"{param_id}\t{lower_centile!r}\t{mid_lower_centile!r}\t{median!r}\t{upper_centile!r}\n"
+        )
+    buffer.seek(0)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        # The staging table is dropped when the transaction commits, but may remain from
+        # an earlier call if this is within an outer transaction
+        cursor.execute(
+            "CREATE TEMPORARY TABLE IF NOT EXISTS depth_prediction_staging ("
+            "parameters_id bigint PRIMARY KEY, lower_centile double precision, "
+            "mid_lower_centile double precision, median_depth double precision, "
+            "upper_centile double precision) ON COMMIT DROP"
+        )
+        cursor.execute("TRUNCATE depth_prediction_staging")
+        cursor.copy_from(
+            buffer,
+            "depth_prediction_staging",
+            columns=(
+                "parameters_id",
+                "lower_centile",
+                "mid_lower_centile",
+                "median_depth",
+                "upper_centile",
+            ),
         )
 
-        if prediction:  # update:
-            new_prediction.pk = prediction.pk
-            bulk_mgr.update(new_prediction)
+        cursor.execute(
+            """
+            INSERT INTO calculations_depthprediction (date, parameters_id, model_version_id,
+                median_depth, lower_centile, mid_lower_centile, upper_centile)
+            SELECT %(date)s, parameters_id, %(model_version_id)s,
+                median_depth, lower_centile, mid_lower_centile, upper_centile
+            FROM depth_prediction_staging
+            ON CONFLICT (date, parameters_id) DO UPDATE SET
+                model_version_id = EXCLUDED.model_version_id,
+                median_depth = EXCLUDED.median_depth,
+                lower_centile = EXCLUDED.lower_centile,
+                mid_lower_centile = EXCLUDED.mid_lower_centile,
+                upper_centile = EXCLUDED.upper_centile
+            """,
+            {"date": forecast_time, "model_version_id": model_version_id},
+        )
+        saved = cursor.rowcount
+
+        # Clean up cell depth predictions which are no longer flooded
+        cursor.execute(
+            """
+            DELETE FROM calculations_depthprediction d
+            USING calculations_floodmodelparameters p
+            WHERE d.parameters_id = p.id
+                AND d.date = %(date)s
+                AND p.model_version_id = %(model_version_id)s
+                AND NOT EXISTS (
+                    SELECT 1 FROM depth_prediction_staging s
+                    WHERE s.parameters_id = d.parameters_id
+                )
+            """,
+            {"date": forecast_time, "model_version_id": model_version_id},
+        )
+        deleted = cursor.rowcount
 
-        else:  # create:
-            bulk_mgr.add(new_prediction)
+    logger.debug(
+        f"Saved {saved} depth predictions, removed {deleted} no-longer flooded cells"
+    )
 
 
-@jit(nopython=False)
-def predict_depth(flow_values, param):
+def predict_depth_centiles(flow_values, betas):
     """
-    Predict the depth of a cell using numpy polynomial
-    @param flow_values:
-    @param param:
-    @return:
+    Predict the depths of many cells for an ensemble of river flows, and return
+    the centiles of each cell's depths.
+    @param flow_values: array of river flows
+    @param betas: (N_cells x 5) array of polynomial coefficients beta0..beta3 and minQ
+    @return: (N_cells x 4) array of lower (10th), mid-lower (30th), median and upper (90th)
+        centile depths
     """
+    flow_values = np.asarray(flow_values, dtype=float)[np.newaxis, :]
+    coefficients = betas[:, :4]
+    minQ = betas[:, 4:5]
+
+    # Evaluate the polynomials using Horner's method, in the same order
+    # as np.polynomial.Polynomial
+    depths = coefficients[:, 3:4] + flow_values * 0
+    for i in (2, 1, 0):
+        depths = coefficients[:, i : i + 1] + depths * flow_values
+
+    # minQ is the minimum flow rate to calculate polynomial on
+    # If we're less than the minimum flow rate, then depth = 0
+    depths[flow_values < minQ] = 0
+    depths[depths < 0] = 0
 
-    # FIXME: getattr is slow
-    beta_values = [getattr(param, i, 0) for i in BETA_ARGS]
-    beta_values = [0 if b is None else b for b in beta_values]
-
-    minQ = beta_values[4]
-    beta_values = beta_values[:4]
-
-    depths = np.zeros_like(flow_values)
-    for index, element in np.ndenumerate(flow_values):
-        # minQ is the minimum flow rate to calculate polynomial on
-        # If we're less than the minimum flow rate, then depth = 0
-        if element < minQ:
-            depth = 0
-        else:
-            polynomial = np.polynomial.Polynomial(beta_values)
-            depth = polynomial(element)
+    return np.percentile(depths, [10, 30, 50, 90], axis=1).T
 
-        depths[index] = depth
 
-    # TODO: Does this have any effect?
-    depths[depths < 0] = 0
+def predict_depth(flow_values, param):
+    """
+    Predict the depth of a single cell
+    @param flow_values: array of river flows
+    @param param: FloodModelParameters of the cell
+    @return: tuple of lower, mid-lower, median and upper centile depths
+    """
+    betas = np.array([[getattr(param, i, 0) for i in BETA_ARGS]], dtype=float)
+    return tuple(predict_depth_centiles(flow_values, np.nan_to_num(betas))[0])
 
-    # Get median and centiles
-    median = np.median(depths)
-    lower_centile = np.percentile(depths, 10)
-    mid_lower_centile = np.percentile(depths, 30)
-    upper_centile = np.percentile(depths, 90)
 
-    # logger.debug(
-    #    f"depths type {type(depths)}, shape: {np.shape(depths)}"
-    # )
-    # logger.debug(
-    #    f"get median and centiles: {median} & {mid_lower_centile} & {upper_centile}"
-    # )
+def build_depth_pyramid(bounds, centiles, levels):
+    """
+    Aggregate cell depths into square blocks for each aggregation level, like an image
+    pyramid: the finest level is built from the cells, and each coarser level by summing
+    blocks of the level below. Each cell is assigned to the block containing its centroid.
+    @param bounds: (N_cells x 4) array of cell bounds (xmin, ymin, xmax, ymax)
+    @param centiles: (N_cells x 4) array of lower, mid-lower, median and upper depths
+    @param levels: aggregation levels, i.e. number of blocks across the smaller side
+        of the extent; each must divide the finest level
+    @return: dict of level to tuple of ((N_blocks x 4) block bounds, (N_blocks x 4) mean centiles)
+    """
+    if not len(bounds):
+        return {level: (np.empty((0, 4)), np.empty((0, 4))) for level in levels}
+
+    extent = (
+        bounds[:, 0].min(),
+        bounds[:, 1].min(),
+        bounds[:, 2].max(),
+        bounds[:, 3].max(),
+    )
+    levels = sorted(levels, reverse=True)
+    finest_block_size = min(extent[2] - extent[0], extent[3] - extent[1]) / levels[0]
+
+    # Sum the depths and count the cells in each block of the finest level
+    cols = np.floor(
+        ((bounds[:, 0] + bounds[:, 2]) / 2 - extent[0]) / finest_block_size
+    ).astype(np.int64)
+    rows = np.floor(
+        ((bounds[:, 1] + bounds[:, 3]) / 2 - extent[1]) / finest_block_size
+    ).astype(np.int64)
+    shape = (rows.max() + 1, cols.max() + 1)
+    flat_index = rows * shape[1] + cols
+
+    counts = np.bincount(flat_index, minlength=shape[0] * shape[1]).reshape(shape)
+    sums = np.stack(
+        [
+            np.bincount(flat_index, weights=centiles[:, k], minlength=counts.size)
+            for k in range(centiles.shape[1])
+        ],
+        axis=-1,
+    ).reshape(shape + (centiles.shape[1],))
+
+    pyramid = {}
+    previous_level = levels[0]
+    for level in levels:
+        # Reduce the level below by summing factor x factor blocks
+        factor = previous_level // level
+        if factor > 1:
+            padded_shape = (
+                -(-counts.shape[0] // factor) * factor,
+                -(-counts.shape[1] // factor) * factor,
+            )
+            counts = np.pad(
+                counts,
+                [
+                    (0, padded_shape[0] - counts.shape[0]),
+                    (0, padded_shape[1] - counts.shape[1]),
+                ],
+            )
+            sums = np.pad(
+                sums,
+                [
+                    (0, padded_shape[0] - sums.shape[0]),
+                    (0, padded_shape[1] - sums.shape[1]),
+                    (0, 0),
+                ],
+            )
+            reduced_shape = (
+                padded_shape[0] // factor,
+                factor,
+                padded_shape[1] // factor,
+                factor,
+            )
+            counts = counts.reshape(reduced_shape).sum(axis=(1, 3))
+            sums = sums.reshape(reduced_shape + (sums.shape[-1],)).sum(axis=(1, 3))
+        previous_level = level
+
+        # Average the non-empty blocks, and keep those with a non-zero median
+        block_rows, block_cols = np.nonzero(counts)
+        means = (
+            sums[block_rows, block_cols] / counts[block_rows, block_cols, np.newaxis]
+        )
+        keep = means[:, 2] != 0
+        block_rows, block_cols, means = block_rows[keep], block_cols[keep], means[keep]
+
+        block_size = finest_block_size * (levels[0] // level)
+        block_bounds = np.stack(
+            [
+                extent[0] + block_cols * block_size,
+                extent[1] + block_rows * block_size,
+                extent[0] + (block_cols + 1) * block_size,
+                extent[1] + (block_rows + 1) * block_size,
+            ],
+            axis=-1,
+        )
+        pyramid[level] = (block_bounds, means)
 
-    return lower_centile, mid_lower_centile, median, upper_centile
+    return pyramid
 
 
-@shared_task(name="aggregate_flood_models")
-def aggregate_flood_models(date):
-    logger.info(f"Aggregating flood model results for responsive tiling")
-    current_model_version_id = ModelVersion.get_current_id()
-    result = DepthPrediction.objects.filter(
-        date=date, model_version_id=current_model_version_id
-    ).aggregate(Extent("parameters__bounding_box"))
+def save_aggregated_depth_predictions(date, model_version_id, pyramid):
+    """
+    Replace the AggregatedDepthPredictions for a date with all levels of a pyramid
+    from build_depth_pyramid, using a single COPY
+    """
+    buffer = io.StringIO()
+    for level, (block_bounds, means) in pyramid.items():
+        for (xmin, ymin, xmax, ymax), (lower, mid_lower, median, upper) in zip(
+            block_bounds.tolist(), means.tolist()
+        ):
+            buffer.write(
+                f"{date.isoformat()}\t{model_version_id}\t{median!r}\t{lower!r}\t"
+                f"{mid_lower!r}\t{upper!r}\t{level}\tSRID=4326;POLYGON(("
+                f"{xmin!r} {ymin!r},{xmin!r} {ymax!r},{xmax!r} {ymax!r},"
+                f"{xmax!r} {ymin!r},{xmin!r} {ymin!r}))\n"
+            )
+    buffer.seek(0)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            """
+            DELETE FROM calculations_aggregateddepthprediction
+            WHERE date = %(date)s AND aggregation_level = ANY(%(levels)s)
+            """,
+            {"date": date, "levels": list(pyramid.keys())},
+        )
+        cursor.copy_from(
+            buffer,
+            "calculations_aggregateddepthprediction",
+            columns=(
+                "date",
+                "model_version_id",
+                "median_depth",
+                "lower_centile",
+                "mid_lower_centile",
+                "upper_centile",
+                "aggregation_level",
+                "bounding_box",
+            ),
+        )
 
-    extent = result["parameters__bounding_box__extent"]
 
-    if extent is None:
-        raise Exception(
-            "Extent is None – no bounding box defined in Flood Model Parameters!"
+def get_aggregation_level_stats(date, aggregation_level, bounds):
+    """
+    Get the AggregationLevelStats of the predictions at an aggregation level
+    @param bounds: (N x 4) array of the bounds (xmin, ymin, xmax, ymax) of the predictions
+    """
+    if not len(bounds):
+        return AggregationLevelStats(
+            date=date, aggregation_level=aggregation_level, count=0, block_size=0
         )
 
-    for i in [32, 64, 128, 256]:
-        aggregate_flood_models_by_size.delay(date, current_model_version_id, extent, i)
-
-
-@shared_task(name="aggregate_flood_models_by_size")
-def aggregate_flood_models_by_size(date, model_version_id, extent, i):
-    logger.info(f"Aggregating for date {date} level {i}")
-    bulk_mgr = BulkCreateUpdateManager(
-        chunk_size=settings.DATABASE_CHUNK_SIZE,
-        fields=(
-            "model_version_id",
-            "median_depth",
-            "lower_centile",
-            "mid_lower_centile",
-            "upper_centile",
-            "aggregation_level",
+    return AggregationLevelStats(
+        date=date,
+        aggregation_level=aggregation_level,
+        count=len(bounds),
+        block_size=min(
+            (bounds[:, 2] - bounds[:, 0]).min(), (bounds[:, 3] - bounds[:, 1]).min()
+        ),
+        bounding_box=Polygon.from_bbox(
+            (
+                bounds[:, 0].min(),
+                bounds[:, 1].min(),
+                bounds[:, 2].max(),
+                bounds[:, 3].max(),
+            )
         ),
     )
 
-    total_width = extent[2] - extent[0]
-    total_height = extent[3] - extent[1]
-    block_size = min(total_height, total_width) / i
 
-    x = extent[0]
-    y = extent[1]
-
-    while y < extent[3]:
-        while x < extent[2]:
-            x_max = x + block_size
-            y_max = y + block_size
-            new_bb = Polygon.from_bbox((x, y, x_max, y_max))
-
-            q = DepthPrediction.objects.filter(
-                date=date,
-                parameters__bounding_box__within=new_bb,
-                model_version_id=model_version_id,
-            )
-            values = q.aggregate(
-                Avg("median_depth"),
-                Avg("lower_centile"),
-                Avg("mid_lower_centile"),
-                Avg("upper_centile"),
-            )
-
-            if values["median_depth__avg"]:
-                agg = AggregatedDepthPrediction.objects.filter(
-                    date=date, bounding_box=new_bb
-                ).first()
-
-                if not agg:
-                    bulk_mgr.add(
-                        AggregatedDepthPrediction(
-                            date=date,
-                            bounding_box=new_bb,
-                            model_version_id=model_version_id,
-                            median_depth=values["median_depth__avg"],
-                            lower_centile=values["lower_centile__avg"],
-                            mid_lower_centile=values["mid_lower_centile__avg"],
-                            upper_centile=values["upper_centile__avg"],
-                            aggregation_level=i,
-                        )
-                    )
-                else:
-                    agg.model_version_id = model_version_id
-                    agg.median_depth = values["median_depth__avg"]
-                    agg.lower_centile = values["lower_centile__avg"]
-                    agg.mid_lower_centile = values["mid_lower_centile__avg"]
-                    agg.upper_centile = values["upper_centile__avg"]
-                    agg.aggregation_level = i
-                    bulk_mgr.update(agg)
-
-            x += block_size
-
-        x = extent[0]
-        y += block_size
-
-    bulk_mgr.done()
+def save_aggregation_level_stats(date, level_stats):
+    """
+    Replace the AggregationLevelStats for a date at the levels of level_stats
+    """
+    with transaction.atomic():
+        AggregationLevelStats.objects.filter(
+            date=date,
+            aggregation_level__in=[s.aggregation_level for s in level_stats],
+        ).delete()
+        AggregationLevelStats.objects.bulk_create(level_stats)
+
+
+# Upsert the PercentageFloodRisk for each date from the number of cells outside the
+# river channel with a non-zero median depth
+RISK_PERCENTAGES_SQL = """
+    INSERT INTO calculations_percentagefloodrisk (date, risk)
+    SELECT date,
+        CASE
+            -- No risk if number of cells with 'flood' is less than number of cells
+            -- that are in the river channel
+            WHEN n < %(channel_cell_count)s THEN 0
+            WHEN n > %(large_flood_count)s THEN 1
+            ELSE n::float / (%(large_flood_count)s - %(channel_cell_count)s)
+        END
+    FROM (
+        SELECT {date} AS date, count(*) AS n
+        FROM calculations_depthprediction d
+        JOIN calculations_floodmodelparameters p ON p.id = d.parameters_id
+        WHERE d.median_depth > 0
+            AND p.channel_overlap = %(channel_overlap)s
+            AND {filter}
+        {group_by}
+    ) counts
+    ON CONFLICT (date) DO UPDATE SET risk = EXCLUDED.risk
+"""
 
 
 @shared_task(name="calculate_risk_percentages")
-def calculate_risk_percentages():
-    # Convert aggregated depths to % risk based on number of cells
-    # with non-zero median depth
-    today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
-    prediction_counts = (
-        DepthPrediction.objects.filter(
-            date__gte=today,
-            median_depth__gt=0,
+def calculate_risk_percentages(date=None):
+    """
+    Convert depth predictions to % risk based on number of cells with non-zero median depth
+    @param date: forecast time to calculate the risk for, which is 0 if there are no
+        predictions; or None for every forecast time with predictions from today
+    """
+    query_params = {
+        "channel_cell_count": settings.CHANNEL_CELL_COUNT,
+        "large_flood_count": settings.LARGE_FLOOD_COUNT,
+        "channel_overlap": ChannelOverlap.NONE,
+    }
+    if date is None:
+        query_params["date"] = timezone.now().replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+        sql = RISK_PERCENTAGES_SQL.format(
+            date="d.date", filter="d.date >= %(date)s", group_by="GROUP BY d.date"
+        )
+    else:
+        query_params["date"] = date
+        sql = RISK_PERCENTAGES_SQL.format(
+            date="%(date)s", filter="d.date = %(date)s", group_by=""
         )
-        .values("date")
-        .annotate(non_zero_count=Count("median_depth"))
-        .all()
-    )
 
-    logger.info("Prediction counts total: {}".format(len(prediction_counts)))
-
-    for p in prediction_counts:
-        n = p["non_zero_count"]
-        risk = 0
-        # No risk if number of cells with 'flood' is less than number of cells
-        # that are in the river channel
-        if n < settings.CHANNEL_CELL_COUNT:
-            risk = 0
-        elif n > settings.LARGE_FLOOD_COUNT:
-            risk = 1
-        else:
-            risk = n / (settings.LARGE_FLOOD_COUNT - settings.CHANNEL_CELL_COUNT)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, query_params)
+        count = cursor.rowcount
+
+    logger.info(f"Saved {count} risk percentages")
 
-        # Delete existing row for this date before creating new
-        PercentageFloodRisk.objects.filter(date=p["date"]).delete()
-        PercentageFloodRisk(date=p["date"], risk=risk).save()
+    invalidate_daily_risks()
@@ -1,19 +1,31 @@
-from urllib.request import urlretrieve
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import re
+import shutil
+import time
 import pygrib
 import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime, timedelta, timezone
 from .models import NoaaForecast
 from django.contrib.gis.geos import Point
-from retrying import retry
 from django.conf import settings
-from tqdm import trange
+from tqdm import tqdm
 
-# if report error, retrying 72 times (6 hours), sleep 300 seconds (5 minutes) between attempts
-@retry(stop_max_attempt_number=72, wait_fixed=300)
-def GEFSdownloader(fileDate, forecastHour, latValue, lonValue):
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+
+# Seconds to wait before retrying a download, doubled for each retry up to the maximum
+DOWNLOAD_BACKOFF = 5
+DOWNLOAD_MAX_BACKOFF = 300
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def GEFSurl(fileDate, forecastHour):
     """
-    This script is developed to download files, read files, and export necessary data for generating river flows.
-    Download from stp server:
+    Get the URL of a GEFS file on the NOAA server:
     here is an example link (01/02/2022):
     "https://ftp.ncep.noaa.gov/data/nccf/com/gens/prod/gefs.20220201/00/atmos/pgrb2ap5/". There are many files in this
     folder, and all are global at 0.25 degree resolution. The file naming system is:
@@ -28,6 +40,140 @@ def GEFSdownloader(fileDate, forecastHour, latValue, lonValue):
 
     :param fileDate: the select date of file with format: YYYYMMDD (only three days back)
     :param forecastHour: the number of hours into the future that the forecast is for.
+    :return: the URL of the file.
+    """
+    subUrl = "/00/atmos/pgrb2ap5/"
+    fileNameBase = "geavg.t00z.pgrb2a.0p50.f"
+    fileName = fileNameBase + (str(forecastHour)).zfill(3)
+    return settings.GEFS_URL + "gefs." + fileDate + subUrl + fileName
+
+
+def downloadGEFSPart(session, url, partPath):
+    """
+    Download a file to partPath, continuing from the end of partPath if it exists.
+
+    :raises OSError: if the download fails or is incomplete.
+    """
+    offset = os.path.getsize(partPath) if os.path.exists(partPath) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    with session.get(url, headers=headers, stream=True, timeout=60) as response:
+        if response.status_code == 416:
+            # The partial file doesn't match the file on the server, so start again
+            os.remove(partPath)
+            raise OSError(f"Partial download of {url} is invalid")
+        response.raise_for_status()
+        if response.status_code != 206:
+            offset = 0
+
+        written = 0
+        with open(partPath, "ab" if offset else "wb") as f:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                written += len(chunk)
+
+        expected = response.headers.get("Content-Length")
+        if expected is not None and written < int(expected):
+            raise OSError(f"Download of {url} is incomplete")
+
+
+def downloadGEFSFile(session, url, path, retries=None, backoff=DOWNLOAD_BACKOFF):
+    """
+    Download a file, retrying with exponential backoff. Each retry resumes the partial
+    download from the previous attempt.
+
+    :param session: requests Session to download with.
+    :param url: the URL of the file.
+    :param path: the path to save the file to.
+    :param retries: the number of times to retry, defaults to GEFS_DOWNLOAD_RETRIES.
+    :param backoff: seconds to wait before the first retry.
+    :return: the number of attempts taken to download the file.
+    """
+    if retries is None:
+        retries = settings.GEFS_DOWNLOAD_RETRIES
+    partPath = path + ".part"
+    for attempt in range(retries + 1):
+        try:
+            downloadGEFSPart(session, url, partPath)
+            os.replace(partPath, path)
+            return attempt + 1
+        except OSError as e:
+            if attempt == retries:
+                raise
+            delay = min(backoff * 2**attempt, DOWNLOAD_MAX_BACKOFF)
+            logger.warning(f"Unable to download {url}: {e}. Retrying in {delay}s")
+            time.sleep(delay)
+
+
+def downloadGEFSFiles(urls, directory, concurrency=None, **kwargs):
+    """
+    Download files concurrently, skipping files which have already been downloaded.
+
+    :param urls: the URLs of the files.
+    :param directory: the directory to save the files to.
+    :param concurrency: the number of files to download at once, defaults to
+                        GEFS_DOWNLOAD_CONCURRENCY.
+    :param kwargs: retries and backoff for downloadGEFSFile.
+    :return: a tuple of the paths of the files, in the order of the URLs, and a dict
+             reporting the number of files downloaded and skipped, the number of retries,
+             the total seconds taken and the mean and maximum seconds for each file.
+    """
+    concurrency = concurrency or settings.GEFS_DOWNLOAD_CONCURRENCY
+    os.makedirs(directory, exist_ok=True)
+
+    # Share a connection pool between the downloads
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    def download(url, path):
+        fileStart = time.monotonic()
+        attempts = downloadGEFSFile(session, url, path, **kwargs)
+        return attempts, time.monotonic() - fileStart
+
+    paths = [os.path.join(directory, url.rsplit("/", 1)[-1]) for url in urls]
+    start = time.monotonic()
+    retries = 0
+    latencies = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            executor.submit(download, url, path)
+            for url, path in zip(urls, paths)
+            if not os.path.exists(path)
+        ]
+        try:
+            for future in tqdm(
+                as_completed(futures), total=len(futures), desc="GEFS Download"
+            ):
+                attempts, latency = future.result()
+                retries += attempts - 1
+                latencies.append(latency)
+        except BaseException:
+            executor.shutdown(cancel_futures=True)
+            raise
+
+    report = {
+        "downloaded": len(latencies),
+        "skipped": len(urls) - len(latencies),
+        "retries": retries,
+        "seconds": time.monotonic() - start,
+        "mean_latency": float(np.mean(latencies)) if latencies else 0,
+        "max_latency": max(latencies, default=0),
+    }
+    logger.info(
+        f"Downloaded {report['downloaded']} GEFS files in {report['seconds']:.1f}s"
+        f" with {report['retries']} retries, {report['skipped']} already downloaded."
+        f" Seconds per file: mean {report['mean_latency']:.1f},"
+        f" max {report['max_latency']:.1f}"
+    )
+    return paths, report
+
+
+def readGEFSFile(path, latValue, lonValue):
+    """
+    Read the data for generating river flows from a GEFS file.
+
+    :param path: the path of the GEFS file.
     :param latValue: the latitude of the specific cell.
                     (the solution is 0.5 degree. range [-90, 90] with 0.5 interval)
     :param lonValue: the longtitue of the specific cell.
@@ -40,16 +186,7 @@ def GEFSdownloader(fileDate, forecastHour, latValue, lonValue):
                 4.V Wind Component.
                 5.Total Precipitation.
     """
-
-    # download GEFSdata from ftp server.
-    rootUrl = "https://ftp.ncep.noaa.gov/data/nccf/com/gens/prod/"
-    subUrl = "/00/atmos/pgrb2ap5/"
-    fileNameBase = "geavg.t00z.pgrb2a.0p50.f"
-    fileName = fileNameBase + (str(forecastHour)).zfill(3)
-    fullUrl = rootUrl + "gefs." + fileDate + subUrl + fileName
-
-    gefsFile = urlretrieve(fullUrl)
-    gefsData = pygrib.open(gefsFile[0])
+    gefsData = pygrib.open(path)
 
     # extract necessary data sets:
     for grb in gefsData:
@@ -120,6 +257,8 @@ def GEFSdownloader(fileDate, forecastHour, latValue, lonValue):
             )
             totalPrecipValue = grb.values[index]
 
+    gefsData.close()
+
     return RHvalue, maxTempValue, minTempValue, uWindValue, vWindValue, totalPrecipValue
 
 
@@ -171,15 +310,14 @@ def prepareGEFS():
     latValue = settings.LAT_VALUE
     lonValue = settings.LON_VALUE
 
-    for i in trange(loopRange, desc="GEFS Download"):
-        forceastHour = deltaHour + i * deltaHour
+    # Download all the files, then save the data from each file in order
+    directory = os.path.join(settings.GEFS_DOWNLOAD_DIR, fileDate)
+    removeOldGEFSFiles(fileDate)
+    urls = [GEFSurl(fileDate, deltaHour + i * deltaHour) for i in range(loopRange)]
+    paths, _ = downloadGEFSFiles(urls, directory)
 
-        gefsData = GEFSdownloader(
-            fileDate=fileDate,
-            forecastHour=forceastHour,
-            latValue=latValue,
-            lonValue=lonValue,
-        )
+    for path in paths:
+        gefsData = readGEFSFile(path, latValue, lonValue)
 
         gefsData = NoaaForecast(
             location=Point(latValue, lonValue),
@@ -193,3 +331,25 @@ def prepareGEFS():
         )
 
         gefsData.save()
+
+    shutil.rmtree(directory)
+
+
+def removeOldGEFSFiles(fileDate):
+    """
+    Remove files left by incomplete downloads on other dates. Only the dated
+    subdirectories that prepareGEFS downloads into are removed.
+
+    :param fileDate: the date of the files to keep, with format: YYYYMMDD
+    """
+    if not os.path.isdir(settings.GEFS_DOWNLOAD_DIR):
+        return
+    for name in os.listdir(settings.GEFS_DOWNLOAD_DIR):
+        path = os.path.join(settings.GEFS_DOWNLOAD_DIR, name)
+        if (
+            name != fileDate
+            and re.fullmatch(r"\d{8}", name)
+            and os.path.isdir(path)
+            and not os.path.islink(path)
+        ):
+            shutil.rmtree(path)
@@ -1,13 +1,16 @@
 import math
 import os
+import time
 import numpy as np
+from numba import njit
 from django.conf import settings
+from django.db import transaction
 from datetime import date, datetime, timedelta, timezone
+from .bulk_create_manager import BulkCreateManager
 from .models import (
     NoaaForecast,
     InitialCondition,
     RiverFlowCalculationOutput,
-    RiverFlowPrediction,
     AggregatedZentraReading,
 )
 
@@ -74,6 +77,111 @@ def ModelFun(qp, Ep, dt, CatArea, X, F0):
     return Q, F0
 
 
+def ModelFunEnsemble(qp, Ep, dt, CatArea, X, F0):
+    """
+    ModelFunEnsemble is a vectorised equivalent of ModelFun. Rather than looping over each parameter set,
+    it advances the state of every parameter set (and, optionally, every weather ensemble member) as NumPy
+    arrays, stepping through time once. Results match ModelFun to rounding error.
+
+    :params qp: rainfall (mm/day), shape (time,) or (time, members)
+    :params Ep: potential evapotranspiration (mm/day), same shape as qp
+    :params dt: time-step (day)
+    :params CatArea: catchment area (km2)
+    :params X: array containing model parameters, shape (parameter sets, 4)
+    :params F0: array containing initial condition of state variables, shape (parameter sets, 3)
+                or (members, parameter sets, 3)
+
+    :return Q: river flow rate (m3/s), shape (time, parameter sets) or (time, members, parameter sets)
+    :return F0: array containing final values of state variables
+    """
+
+    # Add a trailing axis to the weather data so it broadcasts against the parameter sets
+    qp = np.asarray(qp, dtype=float)[..., np.newaxis]
+    Ep = np.asarray(Ep, dtype=float)[..., np.newaxis]
+
+    # Extract parameters
+    Smax = X[:, 0]  # (mm)
+    qmax = X[:, 1]  # (mm/day)
+    k = X[:, 2]  # (mm/day)
+    Tr = X[:, 3]  # (days)
+
+    # Extract initial conditions
+    S0 = F0[..., 0]  # initial storage level for PDM (mm)
+    qSLOW0 = F0[..., 1]  # initial slow flow rate (mm/day)
+    qFAST0 = F0[..., 2]  # initial fast flow rate (mm/day)
+
+    # Determine surface runoff and drainage
+    qro, qd, Ea, S = PDMmodelEnsemble(qp, Ep, Smax, 1, k, dt, S0)
+
+    # Determine slow flow
+    qSLOW = RoutingFunEnsemble(qd, Tr, 1, dt, qSLOW0)
+
+    # Determine fast flow
+    qFAST = RoutingFunEnsemble(qro, qmax, 5 / 3, dt, qFAST0)
+
+    # Determine river flow
+    q = qFAST + qSLOW
+
+    # Covert to m3/s
+    Q = (q * CatArea * (1e3) / 24) / (3600)
+
+    # Final values of state variables
+    F0 = np.stack([S[-1], qSLOW[-1], qFAST[-1]], axis=-1)
+    return Q, F0
+
+
+def ModelFunNumba(qp, Ep, dt, CatArea, X, F0):
+    """
+    ModelFunNumba is equivalent to ModelFun, but runs the PDM and routing stores using
+    numba-compiled kernels. Results match ModelFun to rounding error.
+
+    :params qp: rainfall (mm/day)
+    :params Ep: potential evapotranspiration (mm/day)
+    :params dt: time-step (day)
+    :params CatArea: catchment area (km2)
+    :params X: array containing model parameters
+
+    :return Q: river flow rate (m3/s)
+    :return F0: array containing final values of state variables
+    """
+
+    qp = np.ascontiguousarray(qp, dtype=float)
+    Ep = np.ascontiguousarray(Ep, dtype=float)
+    X = np.ascontiguousarray(X, dtype=float)
+    F0 = np.ascontiguousarray(F0, dtype=float)
+
+    # Determine surface runoff and drainage
+    qro, qd, Ea, S = PDMkernel(qp, Ep, X[:, 0], 1.0, X[:, 2], dt, F0[:, 0])
+
+    # Determine slow flow
+    qSLOW = RoutingFunNumba(qd, X[:, 3], 1, dt, F0[:, 1])
+
+    # Determine fast flow
+    qFAST = RoutingFunNumba(qro, X[:, 1], 5 / 3, dt, F0[:, 2])
+
+    # Determine river flow
+    q = qFAST + qSLOW
+
+    # Covert to m3/s
+    Q = (q * CatArea * (1e3) / 24) / (3600)
+
+    # Final values of state variables
+    F0 = np.stack([S[-1], qSLOW[-1], qFAST[-1]], axis=-1)
+    return Q, F0
+
+
+def warmModelFunNumba():
+    """
+    Compile the numba kernels of ModelFunNumba for the argument types of GenerateRiverFlows,
+    or load them from NUMBA_CACHE_DIR, so the first forecast doesn't wait for compilation.
+    """
+    start = time.time()
+    X = np.ones((1, 4))
+    F0 = np.ones((1, 3))
+    ModelFunNumba(np.ones(2), np.ones(2), 0.25, 1.0, X, F0)
+    logger.info(f"Prepared the numba river flow engine in {(time.time()-start):.2f}s")
+
+
 def RoutingFun(qs, X, b, dt, q0):
     """
     determines river flow data from surface runoff data using a combination of non-linear routing stores as described
@@ -138,6 +246,111 @@ def RoutingFun(qs, X, b, dt, q0):
     return q
 
 
+def RoutingFunNumba(qs, X, b, dt, q0):
+    """
+    Equivalent of RoutingFunEnsemble for a (time, parameter sets) array of drainage rates,
+    stepping through time in the numba-compiled RoutingKernel.
+
+    :params qs: Determine drainage rate, shape (time, parameter sets)
+    :params X: residence time in days (b == 1) or qmax in mm/day, one value per parameter set
+    :params b: Exponent in q=a*vˆb
+    :params dt: hourly time step
+    :params q0: initial river flow (mm/day), one value per parameter set
+
+    :return q: river flow array (mm/day), shape (time, parameter sets)
+    """
+
+    if b == 1:
+        # Linear store: X is the residence time in days
+        a = 1 / X
+        vmax = np.full(np.shape(X), float("inf"))
+
+    else:
+        # Non-linear store: X is qmax in mm/day
+        dtDAY = 1  # this is needed because qmax is determine with daily data
+        a = (np.power(X, (1 - b))) * (math.pow((b * dtDAY), (-b)))
+        vmax = np.power((a * b * dt), (1 / (1 - b)))  # Limit on v for stability
+
+    v0 = np.power((q0 / a), (1 / b))
+
+    return RoutingKernel(qs, a, vmax, float(b), dt, v0)
+
+
+@njit(cache=True)
+def RoutingKernel(qs, a, vmax, b, dt, v0):
+    """
+    Numba-compiled time stepping for RoutingFunNumba. a, vmax and v0 (the initial river
+    storage) have one value per parameter set.
+    """
+
+    numPoint, numSets = qs.shape
+    q = np.empty((numPoint, numSets))
+
+    for n in range(numSets):
+        v = v0[n]
+        for i in range(numPoint):  # Step through each day
+            # Trial values for q and v:
+            qtrial = a[n] * math.pow(v, b)
+            vtrial = v + ((qs[i, n] - qtrial) * dt)
+
+            if vtrial < vmax[n]:  # Ordinarily use trial values
+                q[i, n] = qtrial  # River flow (mm/day)
+                v = vtrial  # River storage (mm)
+            else:  # Force v<=vmax
+                q[i, n] = qs[i, n] - ((vmax[n] - v) / dt)
+                v = vmax[n]
+
+    return q
+
+
+@njit(cache=True)
+def PDMkernel(qp, Ep, Smax, gamma, k, dt, S0):
+    """
+    Numba-compiled equivalent of PDMmodel for all parameter sets at once. Smax, k and S0
+    have one value per parameter set.
+
+    return qro, qd, Ea, S: as PDMmodel, with shape (time, parameter sets)
+    """
+
+    numPoint = qp.shape[0]
+    numSets = Smax.shape[0]
+
+    qd = np.empty((numPoint, numSets))
+    qro = np.empty((numPoint, numSets))
+    Ea = np.empty((numPoint, numSets))
+    S = np.empty((numPoint, numSets))
+
+    for n in range(numSets):
+        Si = S0[n]
+        for i in range(numPoint):
+            S[i, n] = Si
+
+            # Pareto CDF
+            F = 1 - (math.pow((1 - (Si) / Smax[n]), gamma))
+
+            # Determine drainage rate
+            qd[i, n] = k[n] * Si / Smax[n]
+
+            # Trial value for S
+            Strial = Si + (((1 - F) * qp[i] - Ep[i] - qd[i, n]) * dt)
+
+            # To start with try the following:
+            qro[i, n] = F * qp[i]  # River flow contribution
+            Ea[i, n] = Ep[i]  # Actual evapotranspiration
+
+            if Strial <= 0:
+                Ea[i, n] = ((1 - F) * qp[i]) + (Si / dt)
+                qd[i, n] = 0
+                Si = 0.0
+            elif Strial >= Smax[n]:  # Force S<=Smax
+                qro[i, n] = qp[i] - Ep[i] - ((Smax[n] - Si) / dt) - qd[i, n]
+                Si = Smax[n]
+            else:
+                Si = Strial  # Catchment storage
+
+    return qro, qd, Ea, S
+
+
 def PDMmodel(qp, Ep, Smax, gamma, k, dt, S0):
     """
     PDMmodel determines surface runoff from rainfall and potential evapotranspiration data using the PDM model structure
@@ -203,6 +416,98 @@ def PDMmodel(qp, Ep, Smax, gamma, k, dt, S0):
     return qro, qd, Ea, S
 
 
+def RoutingFunEnsemble(qs, X, b, dt, q0):
+    """
+    Vectorised equivalent of RoutingFun, routing every column of qs at once.
+
+    :params qs: Determine drainage rate, shape (time, ...)
+    :params X: residence time in days (b == 1) or qmax in mm/day, one value per parameter set
+    :params b: Exponent in q=a*vˆb
+    :params dt: hourly time step
+    :params q0: initial river flow (mm/day), broadcastable against qs[0]
+
+    :return q: river flow array (mm/day), same shape as qs
+    """
+
+    if b == 1:
+        # Linear store: X is the residence time in days
+        Tr = X
+        a = 1 / Tr
+        vmax = float("inf")
+
+    else:
+        # Non-linear store: X is qmax in mm/day
+        qmax = X
+        dtDAY = 1  # this is needed because qmax is determine with daily data
+        a = (np.power(qmax, (1 - b))) * (math.pow((b * dtDAY), (-b)))
+        vmax = np.power((a * b * dt), (1 / (1 - b)))  # Limit on v for stability
+
+    q = np.empty(np.shape(qs))
+    v = np.power((q0 / a), (1 / b))
+
+    for i in range(len(qs)):  # Step through each time step
+        # Trial values for q and v:
+        qtrial = a * np.power(v, b)
+        vtrial = v + ((qs[i] - qtrial) * dt)
+
+        # Ordinarily use trial values, but force v<=vmax
+        stable = vtrial < vmax
+        q[i] = np.where(stable, qtrial, qs[i] - ((vmax - v) / dt))
+        v = np.where(stable, vtrial, vmax)
+
+    return q
+
+
+def PDMmodelEnsemble(qp, Ep, Smax, gamma, k, dt, S0):
+    """
+    Vectorised equivalent of PDMmodel, stepping all parameter sets through time at once.
+
+    params qp: Rainfall (mm/day), shape (time, ...) broadcastable against the parameters
+    params Ep: Potential evapotranspiration (mm/day), same shape as qp
+    params Smax: Maximum storage for PDM (mm), one value per parameter set
+    params gamma: Exponent for Pareto distribution
+    params k: model parameter (mm/day), one value per parameter set
+    params dt: hourly time step
+    params S0: initial storage value for PDM (mm)
+
+    return qro, qd, Ea, S: as PDMmodel, with shape (time, ...)
+    """
+
+    shape = (len(qp),) + np.broadcast_shapes(
+        np.shape(qp[0]), np.shape(Smax), np.shape(S0)
+    )
+
+    # Initialise vectors
+    qd = np.empty(shape)
+    qro = np.empty(shape)
+    Ea = np.empty(shape)
+    S = np.empty(shape)
+
+    Si = np.broadcast_to(S0, shape[1:])
+
+    for i in range(len(qp)):
+        S[i] = Si
+
+        # Pareto CDF
+        F = 1 - (np.power((1 - (Si) / Smax), gamma))
+
+        # Determine drainage rate
+        qdi = k * Si / Smax
+
+        # Trial value for S
+        Strial = Si + (((1 - F) * qp[i] - Ep[i] - qdi) * dt)
+
+        empty = Strial <= 0
+        full = ~empty & (Strial >= Smax)  # Force S<=Smax
+
+        qd[i] = np.where(empty, 0, qdi)
+        qro[i] = np.where(full, qp[i] - Ep[i] - ((Smax - Si) / dt) - qdi, F * qp[i])
+        Ea[i] = np.where(empty, ((1 - F) * qp[i]) + (Si / dt), Ep[i])
+        Si = np.where(empty, 0, np.where(full, Smax, Strial))
+
+    return qro, qd, Ea, S
+
+
 def FAO56(dt, predictionDate, Tmin, Tmax, alt, lat, T, u2, RH):
     """
     FAO56 potential evapotranspiration from weather data using the FAO56 method.
@@ -436,7 +741,12 @@ def GenerateRiverFlows(dt, predictionDate, gefsData, F0, parametersFilePath):
     E0 = fa056OutputData[1]
 
     # Determine flow rate, Q (m3/s)
-    modelfunOutputData = ModelFun(qp, Ep, dt, CatArea, X, F0)
+    if settings.RIVER_FLOW_ENGINE == "numba":
+        modelfunOutputData = ModelFunNumba(qp, Ep, dt, CatArea, X, F0)
+    elif settings.RIVER_FLOW_ENGINE == "vectorised":
+        modelfunOutputData = ModelFunEnsemble(qp, Ep, dt, CatArea, X, F0)
+    else:
+        modelfunOutputData = ModelFun(qp, Ep, dt, CatArea, X, F0)
 
     # "modelfunOutputData " is a data tuple, which:
     # modelfunOutputData [0] ====> Q
@@ -614,41 +924,45 @@ def runningGenerateRiverFlows(
     elif mode == "daily":
         nextDay = predictionDate + timedelta(days=1)
 
-    if initialDataSave == True:
-        for i in range(len(F0[:, 0])):
-            nextDayInitialCondition = InitialCondition(
-                date=nextDay,
-                location=dataLocation,
-                storage_level=F0[i, 0],
-                slow_flow_rate=F0[i, 1],
-                fast_flow_rate=F0[i, 2],
-            )
-            nextDayInitialCondition.save()
-            logger.debug("Saved nextDayInitialCondition")
-
-    if riverFlowSave == True:
-        for i in range(qp.shape[0]):
-            # save qp and Eq and into DB.
+    # Save all outputs from this run in a single transaction, using bulk inserts
+    # rather than one INSERT per row.
+    start = time.time()
+    with transaction.atomic():
+        bulk_mgr = BulkCreateManager(chunk_size=settings.DATABASE_CHUNK_SIZE)
+
+        if initialDataSave == True:
+            for i in range(len(F0[:, 0])):
+                bulk_mgr.add(
+                    InitialCondition(
+                        date=nextDay,
+                        location=dataLocation,
+                        storage_level=F0[i, 0],
+                        slow_flow_rate=F0[i, 1],
+                        fast_flow_rate=F0[i, 2],
+                    )
+                )
+
+        if riverFlowSave == True:
+            # save qp, Eq and Q into DB, with the river flows for all parameter sets
+            # stored as an array in each row.
             # ( 'calculations_riverflowcalculationoutput' table)
-            forecastTime = predictionDate + timedelta(days=i * dt)
-            riverFlowCalculationOutputData = RiverFlowCalculationOutput(
-                prediction_date=predictionDate,
-                forecast_time=forecastTime,
-                location=dataLocation,
-                rain_fall=qp[i],
-                potential_evapotranspiration=Ep[i],
-            )
-            riverFlowCalculationOutputData.save()
-
-            # save Q into DB.
-            # ('calculations_riverflowprediction' table)
-            for j in range(riverFlows.shape[1]):
-                riverFlowPredictionData = RiverFlowPrediction(
-                    prediction_index=j,
-                    calculation_output=riverFlowCalculationOutputData,
-                    river_flow=riverFlows[i, j],
+            for i in range(qp.shape[0]):
+                bulk_mgr.add(
+                    RiverFlowCalculationOutput(
+                        prediction_date=predictionDate,
+                        forecast_time=predictionDate + timedelta(days=i * dt),
+                        location=dataLocation,
+                        rain_fall=qp[i],
+                        potential_evapotranspiration=Ep[i],
+                        river_flows=riverFlows[i, :].tolist(),
+                    )
                 )
-                riverFlowPredictionData.save()
-                logger.debug(f"Saved river flow prediction {j}")
+
+        bulk_mgr.done()
+
+    logger.info(
+        f"Saved model outputs (riverFlowSave={riverFlowSave}, initialDataSave={initialDataSave})"
+        f" in {time.time() - start:.2f}s"
+    )
 
     return F0
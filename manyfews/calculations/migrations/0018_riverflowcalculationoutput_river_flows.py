@@ -0,0 +1,46 @@
+# Generated by Django 4.2 on 2026-10-18 09:12
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("calculations", "0017_remove_aggregateddepthprediction_tile_size_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="riverflowcalculationoutput",
+            name="river_flows",
+            field=django.contrib.postgres.fields.ArrayField(
+                base_field=models.FloatField(), default=list, size=None
+            ),
+        ),
+        # Copy existing per-row predictions into the new array column (and back again)
+        migrations.RunSQL(
+            sql="""
+                UPDATE calculations_riverflowcalculationoutput o
+                SET river_flows = p.river_flows
+                FROM (
+                    SELECT calculation_output_id,
+                        array_agg(river_flow ORDER BY prediction_index) AS river_flows
+                    FROM calculations_riverflowprediction
+                    GROUP BY calculation_output_id
+                ) p
+                WHERE o.id = p.calculation_output_id
+            """,
+            reverse_sql="""
+                INSERT INTO calculations_riverflowprediction
+                    (prediction_index, calculation_output_id, river_flow)
+                SELECT f.ordinality - 1, o.id, f.river_flow
+                FROM calculations_riverflowcalculationoutput o,
+                    unnest(o.river_flows) WITH ORDINALITY AS f(river_flow, ordinality)
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM calculations_riverflowprediction p
+                    WHERE p.calculation_output_id = o.id
+                )
+            """,
+        ),
+    ]
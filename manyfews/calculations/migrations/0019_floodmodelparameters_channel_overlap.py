@@ -0,0 +1,43 @@
+# Generated by Django 4.2 on 2026-10-18 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("calculations", "0018_riverflowcalculationoutput_river_flows"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="floodmodelparameters",
+            name="channel_overlap",
+            field=models.SmallIntegerField(
+                choices=[
+                    (0, "Outside river channel"),
+                    (1, "Partially within river channel"),
+                    (2, "Covered by river channel"),
+                ],
+                default=0,
+            ),
+        ),
+        # Copy of UPDATE_CHANNEL_OVERLAP_SQL from calculations.models, frozen so that
+        # later changes to the model don't change this migration
+        migrations.RunSQL(
+            sql="""
+                WITH channel AS (
+                    SELECT ST_Union(ST_Buffer(channel_location, 0)) AS geom
+                    FROM calculations_riverchannel
+                )
+                UPDATE calculations_floodmodelparameters p
+                SET channel_overlap = CASE
+                    WHEN channel.geom IS NULL OR NOT ST_Intersects(p.bounding_box, channel.geom) THEN 0
+                    WHEN ST_CoveredBy(p.bounding_box, channel.geom) THEN 2
+                    ELSE 1
+                END
+                FROM channel
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2 on 2026-10-18 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("calculations", "0019_floodmodelparameters_channel_overlap"),
+    ]
+
+    operations = [
+        # Remove duplicate predictions, keeping the most recently created
+        migrations.RunSQL(
+            sql="""
+                DELETE FROM calculations_depthprediction d
+                USING calculations_depthprediction newer
+                WHERE d.date = newer.date
+                    AND d.parameters_id = newer.parameters_id
+                    AND d.id < newer.id
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddConstraint(
+            model_name="depthprediction",
+            constraint=models.UniqueConstraint(
+                fields=("date", "parameters"), name="unique_depth_prediction"
+            ),
+        ),
+    ]
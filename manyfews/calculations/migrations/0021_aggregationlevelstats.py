@@ -0,0 +1,45 @@
+# Generated by Django 4.2 on 2026-10-18 14:05
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("calculations", "0020_depthprediction_unique_depth_prediction"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AggregationLevelStats",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateTimeField()),
+                ("aggregation_level", models.IntegerField()),
+                ("count", models.IntegerField()),
+                ("block_size", models.FloatField()),
+                (
+                    "bounding_box",
+                    django.contrib.gis.db.models.fields.PolygonField(
+                        null=True, srid=4326
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="aggregationlevelstats",
+            constraint=models.UniqueConstraint(
+                fields=("date", "aggregation_level"),
+                name="unique_aggregation_level_stats",
+            ),
+        ),
+    ]
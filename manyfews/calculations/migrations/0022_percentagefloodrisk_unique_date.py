@@ -0,0 +1,27 @@
+# Generated by Django 4.2 on 2026-10-18 15:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("calculations", "0021_aggregationlevelstats"),
+    ]
+
+    operations = [
+        # Keep only the latest risk saved for each date
+        migrations.RunSQL(
+            """
+            DELETE FROM calculations_percentagefloodrisk a
+            USING calculations_percentagefloodrisk b
+            WHERE a.date = b.date AND a.id < b.id
+            """,
+            migrations.RunSQL.noop,
+        ),
+        migrations.AlterField(
+            model_name="percentagefloodrisk",
+            name="date",
+            field=models.DateTimeField(unique=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-19 14:25
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    # The river flows were copied into RiverFlowCalculationOutput.river_flows by 0018,
+    # which copies them back into the table if this is reversed
+    dependencies = [
+        ("calculations", "0023_coefficientcacheversion"),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name="RiverFlowPrediction",
+        ),
+    ]
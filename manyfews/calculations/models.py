@@ -1,5 +1,7 @@
+from django.db import connection, transaction
 from django.db.models import Max
 from django.contrib.gis.db import models
+from django.contrib.postgres.fields import ArrayField
 from django.contrib.gis.geos import MultiPolygon, Point, Polygon
 
 
@@ -91,19 +93,40 @@ class RiverFlowCalculationOutput(models.Model):
     location = models.PointField(default=Point(0, 0))
     rain_fall = models.FloatField()
     potential_evapotranspiration = models.FloatField()
+    # River flow for each parameter set, in order of prediction_index
+    river_flows = ArrayField(models.FloatField(), default=list)
 
 
-class RiverFlowPrediction(models.Model):
-    prediction_index = models.IntegerField(default=int(0))
-    calculation_output = models.ForeignKey(
-        RiverFlowCalculationOutput, on_delete=models.CASCADE
+class ChannelOverlap(models.IntegerChoices):
+    NONE = 0, "Outside river channel"
+    PARTIAL = 1, "Partially within river channel"
+    COVERED = 2, "Covered by river channel"
+
+
+# Sets FloodModelParameters.channel_overlap from the union of all river channels,
+# in a single spatial join
+UPDATE_CHANNEL_OVERLAP_SQL = """
+    WITH channel AS (
+        SELECT ST_Union(ST_Buffer(channel_location, 0)) AS geom
+        FROM calculations_riverchannel
     )
-    river_flow = models.FloatField()
+    UPDATE calculations_floodmodelparameters p
+    SET channel_overlap = CASE
+        WHEN channel.geom IS NULL OR NOT ST_Intersects(p.bounding_box, channel.geom) THEN 0
+        WHEN ST_CoveredBy(p.bounding_box, channel.geom) THEN 2
+        ELSE 1
+    END
+    FROM channel
+"""
 
 
 class FloodModelParameters(models.Model):
     model_version = models.ForeignKey(ModelVersion, on_delete=models.CASCADE)
     bounding_box = models.PolygonField(default=Polygon.from_bbox((0, 0, 1, 1)))
+    # Whether the cell lies in a river channel; updated by update_channel_overlap
+    channel_overlap = models.SmallIntegerField(
+        choices=ChannelOverlap.choices, default=ChannelOverlap.NONE
+    )
     beta0 = models.FloatField()
     # Allow variable number of parameters - we'll just use the populated ones
     beta1 = models.FloatField(null=True)
@@ -119,10 +142,58 @@ class FloodModelParameters(models.Model):
     beta11 = models.FloatField(null=True)
     beta12 = models.FloatField(null=True)
 
+    @staticmethod
+    def update_channel_overlap(model_version_id=None):
+        """
+        Recalculate channel_overlap for the parameters of a model version
+        (or all parameters if model_version_id is None)
+        """
+        with connection.cursor() as cursor:
+            if model_version_id is None:
+                cursor.execute(UPDATE_CHANNEL_OVERLAP_SQL)
+            else:
+                cursor.execute(
+                    UPDATE_CHANNEL_OVERLAP_SQL + " WHERE p.model_version_id = %s",
+                    [model_version_id],
+                )
+
+        # Cached coefficients only include cells outside the channel
+        from .coefficient_cache import invalidate_coefficient_cache
+
+        invalidate_coefficient_cache()
+
+    @staticmethod
+    def queue_update_channel_overlap():
+        """
+        Recalculate channel_overlap for all parameters in a celery task once the current
+        transaction commits, so editing river channels doesn't wait for the spatial update
+        """
+        from .tasks import update_river_channel_overlap
+
+        transaction.on_commit(update_river_channel_overlap.delay)
+
+
+class CoefficientCacheVersion(models.Model):
+    """
+    Version of the cached flood model coefficients, stored in a single row. Incrementing
+    it invalidates the caches in every container, as cache files are named by version.
+    """
+
+    version = models.PositiveIntegerField(default=0)
+
 
 class RiverChannel(models.Model):
     channel_location = models.MultiPolygonField(default=MultiPolygon())
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        FloodModelParameters.queue_update_channel_overlap()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        FloodModelParameters.queue_update_channel_overlap()
+        return result
+
 
 class AbstractDepthPrediction(models.Model):
     date = models.DateTimeField()
@@ -142,12 +213,43 @@ class AbstractDepthPrediction(models.Model):
 class DepthPrediction(AbstractDepthPrediction):
     parameters = models.ForeignKey(FloodModelParameters, on_delete=models.CASCADE)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["date", "parameters"], name="unique_depth_prediction"
+            )
+        ]
+
 
 class AggregatedDepthPrediction(AbstractDepthPrediction):
     bounding_box = models.PolygonField(default=Polygon.from_bbox((0, 0, 1, 1)))
     aggregation_level = models.IntegerField()
 
 
-class PercentageFloodRisk(models.Model):
+class AggregationLevelStats(models.Model):
+    """
+    Statistics of the depth predictions at each aggregation level for a date, used to
+    choose the aggregation level for a map extent. Level -1 is the DepthPredictions.
+    """
+
     date = models.DateTimeField()
+    aggregation_level = models.IntegerField()
+    # Number of predictions at the level
+    count = models.IntegerField()
+    # Smallest width or height of the predictions, in degrees
+    block_size = models.FloatField()
+    # Extent of the predictions, or null if there are none
+    bounding_box = models.PolygonField(null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["date", "aggregation_level"],
+                name="unique_aggregation_level_stats",
+            )
+        ]
+
+
+class PercentageFloodRisk(models.Model):
+    date = models.DateTimeField(unique=True)
     risk = models.FloatField()
@@ -1,6 +1,9 @@
 import csv
+import time
 
-from celery import Celery, shared_task
+from celery import Celery, chain, shared_task
+from celery.exceptions import ChordError
+from celery.signals import worker_process_init
 
 from django.conf import settings
 from django.contrib.gis.geos import Point, Polygon
@@ -9,16 +12,24 @@ from django.core.exceptions import ObjectDoesNotExist
 import numpy as np
 from tqdm import tqdm, trange
 
+from webapp.alerts import TwilioMessageDispatcher, log_dispatch_report
 from webapp.models import UserAlert, UserPhoneNumber, AlertType
 from zentra.api import ZentraToken
 
-from .alerts import send_phone_alerts_for_user
+from .alerts import (
+    expire_sent_alerts,
+    get_alert_messages,
+    get_alert_window,
+    send_alert_messages,
+    send_phone_alerts_for_user,
+)
 from .bulk_create_manager import BulkCreateManager
 from .flood_risk import run_all_flood_models, calculate_risk_percentages
 from .gefs import prepareGEFS
 from .generate_river_flows import (
     prepareWeatherForecastData,
     runningGenerateRiverFlows,
+    warmModelFunNumba,
 )
 from .models import (
     AggregatedZentraReading,
@@ -29,8 +40,8 @@ from .models import (
     ZentraDevice,
     PercentageFloodRisk,
     AggregatedDepthPrediction,
+    AggregationLevelStats,
     DepthPrediction,
-    RiverFlowPrediction,
     RiverFlowCalculationOutput,
     ZentraReading,
 )
@@ -41,9 +52,20 @@ from celery.utils.log import get_task_logger
 
 logger = get_task_logger(__name__)
 
+# Number of alert messages to send between saving which were sent
+ALERT_MESSAGE_BATCH_SIZE = 100
+
 app = Celery()
 
 
+@worker_process_init.connect
+def warm_river_flow_engine(**kwargs):
+    # Compiling the numba kernels takes longer than a run of the loop engine, so do it
+    # as each worker process starts rather than in the first forecast
+    if settings.RIVER_FLOW_ENGINE == "numba":
+        warmModelFunNumba()
+
+
 @shared_task(name="calculations.hello_celery")
 def hello_celery():
     """
@@ -246,6 +268,16 @@ def run_flood_model():
     run_all_flood_models()
 
 
+@shared_task(name="Run daily forecast")
+def run_daily_forecast():
+    """
+    Update the river flow forecast, then run the flood model for each forecast time.
+    Risks are calculated as each forecast time completes, and alerts are sent once
+    the forecast times they cover are complete.
+    """
+    chain(dailyModelUpdate.si(), run_flood_model.si()).delay()
+
+
 @shared_task(name="Calculate percentage risks")
 def calculate_percentage_risk():
     calculate_risk_percentages()
@@ -258,17 +290,45 @@ def send_user_sms_alerts(user_id, phone_number_id):
 
 @shared_task(name="Send all alerts")
 def send_alerts():
-    # Get and send SMS alerts
-    # Group by user and phone number, so we can send alerts for multiple locations at once
-    sms_alerts = (
-        UserAlert.objects.filter(verified=True, alert_type=AlertType.SMS)
-        .values("user_id", "phone_number")
-        .distinct()
+    # Evaluate all verified alerts at once, grouped by phone number so we can send
+    # alerts for multiple locations at once. Messages are sent from this task through
+    # one dispatcher, so TWILIO_SEND_RATE limits the whole run.
+    start = time.time()
+    messages = get_alert_messages(
+        *get_alert_window(), UserAlert.objects.filter(verified=True)
     )
-    for alert_details in sms_alerts:
-        result = send_user_sms_alerts.delay(
-            alert_details["user_id"], alert_details["phone_number"]
+    expired = expire_sent_alerts(messages)
+    if expired:
+        logger.info(f"Expired {expired} sent alerts for flood events which have ended")
+    logger.info(f"Sending {len(messages)} alert messages")
+    if not messages:
+        return
+
+    dispatcher = TwilioMessageDispatcher()
+    report = {"sent": 0, "failed": 0, "unchanged": 0, "duplicate": 0}
+    for i in range(0, len(messages), ALERT_MESSAGE_BATCH_SIZE):
+        batch_report = send_alert_messages(
+            messages[i : i + ALERT_MESSAGE_BATCH_SIZE], dispatcher
         )
+        for key in report:
+            report[key] += batch_report[key]
+    report["seconds"] = time.time() - start
+    log_dispatch_report(report)
+    logger.info(
+        f"Skipped {report['unchanged']} unchanged and {report['duplicate']} duplicate"
+        " alert messages"
+    )
+    return report
+
+
+@shared_task(name="Send alerts after flood model failure")
+def send_alerts_after_failure(request, exc, traceback):
+    # Errback of the flood model chord. A failed forecast time stops the chord calling
+    # "Send all alerts", so send the alerts for the forecast times which did complete.
+    # Failures of "Send all alerts" itself aren't repeated.
+    if isinstance(exc, ChordError):
+        logger.error(f"Sending alerts after flood model failure: {exc}")
+        send_alerts.delay()
 
 
 @shared_task(name="Load parameters", bind=True)
@@ -330,6 +390,9 @@ def load_params_from_csv(self, filename: str, model_version_id: str):
 
     logger.info("Saved model parameters.")
 
+    FloodModelParameters.update_channel_overlap(model_version_id)
+    logger.info("Updated river channel cells.")
+
     # Clean up old parameters from db
     current_model_version_id = ModelVersion.get_current_id()
     FloodModelParameters.objects.exclude(
@@ -338,6 +401,12 @@ def load_params_from_csv(self, filename: str, model_version_id: str):
     logger.info("Deleted old model parameters")
 
 
+@shared_task(name="Update river channel overlap")
+def update_river_channel_overlap():
+    FloodModelParameters.update_channel_overlap()
+    logger.info("Updated river channel cells.")
+
+
 @shared_task(name="Import Zentra Devices")
 def import_zentra_devices():
     token = ZentraToken(username=settings.ZENTRA_UN, password=settings.ZENTRA_PW)
@@ -351,8 +420,8 @@ def drop_database():
 
     PercentageFloodRisk.objects.all().delete()
     AggregatedDepthPrediction.objects.all().delete()
+    AggregationLevelStats.objects.all().delete()
     DepthPrediction.objects.all().delete()
-    RiverFlowPrediction.objects.all().delete()
     RiverFlowCalculationOutput.objects.all().delete()
     InitialCondition.objects.all().delete()
     AggregatedZentraReading.objects.all().delete()
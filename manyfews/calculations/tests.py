@@ -1,34 +1,82 @@
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
-import os, tempfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import glob, math, os, tempfile, threading
 
+from celery.exceptions import ChordError
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.contrib.gis.db.models import Extent
 from django.contrib.gis.geos import MultiPolygon, Point, Polygon
-from django.test import TestCase
+from django.core.management import call_command
+from django.db import DataError
+from django.test import TestCase, override_settings
 import numpy as np
 import xlrd
 from unittest import mock
 
-from webapp.models import UserAlert, UserPhoneNumber, AlertType
-from .alerts import send_phone_alerts_for_user
-from .flood_risk import predict_depth, predict_depths
+from webapp.models import SentAlert, UserAlert, UserPhoneNumber, AlertType
+from .alerts import (
+    get_alert_messages,
+    get_alert_window,
+    get_event_hash,
+    send_alert_messages,
+    send_phone_alerts_for_user,
+)
+from .coefficient_cache import (
+    coefficient_cache_path,
+    get_cache_version,
+    invalidate_coefficient_cache,
+    load_coefficients,
+)
+from .flood_risk import (
+    AGGREGATION_LEVELS,
+    BETA_ARGS,
+    build_depth_pyramid,
+    calculate_risk_percentages,
+    predict_depth,
+    predict_depth_centiles,
+    predict_depths,
+    run_all_flood_models,
+    run_flood_model_for_time,
+    save_depth_predictions,
+)
+from .depth_tiles import (
+    EMPTY_TILE_NAME,
+    get_depth_tile_key,
+    interpolate_ylgnbu,
+    plan_aggregation_level,
+    render_depth_tiles,
+    render_tiles,
+)
+from .gefs import GEFSurl, downloadGEFSFiles, prepareGEFS
+from .generate_river_flows import (
+    GenerateRiverFlows,
+    ModelFun,
+    ModelFunEnsemble,
+    runningGenerateRiverFlows,
+)
 from .models import (
+    AggregatedDepthPrediction,
+    AggregationLevelStats,
+    ChannelOverlap,
     DepthPrediction,
     FloodModelParameters,
     ModelVersion,
+    PercentageFloodRisk,
     RiverChannel,
     ZentraDevice,
     ZentraReading,
     NoaaForecast,
     InitialCondition,
     AggregatedZentraReading,
-    RiverFlowPrediction,
     RiverFlowCalculationOutput,
 )
 from .tasks import (
     initialModelSetUp,
     dailyModelUpdate,
     send_alerts,
+    send_alerts_after_failure,
     load_params_from_csv,
     import_zentra_devices,
 )
@@ -58,6 +106,14 @@ def excel_to_matrix(path, sheet_num):
     return datamatrix
 
 
+def data_file_path(filename):
+    """Return the absolute path of a file in the project's Data directory."""
+    projectPath = os.path.abspath(
+        os.path.join((os.path.split(os.path.realpath(__file__))[0]), "../../")
+    )
+    return os.path.join(projectPath, "Data", filename)
+
+
 def prepare_test_data():
     """
     This function is used to import test GEFS and initial condition data into database.
@@ -126,6 +182,19 @@ def prepare_test_data():
     return testDate, testLocation
 
 
+@contextmanager
+def update_channel_overlap_on_commit(test_case):
+    """
+    Run the channel overlap update task queued by saving a RiverChannel synchronously,
+    when the block exits
+    """
+    with mock.patch(
+        "calculations.tasks.update_river_channel_overlap.delay",
+        FloodModelParameters.update_channel_overlap,
+    ), test_case.captureOnCommitCallbacks(execute=True):
+        yield
+
+
 class TaskTest(TestCase):
     def setUp(self):
         super().setUp()
@@ -171,8 +240,8 @@ class TaskTest(TestCase):
         self.riverOutput = RiverFlowCalculationOutput.objects.all()
         assert len(self.riverOutput) == 8
 
-        self.riverOutputPrediction = RiverFlowPrediction.objects.all()
-        assert len(self.riverOutputPrediction) == 800
+        for output in self.riverOutput:
+            assert len(output.river_flows) == 100
 
         # check that the new initial condition in the database
         self.initialCondition = InitialCondition.objects.all()
@@ -255,17 +324,43 @@ class UserAlertTests(TestCase):
         )
         self.alert3.save()
 
-    @mock.patch("calculations.tasks.send_user_sms_alerts")
-    def test_send_alerts(self, mock):
+    def create_prediction(self, bbox, days=1, median_depth=1, parameters=None):
+        model_version = ModelVersion.objects.filter(is_current=True).first()
+        if model_version is None:
+            model_version = ModelVersion(version_name="v1", is_current=True)
+            model_version.save()
+        if parameters is None:
+            parameters = FloodModelParameters(
+                model_version=model_version,
+                bounding_box=Polygon.from_bbox(bbox),
+                beta0=0,
+            )
+            parameters.save()
+        prediction = DepthPrediction(
+            date=datetime.utcnow().date() + timedelta(days=days),
+            parameters=parameters,
+            median_depth=median_depth,
+            lower_centile=0.5,
+            mid_lower_centile=0.7,
+            upper_centile=1.5,
+            model_version=model_version,
+        )
+        prediction.save()
+        return prediction
+
+    @mock.patch("calculations.tasks.send_alert_messages")
+    def test_send_alerts(self, send_mock):
         # Call send_alerts: mock should not be called as nothing in db
         send_alerts()
-        mock.assert_not_called()
+        send_mock.assert_not_called()
 
         self.setUpAlerts()
+        # Add a DepthPrediction in a location crossing all alerts
+        self.create_prediction((9, 9, 11, 11))
 
         # Call send_alerts again. Should not call mock as alerts not verified.
         send_alerts()
-        mock.assert_not_called()
+        send_mock.assert_not_called()
 
         # Verify alerts 1 and 2
         self.alert1.verified = True
@@ -273,23 +368,48 @@ class UserAlertTests(TestCase):
         self.alert2.verified = True
         self.alert2.save()
 
-        # Call send_alerts again. Should call mock delay with user and phone number1 ids
-        send_alerts()
-        mock.delay.assert_called_once_with(self.user.id, self.phone_number1.id)
-
-        mock.reset_mock()
+        # Call send_alerts again. Should send one message to phone number1, for both alerts
+        send_mock.return_value = {
+            "sent": 1,
+            "failed": 0,
+            "unchanged": 0,
+            "duplicate": 0,
+        }
+        with self.assertNumQueries(2):
+            report = send_alerts()
+        send_mock.assert_called_once()
+        assert report["sent"] == 1
+        (messages, _), _ = send_mock.call_args
+        assert len(messages) == 1
+        phone_number, alert_type, message, _ = messages[0]
+        assert phone_number == "+441234567890"
+        assert alert_type == AlertType.SMS
+        assert message.startswith("Floods up to 1.0m predicted from ")
+
+        send_mock.reset_mock()
 
         # Verify alert 3
         self.alert3.verified = True
         self.alert3.save()
-        # Call send_alerts again. Should call mock delay twice with both phone numbers
+        # Call send_alerts again. Should send the same message to both phone numbers
         send_alerts()
-        mock.delay.assert_has_calls(
-            mock.call(self.user.id, self.phone_number1.id),
-            mock.call(self.user.id, self.phone_number2.id),
-        )
+        (messages, _), _ = send_mock.call_args
+        assert [m[:3] for m in sorted(messages)] == [
+            ("+441234567890", AlertType.SMS, message),
+            ("+449876543210", AlertType.SMS, message),
+        ]
+
+        # Batches are sent through one dispatcher, so its rate limit covers them all
+        send_mock.reset_mock()
+        with mock.patch("calculations.tasks.ALERT_MESSAGE_BATCH_SIZE", 1):
+            report = send_alerts()
+        assert report["sent"] == 2
+        (_, first), (_, second) = [c.args for c in send_mock.call_args_list]
+        assert first is second
 
-    @mock.patch("calculations.alerts.TwilioAlerts.send_alert_sms")
+    @mock.patch(
+        "calculations.alerts.TwilioMessageDispatcher.send_message", return_value=True
+    )
     def test_send_sms_alerts(self, sms_mock):
         self.setUpAlerts()
         # No depths in db so should not make any calls to Twilio apart from constructor
@@ -297,32 +417,15 @@ class UserAlertTests(TestCase):
         sms_mock.assert_not_called()
 
         # Add an DepthPrediction in a location crossing alert2 and alert3
-        model_version = ModelVersion(version_name="v1", is_current=True)
-        model_version.save()
-        parameters = FloodModelParameters(
-            model_version=model_version,
-            bounding_box=Polygon.from_bbox((9, 9, 11, 11)),
-            beta0=0,
-        )
-        parameters.save()
-        prediction = DepthPrediction(
-            date=datetime.utcnow().date() + timedelta(days=1),
-            parameters=parameters,
-            median_depth=1,
-            lower_centile=0.5,
-            mid_lower_centile=0.7,
-            upper_centile=1.5,
-            model_version=model_version,
-        )
-        prediction.save()
+        self.create_prediction((9, 9, 11, 11))
 
         # Call with user 1, phone number 1
         send_phone_alerts_for_user(self.user.id, self.phone_number1.id)
         assert sms_mock.call_count == 1
         call_args = sms_mock.call_args[0]
         assert call_args[0] == "+441234567890"
-        assert call_args[1].startswith("Floods up to 1.0m predicted from ")
-        assert call_args[1].endswith(f"See {settings.SITE_URL} for details.")
+        assert call_args[2].startswith("Floods up to 1.0m predicted from ")
+        assert call_args[2].endswith(f"See {settings.SITE_URL} for details.")
 
         sms_mock.reset_mock()
 
@@ -331,7 +434,7 @@ class UserAlertTests(TestCase):
         assert sms_mock.call_count == 1
         call_args2 = sms_mock.call_args[0]
         assert call_args2[0] == "+449876543210"
-        assert call_args2[1] == call_args[1]
+        assert call_args2[2] == call_args[2]
 
         sms_mock.reset_mock()
 
@@ -339,22 +442,240 @@ class UserAlertTests(TestCase):
         channel = RiverChannel(
             channel_location=MultiPolygon([Polygon.from_bbox((8, 8, 12, 12))])
         )
-        channel.save()
+        with update_channel_overlap_on_commit(self):
+            channel.save()
         send_phone_alerts_for_user(self.user.id, self.phone_number2.id)
         assert sms_mock.call_count == 0
 
         sms_mock.reset_mock()
 
         # Modify river channel so it only covers part of the DepthPrediction and alert intersection - should send alert
+        # (forgetting the last alert sent, as the message is the same)
+        SentAlert.objects.all().delete()
         channel.channel_location = MultiPolygon(
             [Polygon.from_bbox((10, 10, 10.5, 10.5))]
         )
-        channel.save()
+        with update_channel_overlap_on_commit(self):
+            channel.save()
         send_phone_alerts_for_user(self.user.id, self.phone_number2.id)
         assert sms_mock.call_count == 1
         call_args2 = sms_mock.call_args[0]
         assert call_args2[0] == "+449876543210"
-        assert call_args2[1] == call_args[1]
+        assert call_args2[2] == call_args[2]
+
+    def test_get_alert_messages(self):
+        self.setUpAlerts()
+        # Floods in alert1 on two days, a deeper flood in alert3, and floods outside
+        # the alerts or the alert window
+        first = self.create_prediction((4, 4, 5, 5), days=1, median_depth=1)
+        last = self.create_prediction((6, 6, 7, 7), days=2, median_depth=0.5)
+        self.create_prediction((15, 15, 16, 16), days=1, median_depth=3)
+        self.create_prediction((30, 30, 31, 31), days=1, median_depth=5)
+        self.create_prediction((4, 4, 5, 5), days=10, median_depth=5)
+
+        # Alerts are found from the flooded cells, and combined for each phone number
+        with self.settings(ALERT_TEXT="{max_depth} {start_date} {end_date}"):
+            messages = get_alert_messages(
+                *get_alert_window(),
+                UserAlert.objects.filter(phone_number=self.phone_number1),
+            )
+        first.refresh_from_db()
+        last.refresh_from_db()
+        date_format = settings.ALERT_DATE_FORMAT
+        assert messages == [
+            (
+                "+441234567890",
+                AlertType.SMS,
+                f"1.0 {first.date.strftime(date_format)}"
+                f" {last.date.strftime(date_format)}",
+                get_event_hash(sorted([first.parameters_id, last.parameters_id]), 1.0),
+            )
+        ]
+
+        # Alerts of other users with the same number are combined into one message
+        other_user = User.objects.create(username="user2")
+        UserAlert.objects.create(
+            user=other_user,
+            phone_number=UserPhoneNumber.objects.create(
+                user=other_user, phone_number="+441234567890"
+            ),
+            alert_type=AlertType.SMS,
+            location=Polygon.from_bbox((14, 14, 17, 17)),
+        )
+        messages = get_alert_messages(*get_alert_window(), UserAlert.objects.all())
+        assert sorted(m[:2] for m in messages) == [
+            ("+441234567890", AlertType.SMS),
+            ("+449876543210", AlertType.SMS),
+        ]
+        message = next(m[2] for m in messages if m[0] == "+441234567890")
+        assert message.startswith("Floods up to 3.0m")
+
+    @mock.patch("calculations.alerts.TwilioMessageDispatcher.send_message")
+    def test_send_alert_messages_unchanged(self, send_mock):
+        send_mock.return_value = True
+        messages = [
+            ("+441234567890", AlertType.SMS, "Floods up to 1.0m", "event1"),
+            ("+449876543210", AlertType.SMS, "Floods up to 1.0m", "event1"),
+        ]
+        report = send_alert_messages(messages)
+        assert (report["sent"], report["unchanged"]) == (2, 0)
+
+        # Only one message is sent to each number, and the duplicates are reported
+        send_mock.reset_mock()
+        SentAlert.objects.all().delete()
+        with self.assertLogs("calculations.alerts", "WARNING"):
+            report = send_alert_messages(messages + [messages[0]])
+        assert (report["sent"], report["unchanged"], report["duplicate"]) == (2, 0, 1)
+        assert send_mock.call_count == 2
+
+        # Unchanged messages are skipped, with one query to find the last messages sent
+        send_mock.reset_mock()
+        messages[1] = ("+449876543210", AlertType.SMS, "Floods up to 2.0m", "event2")
+        with self.assertNumQueries(2):
+            report = send_alert_messages(messages)
+        assert (report["sent"], report["unchanged"]) == (1, 1)
+        send_mock.assert_called_once_with(*messages[1][:3])
+
+        # Messages which failed to send are sent again
+        send_mock.reset_mock()
+        send_mock.return_value = False
+        messages[1] = ("+449876543210", AlertType.SMS, "Floods up to 3.0m", "event3")
+        send_alert_messages(messages)
+        send_mock.return_value = True
+        report = send_alert_messages(messages)
+        assert (report["sent"], report["unchanged"]) == (1, 1)
+        assert send_mock.call_count == 2
+
+    @mock.patch(
+        "calculations.alerts.TwilioMessageDispatcher.send_message", return_value=True
+    )
+    def test_send_alert_messages_ongoing_event(self, send_mock):
+        self.setUpAlerts()
+        alerts = UserAlert.objects.filter(phone_number=self.phone_number1)
+        first = self.create_prediction((4, 4, 5, 5), days=1)
+        self.create_prediction((4, 4, 5, 5), days=2, parameters=first.parameters)
+        (message,) = get_alert_messages(*get_alert_window(), alerts)
+        send_alert_messages([message])
+        send_mock.assert_called_once()
+
+        # Two days later the flood starts later in the alert window, but it is the
+        # same flood event, so the alert isn't sent again
+        send_mock.reset_mock()
+        later = datetime.now(timezone.utc) + timedelta(days=2)
+        with mock.patch("calculations.alerts.timezone.now", return_value=later):
+            (ongoing,) = get_alert_messages(*get_alert_window(), alerts)
+            assert ongoing[2] != message[2]
+            report = send_alert_messages([ongoing])
+            assert report["unchanged"] == 1
+            send_mock.assert_not_called()
+
+            # A deeper flood is a new event
+            self.create_prediction(
+                (4, 4, 5, 5), days=3, median_depth=2, parameters=first.parameters
+            )
+            (deeper,) = get_alert_messages(*get_alert_window(), alerts)
+            report = send_alert_messages([deeper])
+            assert report["sent"] == 1
+
+    @mock.patch(
+        "calculations.alerts.TwilioMessageDispatcher.send_message", return_value=True
+    )
+    def test_send_alerts_recurring_event(self, send_mock):
+        self.setUpAlerts()
+        self.alert1.verified = True
+        self.alert1.save()
+        prediction = self.create_prediction((4, 4, 5, 5))
+        report = send_alerts()
+        assert report["sent"] == 1
+
+        # The event is ongoing, so the alert isn't sent again
+        report = send_alerts()
+        assert (report["sent"], report["unchanged"]) == (0, 1)
+
+        # When the event ends the last alert sent is forgotten
+        prediction.delete()
+        send_alerts()
+        assert not SentAlert.objects.exists()
+
+        # so an identical flood which recurs is alerted again
+        send_mock.reset_mock()
+        self.create_prediction((4, 4, 5, 5), parameters=prediction.parameters)
+        report = send_alerts()
+        assert report["sent"] == 1
+        send_mock.assert_called_once()
+
+
+class RiverFlowModelTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.predictionDate = datetime(2010, 1, 1, tzinfo=timezone.utc)
+        self.gefsData = excel_to_matrix(data_file_path("GEFSdata.xlsx"), 16)
+        self.parametersFile = data_file_path("RainfallRunoffModelParameters.csv")
+        self.F0 = np.loadtxt(
+            open(data_file_path("RainfallRunoffModelInitialConditions.csv")),
+            delimiter=",",
+            usecols=range(3),
+        )
+
+    def run_engine(self, engine):
+        with override_settings(RIVER_FLOW_ENGINE=engine):
+            return GenerateRiverFlows(
+                dt=0.25,
+                predictionDate=self.predictionDate,
+                gefsData=self.gefsData,
+                F0=self.F0.copy(),
+                parametersFilePath=self.parametersFile,
+            )
+
+    def test_engines_match_benchmark(self):
+        Q_benchmark = np.loadtxt(data_file_path("Q_Benchmark.csv"), delimiter=",")
+        Q_loop, qp, Ep, F0_loop = self.run_engine("loop")
+        np.testing.assert_almost_equal(Q_loop, Q_benchmark, 3)
+
+        # Other engines must match the loop to rounding error
+        for engine in ("vectorised", "numba"):
+            Q, _, _, F0 = self.run_engine(engine)
+            np.testing.assert_allclose(Q, Q_loop, rtol=1e-12, atol=1e-12)
+            np.testing.assert_allclose(F0, F0_loop, rtol=1e-12, atol=1e-12)
+
+    def test_ensemble_members(self):
+        X = np.loadtxt(open(self.parametersFile), delimiter=",", usecols=range(4))
+        qp = np.stack([self.gefsData[:, 5], 2 * self.gefsData[:, 5]], axis=1) / 0.25
+        Ep = np.full(qp.shape, 4.0)
+
+        Q, F0 = ModelFunEnsemble(qp, Ep, 0.25, 212.2640, X, self.F0.copy())
+        assert Q.shape == (len(qp), 2, 100)
+        assert F0.shape == (2, 100, 3)
+
+        # Each member should match a separate run of the loop model
+        for m in range(2):
+            Q_m, F0_m = ModelFun(qp[:, m], Ep[:, m], 0.25, 212.2640, X, self.F0.copy())
+            np.testing.assert_allclose(Q[:, m], Q_m, rtol=1e-12, atol=1e-12)
+            np.testing.assert_allclose(F0[m], F0_m, rtol=1e-12, atol=1e-12)
+
+    @override_settings(DATABASE_CHUNK_SIZE=1000)
+    def test_save_river_flows(self):
+        # All outputs should be saved with bulk inserts in one transaction:
+        # SAVEPOINT, 1 InitialCondition insert, 1 RiverFlowCalculationOutput insert,
+        # RELEASE SAVEPOINT
+        with self.assertNumQueries(4):
+            runningGenerateRiverFlows(
+                predictionDate=self.predictionDate,
+                dataLocation=Point(0, 0),
+                weatherForecast=self.gefsData,
+                initialData=self.F0.copy(),
+            )
+
+        assert InitialCondition.objects.count() == 100
+        assert RiverFlowCalculationOutput.objects.count() == 64
+
+        # Check each output holds the flows for all parameter sets
+        Q, _, _, _ = self.run_engine("loop")
+        outputs = RiverFlowCalculationOutput.objects.order_by("forecast_time")
+        for i, output in enumerate(outputs):
+            np.testing.assert_allclose(
+                output.river_flows, Q[i, :], rtol=1e-12, atol=1e-12
+            )
 
 
 class FloodCalculationTests(TestCase):
@@ -364,6 +685,13 @@ class FloodCalculationTests(TestCase):
         super().setUp()
         self.test_date = datetime(2015, 10, 3, 23, 55, 59, 342380)
 
+        # Use a separate coefficient cache for each test
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        settings_override = self.settings(FLOOD_MODEL_CACHE_DIR=cache_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
     def create_depth_predictions(self):
         model_version = ModelVersion.objects.first()
 
@@ -399,43 +727,458 @@ class FloodCalculationTests(TestCase):
         stats = predict_depth(flows, params)
         assert stats == (0, 0, 0, 0)
 
-    @mock.patch("calculations.flood_risk.predict_depth")
-    def test_bulk_predict_depths_delete(self, predict_depth):
-        predict_depth.return_value = (8.14, 21.95, 36.63, -1)
-        dummy_param_list = [1, 2, 3, 4]
-        self.create_depth_predictions()
+    def check_depth_predictions(self, flows):
+        # Each flooded cell should have a prediction matching predict_depth
+        flooded = 0
+        for param in FloodModelParameters.objects.all():
+            lower, mid_lower, median, upper = predict_depth(flows, param)
+            prediction = DepthPrediction.objects.filter(
+                date=self.test_date, parameters=param
+            ).first()
+            if upper > 0:
+                flooded += 1
+                np.testing.assert_almost_equal(
+                    (
+                        prediction.lower_centile,
+                        prediction.mid_lower_centile,
+                        prediction.median_depth,
+                        prediction.upper_centile,
+                    ),
+                    (lower, mid_lower, median, upper),
+                )
+            else:
+                assert prediction is None
 
-        self.assertEqual(DepthPrediction.objects.filter(date=self.test_date).count(), 4)
-        with self.assertNumQueries(4):
-            predict_depths(self.test_date, dummy_param_list, None)
+        self.assertEqual(
+            DepthPrediction.objects.filter(date=self.test_date).count(), flooded
+        )
+        return flooded
 
-        self.assertEqual(DepthPrediction.objects.filter(date=self.test_date).count(), 0)
+    def test_predict_depth_centiles(self):
+        betas = np.array([[1, 2, 3, 4, 0], [-1, -2, -3, -4, 0], [1, 2, 3, 4, 1]])
+        flows = np.array([0.1, 2, 1.5, 5])
+        centiles = predict_depth_centiles(flows, betas)
+        assert centiles.shape == (3, 4)
 
-    @mock.patch("calculations.flood_risk.predict_depth")
-    def test_bulk_predict_depths_create(self, predict_depth):
-        predict_depth.return_value = (8.14, 21.95, 36.63, 1)
+        # Rows should match predicting each cell separately
+        for row, beta in zip(centiles, betas):
+            params = FloodModelParameters(**dict(zip(BETA_ARGS, beta)))
+            np.testing.assert_array_equal(row, predict_depth(flows, params))
 
-        dummy_param_list = [1, 2, 3, 4]
+        # Flows below minQ give zero depth
+        np.testing.assert_almost_equal(
+            centiles[2], np.percentile([0, 49, 24.25, 586], [10, 30, 50, 90])
+        )
+
+    def test_coefficient_cache(self):
+        model_version_id = ModelVersion.get_current_id()
+        param_ids, betas = load_coefficients(model_version_id)
+        cache_path = coefficient_cache_path(model_version_id, get_cache_version())
+        assert os.path.exists(cache_path)
 
+        params = FloodModelParameters.objects.order_by("id")
+        np.testing.assert_array_equal(param_ids, [p.id for p in params])
+        np.testing.assert_array_equal(
+            betas, [[getattr(p, b) for b in BETA_ARGS] for p in params]
+        )
+
+        # Cache is reused until it is invalidated
+        FloodModelParameters.objects.filter(id=param_ids[0]).delete()
+        assert len(load_coefficients(model_version_id)[0]) == len(params)
+
+        # Invalidating the cache changes the version in the database, so cache files
+        # left in other containers are not used
+        with open(cache_path, "rb") as f:
+            cache_data = f.read()
+        invalidate_coefficient_cache()
+        assert not os.path.exists(cache_path)
+        with open(cache_path, "wb") as f:
+            f.write(cache_data)
+        assert len(load_coefficients(model_version_id)[0]) == len(params) - 1
+
+        # Files for old versions are removed when the cache is rebuilt
+        assert not os.path.exists(cache_path)
+        assert os.path.exists(
+            coefficient_cache_path(model_version_id, get_cache_version())
+        )
+
+    def test_update_channel_overlap(self):
+        # Channel covers cell 1 and overlaps the edge of cell 2
+        channel = RiverChannel(
+            channel_location=MultiPolygon(
+                [Polygon.from_bbox((107.75624, -7.06466, 107.75627, -7.06463))]
+            )
+        )
+        with update_channel_overlap_on_commit(self):
+            channel.save()
+            # The overlaps are updated by a task once the channel is committed
+            assert not FloodModelParameters.objects.exclude(
+                channel_overlap=ChannelOverlap.NONE
+            ).exists()
+
+        overlaps = dict(
+            FloodModelParameters.objects.values_list("id", "channel_overlap")
+        )
+        assert overlaps[1] == ChannelOverlap.COVERED
+        assert overlaps[2] == ChannelOverlap.PARTIAL
+        assert overlaps[3] == ChannelOverlap.NONE
+
+        # Channel cells should not get predictions
+        predict_depths(
+            self.test_date, ModelVersion.get_current_id(), np.full(100, 1000.0)
+        )
+        predicted = DepthPrediction.objects.values_list("parameters_id", flat=True)
+        assert 1 not in predicted
+        assert 2 not in predicted
+
+        # Removing the channel clears the overlaps
+        with update_channel_overlap_on_commit(self):
+            channel.delete()
+        assert not FloodModelParameters.objects.exclude(
+            channel_overlap=ChannelOverlap.NONE
+        ).exists()
+
+    def test_bulk_predict_depths_create(self):
+        flows = np.linspace(100, 300, 100)
         self.assertEqual(DepthPrediction.objects.filter(date=self.test_date).count(), 0)
-        with self.assertNumQueries(8):
-            predict_depths(self.test_date, dummy_param_list, None)
 
-        self.assertEqual(DepthPrediction.objects.filter(date=self.test_date).count(), 4)
+        predict_depths(self.test_date, ModelVersion.get_current_id(), flows)
+
+        assert self.check_depth_predictions(flows) > 0
 
-    @mock.patch("calculations.flood_risk.predict_depth")
-    def test_bulk_predict_depths_update(self, predict_depth):
-        predict_depth.return_value = (8.14, 21.95, 36.63, 1)
+    def test_bulk_predict_depths_update(self):
         self.create_depth_predictions()
+        flows = np.linspace(100, 300, 100)
 
-        dummy_param_list = [1, 2, 3, 4]
+        predict_depths(self.test_date, ModelVersion.get_current_id(), flows)
 
-        self.assertEqual(DepthPrediction.objects.filter(date=self.test_date).count(), 4)
-        with self.assertNumQueries(8):
-            predict_depths(self.test_date, dummy_param_list, None)
+        assert self.check_depth_predictions(flows) > 0
+
+    def test_save_depth_predictions_repeated(self):
+        model_version_id = ModelVersion.get_current_id()
+        # A failed save doesn't leave the staging table behind
+        with self.assertRaises(DataError):
+            save_depth_predictions(
+                self.test_date, model_version_id, np.array(["x"]), np.ones((1, 4))
+            )
+
+        # Saves can be repeated within a transaction
+        param_ids = np.array([1, 2])
+        save_depth_predictions(
+            self.test_date, model_version_id, param_ids, np.ones((2, 4))
+        )
+        save_depth_predictions(
+            self.test_date, model_version_id, param_ids, np.array([[0] * 4, [2] * 4])
+        )
+        depths = DepthPrediction.objects.filter(date=self.test_date).values_list(
+            "parameters_id", "median_depth"
+        )
+        assert list(depths) == [(2, 2)]
 
+    def test_bulk_predict_depths_delete(self):
+        self.create_depth_predictions()
         self.assertEqual(DepthPrediction.objects.filter(date=self.test_date).count(), 4)
 
+        # All flows are below minQ so there should be no predictions
+        predict_depths(
+            self.test_date, ModelVersion.get_current_id(), np.full(100, 10.0)
+        )
+
+        self.assertEqual(DepthPrediction.objects.filter(date=self.test_date).count(), 0)
+
+    def test_build_depth_pyramid(self):
+        # 8 x 4 grid of unit cells with depths increasing along the rows
+        cols, rows = np.meshgrid(np.arange(8), np.arange(4))
+        bounds = np.stack(
+            [cols.ravel(), rows.ravel(), cols.ravel() + 1, rows.ravel() + 1], axis=-1
+        ).astype(float)
+        centiles = np.repeat(rows.ravel()[:, np.newaxis], 4, axis=1).astype(float)
+
+        pyramid = build_depth_pyramid(bounds, centiles, [1, 2, 4])
+
+        # The finest level has one block per cell, apart from the zero depth row
+        block_bounds, means = pyramid[4]
+        assert len(block_bounds) == 24
+        np.testing.assert_array_equal(block_bounds, bounds[8:])
+        np.testing.assert_array_equal(means, centiles[8:])
+
+        # Coarser levels average 2 x 2 and 4 x 4 blocks of cells
+        block_bounds, means = pyramid[2]
+        np.testing.assert_array_equal(
+            block_bounds,
+            [[0, 0, 2, 2], [2, 0, 4, 2], [4, 0, 6, 2], [6, 0, 8, 2]]
+            + [[0, 2, 2, 4], [2, 2, 4, 4], [4, 2, 6, 4], [6, 2, 8, 4]],
+        )
+        np.testing.assert_array_equal(means[:, 2], [0.5] * 4 + [2.5] * 4)
+
+        block_bounds, means = pyramid[1]
+        np.testing.assert_array_equal(block_bounds, [[0, 0, 4, 4], [4, 0, 8, 4]])
+        np.testing.assert_array_equal(means[:, 2], [1.5, 1.5])
+
+    def test_predict_depths_aggregation(self):
+        model_version_id = ModelVersion.get_current_id()
+        predict_depths(self.test_date, model_version_id, np.linspace(100, 300, 100))
+
+        # Aggregations saved with the predictions should match averaging the cell
+        # depths in each block containing the cell centroids
+        def aggregations(level):
+            return sorted(
+                (
+                    a.bounding_box.extent,
+                    a.median_depth,
+                    a.lower_centile,
+                    a.mid_lower_centile,
+                    a.upper_centile,
+                )
+                for a in AggregatedDepthPrediction.objects.filter(
+                    date=self.test_date, aggregation_level=level
+                )
+            )
+
+        predictions = DepthPrediction.objects.filter(
+            date=self.test_date, model_version_id=model_version_id
+        ).select_related("parameters")
+        xmin, ymin, xmax, ymax = DepthPrediction.objects.aggregate(
+            Extent("parameters__bounding_box")
+        )["parameters__bounding_box__extent"]
+
+        def expected_aggregations(level):
+            block_size = min(xmax - xmin, ymax - ymin) / level
+            blocks = {}
+            for p in predictions:
+                centroid = p.parameters.bounding_box.centroid
+                col = math.floor((centroid.x - xmin) / block_size)
+                row = math.floor((centroid.y - ymin) / block_size)
+                blocks.setdefault((col, row), []).append(
+                    (
+                        p.median_depth,
+                        p.lower_centile,
+                        p.mid_lower_centile,
+                        p.upper_centile,
+                    )
+                )
+            expected = []
+            for (col, row), depths in blocks.items():
+                means = np.mean(depths, axis=0)
+                if means[0] != 0:
+                    expected.append(
+                        (
+                            (
+                                xmin + col * block_size,
+                                ymin + row * block_size,
+                                xmin + (col + 1) * block_size,
+                                ymin + (row + 1) * block_size,
+                            ),
+                            *means,
+                        )
+                    )
+            return sorted(expected)
+
+        assert aggregations(AGGREGATION_LEVELS[0])
+        for level in AGGREGATION_LEVELS:
+            np.testing.assert_almost_equal(
+                aggregations(level), expected_aggregations(level)
+            )
+
+    def test_plan_aggregation_level(self):
+        predict_depths(
+            self.test_date, ModelVersion.get_current_id(), np.full(100, 1000.0)
+        )
+
+        # Statistics are saved for the cells and each aggregation level
+        level_stats = list(AggregationLevelStats.objects.filter(date=self.test_date))
+        counts = {s.aggregation_level: s.count for s in level_stats}
+        assert counts[-1] == DepthPrediction.objects.count()
+        for level in AGGREGATION_LEVELS:
+            assert (
+                counts[level]
+                == AggregatedDepthPrediction.objects.filter(
+                    aggregation_level=level
+                ).count()
+            )
+
+        # All cells fit in the response, however large the extent
+        extent = Polygon.from_bbox((100, -10, 110, 0))
+        assert plan_aggregation_level(level_stats, extent) == -1
+
+        # Otherwise use the finest level which fits, or the coarsest
+        cell_count = counts[-1]
+        for level in AGGREGATION_LEVELS:
+            if counts[level] < cell_count:
+                with self.settings(DEPTH_MAX_CELLS=counts[level]):
+                    assert plan_aggregation_level(level_stats, extent) == max(
+                        l for l in AGGREGATION_LEVELS if counts[l] <= counts[level]
+                    )
+        with self.settings(DEPTH_MAX_CELLS=0):
+            assert plan_aggregation_level(level_stats, extent) == 32
+
+        # Extents away from the predictions have none to show
+        with self.settings(DEPTH_MAX_CELLS=0):
+            extent = Polygon.from_bbox((0, 0, 1, 1))
+            assert plan_aggregation_level(level_stats, extent) == -1
+
+    @mock.patch("calculations.flood_risk.group")
+    @mock.patch("calculations.flood_risk.chord")
+    def test_run_all_flood_models(self, chord, group):
+        today = datetime.now(timezone.utc).replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+        for days in (1, 5, 6, 10):
+            RiverFlowCalculationOutput.objects.create(
+                prediction_date=today,
+                forecast_time=today + timedelta(days=days),
+                rain_fall=0,
+                potential_evapotranspiration=0,
+                river_flows=[0] * 100,
+            )
+
+        # Alerts are sent once the forecast times they cover are complete, without
+        # waiting for the later forecast times
+        with self.settings(ALERT_DAYS=5):
+            run_all_flood_models()
+        (alert_tasks,), _ = chord.call_args
+        assert sorted(t.args[1] for t in alert_tasks) == [
+            today + timedelta(days=days) for days in (1, 5)
+        ]
+        (send_alerts_task,), _ = chord.return_value.call_args
+        assert send_alerts_task.task == "Send all alerts"
+        assert send_alerts_task.immutable
+        # Alerts are sent for the other forecast times if one fails
+        (errback,) = send_alerts_task.options["link_error"]
+        assert errback["task"] == "Send alerts after flood model failure"
+        (other_tasks,), _ = group.call_args
+        assert sorted(t.args[1] for t in other_tasks) == [
+            today + timedelta(days=days) for days in (6, 10)
+        ]
+        group.return_value.delay.assert_called_once()
+
+    @override_settings(DEPTH_TILE_DIR="")
+    def test_run_flood_model_for_time(self):
+        # The flood model reads the river flows of the fixture from their arrays
+        call_command("loaddata", "RiverFlowCalculationOutput", verbosity=0)
+        output = RiverFlowCalculationOutput.objects.get(pk=1)
+        assert len(output.river_flows) == 100
+        run_flood_model_for_time(output.prediction_date, output.forecast_time)
+        assert PercentageFloodRisk.objects.filter(date=output.forecast_time).exists()
+
+    @mock.patch("calculations.tasks.send_alerts.delay")
+    def test_send_alerts_after_failure(self, send_alerts):
+        # Alerts are sent when a flood model task fails, but not when sending fails
+        send_alerts_after_failure(None, ChordError("Dependency failed"), None)
+        send_alerts.assert_called_once()
+        send_alerts.reset_mock()
+        send_alerts_after_failure(None, RuntimeError("Sending failed"), None)
+        send_alerts.assert_not_called()
+
+    def test_calculate_risk_percentages(self):
+        predict_depths(
+            self.test_date, ModelVersion.get_current_id(), np.full(100, 1000.0)
+        )
+        flooded = DepthPrediction.objects.filter(
+            date=self.test_date,
+            median_depth__gt=0,
+            parameters__channel_overlap=ChannelOverlap.NONE,
+        ).count()
+        assert flooded > 0
+
+        # Risk is scaled between the channel cell count and large flood count
+        with self.settings(CHANNEL_CELL_COUNT=0, LARGE_FLOOD_COUNT=flooded * 2):
+            calculate_risk_percentages(self.test_date)
+        risk = PercentageFloodRisk.objects.get(date=self.test_date)
+        assert risk.risk == 0.5
+
+        # Recalculating updates the existing risk
+        with self.settings(CHANNEL_CELL_COUNT=0, LARGE_FLOOD_COUNT=flooded - 1):
+            calculate_risk_percentages(self.test_date)
+        assert PercentageFloodRisk.objects.get(pk=risk.pk).risk == 1
+        with self.settings(CHANNEL_CELL_COUNT=flooded + 1):
+            calculate_risk_percentages(self.test_date)
+        assert PercentageFloodRisk.objects.get(pk=risk.pk).risk == 0
+
+        # Forecast times without predictions have no risk
+        no_flood_date = self.test_date + timedelta(hours=6)
+        calculate_risk_percentages(no_flood_date)
+        assert PercentageFloodRisk.objects.get(date=no_flood_date).risk == 0
+        assert PercentageFloodRisk.objects.count() == 2
+
+    def test_interpolate_ylgnbu(self):
+        # Values from d3-scale-chromatic's interpolateYlGnBu
+        np.testing.assert_array_equal(
+            interpolate_ylgnbu([0, 0.3, 0.5, 0.77, 1]),
+            [
+                [255, 255, 217],
+                [169, 221, 183],
+                [69, 180, 194],
+                [34, 88, 165],
+                [8, 29, 88],
+            ],
+        )
+
+    def test_render_tiles(self):
+        # Rectangle covering the left half of tile (0, 0) at zoom 1
+        bounds = np.array([[-180, 0, -90, 85.0511287798066]])
+        colours = np.array([[1, 2, 3, 4]], dtype=np.uint8)
+
+        tiles = list(render_tiles(bounds, colours, 1))
+        assert len(tiles) == 1
+        x, y, rgba = tiles[0]
+        assert (x, y) == (0, 0)
+        assert (rgba[:, :128] == [1, 2, 3, 4]).all()
+        assert (rgba[:, 128:] == 0).all()
+
+    def test_render_depth_tiles(self):
+        # Render tiles for a future date, as tiles for earlier dates are removed
+        date = datetime.now(timezone.utc).replace(
+            minute=0, second=0, microsecond=0
+        ) + timedelta(days=1)
+        predict_depths(date, ModelVersion.get_current_id(), np.full(100, 1000.0))
+
+        with tempfile.TemporaryDirectory() as tile_dir, self.settings(
+            DEPTH_TILE_DIR=tile_dir, DEPTH_TILE_MIN_ZOOM=14, DEPTH_TILE_MAX_ZOOM=22
+        ):
+            render_depth_tiles(date)
+            key = get_depth_tile_key(date)
+            assert os.path.islink(os.path.join(tile_dir, key))
+            assert os.path.exists(os.path.join(tile_dir, EMPTY_TILE_NAME))
+
+            # Each zoom has tiles, including the cell predictions at the finest zoom
+            for zoom in range(14, 23):
+                tiles = [
+                    os.path.join(root, f)
+                    for root, _, files in os.walk(
+                        os.path.join(tile_dir, key, str(zoom))
+                    )
+                    for f in files
+                ]
+                assert tiles
+                with open(tiles[0], "rb") as f:
+                    assert f.read(8) == b"\x89PNG\r\n\x1a\n"
+
+            # Rendering again replaces the previous tiles
+            rendered = os.readlink(os.path.join(tile_dir, key))
+            render_depth_tiles(date)
+            assert os.readlink(os.path.join(tile_dir, key)) != rendered
+            assert not os.path.exists(os.path.join(tile_dir, rendered))
+
+            # A failed render leaves the previous tiles and no render directory
+            rendered = os.readlink(os.path.join(tile_dir, key))
+            with mock.patch(
+                "calculations.depth_tiles.encode_png", side_effect=OSError
+            ), self.assertRaises(OSError):
+                render_depth_tiles(date)
+            assert os.readlink(os.path.join(tile_dir, key)) == rendered
+            assert glob.glob(os.path.join(tile_dir, ".*-*")) == [
+                os.path.join(tile_dir, rendered)
+            ]
+
+            # Render directories left by killed renders are removed once stale
+            stale = tempfile.mkdtemp(prefix=f".{key}-", dir=tile_dir)
+            recent = tempfile.mkdtemp(prefix=f".{key}-", dir=tile_dir)
+            os.utime(stale, (0, 0))
+            render_depth_tiles(date)
+            assert not os.path.exists(stale)
+            assert os.path.exists(recent)
+
     def test_find_zentra_data_index(self):
         kind_dict = {
             1: "Precipitation",
@@ -472,3 +1215,138 @@ class FloodCalculationTests(TestCase):
         ]
 
         self.assertEqual(4, findZentraDataIndex(test_record, kind_dict))
+
+
+class FakeGEFSHandler(BaseHTTPRequestHandler):
+    """
+    Serves the server's files, supporting Range requests. Each request for a file
+    first uses up the server's list of failures for the file: "error" responds with
+    503, and "truncate" closes the connection halfway through the file.
+    """
+
+    def do_GET(self):
+        data = self.server.files[self.path]
+        range_header = self.headers.get("Range")
+        with self.server.lock:
+            self.server.requests.append((self.path, range_header))
+            failures = self.server.failures.get(self.path, [])
+            failure = failures.pop(0) if failures else None
+
+        if failure == "error":
+            self.send_error(503)
+            return
+
+        offset = int(range_header[6:-1]) if range_header else 0
+        self.send_response(206 if offset else 200)
+        if offset:
+            self.send_header(
+                "Content-Range", f"bytes {offset}-{len(data) - 1}/{len(data)}"
+            )
+        self.send_header("Content-Length", str(len(data) - offset))
+        self.end_headers()
+        if failure == "truncate":
+            self.wfile.write(data[offset : len(data) // 2])
+        else:
+            self.wfile.write(data[offset:])
+
+    def log_message(self, *args):
+        pass
+
+
+class GEFSDownloadTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeGEFSHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.failures = {}
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        settings_override = self.settings(
+            GEFS_URL=f"http://127.0.0.1:{self.server.server_address[1]}/"
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        download_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(download_dir.cleanup)
+        self.download_dir = download_dir.name
+
+        # Fixture files for each forecast hour
+        self.urls = [GEFSurl("20221018", hour) for hour in (6, 12, 18, 24)]
+        self.paths = ["/" + url.split("/", 3)[3] for url in self.urls]
+        self.server.files = {path: os.urandom(300000) for path in self.paths}
+
+    def test_download_gefs_files(self):
+        self.server.failures = {self.paths[0]: ["error"], self.paths[1]: ["truncate"]}
+        # The last file has already been downloaded
+        existing = os.path.join(self.download_dir, self.urls[3].rsplit("/", 1)[-1])
+        with open(existing, "wb") as f:
+            f.write(b"GRIB")
+
+        paths, report = downloadGEFSFiles(
+            self.urls, self.download_dir, concurrency=2, retries=2, backoff=0.01
+        )
+        assert paths[3] == existing
+        for path, url_path in zip(paths[:3], self.paths):
+            with open(path, "rb") as f:
+                assert f.read() == self.server.files[url_path]
+        assert report["downloaded"] == 3
+        assert report["skipped"] == 1
+        assert report["retries"] == 2
+        assert report["max_latency"] <= report["seconds"]
+
+        # Failed downloads are retried, resuming after truncated responses
+        file_requests = [r for r in self.server.requests if r[0] == self.paths[0]]
+        assert file_requests == [(self.paths[0], None)] * 2
+        file_requests = [r for r in self.server.requests if r[0] == self.paths[1]]
+        assert len(file_requests) == 2
+        assert file_requests[0][1] is None
+        assert file_requests[1][1].startswith("bytes=")
+        assert file_requests[1][1] != "bytes=0-"
+        assert not os.path.exists(paths[1] + ".part")
+
+    def test_download_gefs_files_failure(self):
+        self.server.failures = {self.paths[0]: ["error"] * 3}
+        with self.assertRaises(OSError):
+            downloadGEFSFiles(self.urls[:1], self.download_dir, retries=1, backoff=0.01)
+        assert len(self.server.requests) == 2
+
+    def test_prepare_gefs(self):
+        # Serve the sample GEFS file for each forecast hour of today's forecast
+        fileDate = datetime.utcnow().strftime("%Y%m%d")
+        with open(data_file_path("GEFSsample.grib2"), "rb") as f:
+            sample = f.read()
+        self.server.files = {
+            "/" + GEFSurl(fileDate, hour).split("/", 3)[3]: sample
+            for hour in (6, 12, 18, 24)
+        }
+
+        # Downloads from other dates are removed, but nothing else in the directory
+        stale = os.path.join(self.download_dir, "20221017")
+        os.makedirs(stale)
+        other = os.path.join(self.download_dir, "other")
+        os.makedirs(other)
+
+        with self.settings(
+            GEFS_DOWNLOAD_DIR=self.download_dir,
+            GEFS_FORECAST_DAYS=1,
+            MODEL_TIMESTEP=0.25,
+            LAT_VALUE=-7.0,
+            LON_VALUE=107.5,
+        ):
+            prepareGEFS()
+
+        forecasts = NoaaForecast.objects.all()
+        assert len(forecasts) == 4
+        for forecast in forecasts:
+            assert forecast.location.coords == (-7.0, 107.5)
+            assert forecast.relative_humidity == 80
+            assert forecast.max_temperature == 305
+            assert forecast.min_temperature == 295
+            assert forecast.wind_u == 2.5
+            assert forecast.wind_v == -1.5
+            assert forecast.precipitation == 4.25
+        assert os.listdir(self.download_dir) == ["other"]
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 import environ
 
@@ -86,6 +87,16 @@ MODEL_TIMESTEP = env.float("MODEL_TIMESTEP", 0.25)
 GEFS_FORECAST_DAYS = env.int("GEFS_FORECAST_DAYS", 16)
 LAT_VALUE = env.float("LAT_VALUE", -7.05)
 LON_VALUE = env.float("LON_VALUE", 175)
+# Base URL of the GEFS data, number of files to download at once, and number of times
+# to retry each file (with the backoff limited to 5 minutes, 72 retries waits about 6
+# hours for the files to be published)
+GEFS_URL = env.str("GEFS_URL", "https://ftp.ncep.noaa.gov/data/nccf/com/gens/prod/")
+GEFS_DOWNLOAD_CONCURRENCY = env.int("GEFS_DOWNLOAD_CONCURRENCY", 4)
+GEFS_DOWNLOAD_RETRIES = env.int("GEFS_DOWNLOAD_RETRIES", 72)
+
+# Rainfall-runoff model engine: "loop" runs each parameter set in turn, "vectorised" steps
+# all parameter sets through time together as arrays, "numba" uses compiled kernels
+RIVER_FLOW_ENGINE = env.str("RIVER_FLOW_ENGINE", "numba")
 
 # Thresholds for number of m^2 cells that count towards flood risk
 # CHANNEL_CELL_COUNT is number of cells in the river channel
@@ -115,6 +126,15 @@ TWILIO_ACCOUNT_SID = env.str("TWILIO_ACCOUNT_SID", "")
 TWILIO_AUTH_TOKEN = env.str("TWILIO_AUTH_TOKEN", "")
 TWILIO_PHONE_NUMBER = env.str("TWILIO_PHONE_NUMBER", "")
 TWILIO_VERIFICATION_SID = env.str("TWILIO_VERIFICATION_SID", "")
+# Base URL of the Twilio REST API used to send alerts
+TWILIO_API_URL = env.str("TWILIO_API_URL", "https://api.twilio.com")
+# Maximum number of alert messages to send at once, and per second. Set the rate to
+# the sending limit of the Twilio phone number or messaging service.
+TWILIO_SEND_CONCURRENCY = env.int("TWILIO_SEND_CONCURRENCY", 8)
+TWILIO_SEND_RATE = env.float("TWILIO_SEND_RATE", 10)
+# Number of times to retry sending a message after a connection error, or a 429 or
+# 5xx response
+TWILIO_SEND_RETRIES = env.int("TWILIO_SEND_RETRIES", 3)
 
 # Site URL (or short URL) for use in messages
 SITE_URL = env.str("SITE_URL", "http://localhost:8000")
@@ -127,15 +147,66 @@ ALERT_TEXT = env.str(
 # Date string to use in alerts: for formats see https://docs.python.org/3/library/datetime.html#strftime-and-strptime-format-codes
 ALERT_DATE_FORMAT = env.str("ALERT_DATE_FORMAT", "%b %d")
 ALERT_DEPTH_THRESHOLD = env.float("ALERT_DEPTH_THRESHOLD", 0.1)
+# Number of days from today covered by alerts. Alerts are sent as soon as the flood
+# model has run for these days.
+ALERT_DAYS = env.int("ALERT_DAYS", 5)
 
 # Location to store parameter files uploaded
 MEDIA_ROOT = env.str(
     "MEDIA_ROOT", Path(__file__).resolve().parent.parent.joinpath("files")
 )
 
+# Location to download GEFS files to. Partly downloaded files are resumed if the
+# download is retried.
+GEFS_DOWNLOAD_DIR = env.str("GEFS_DOWNLOAD_DIR", Path(MEDIA_ROOT).joinpath("gefs"))
+
+# Location to cache flood model coefficients for the flood model tasks. Each container
+# can have its own cache: caches are invalidated through a version in the database.
+FLOOD_MODEL_CACHE_DIR = env.str(
+    "FLOOD_MODEL_CACHE_DIR", Path(MEDIA_ROOT).joinpath("cache")
+)
+
+# Location for numba to cache the compiled kernels of the "numba" river flow engine. It
+# must be writable, as the package directory may not be, and kept between container
+# restarts to avoid compiling the kernels again.
+NUMBA_CACHE_DIR = env.str("NUMBA_CACHE_DIR", Path(MEDIA_ROOT).joinpath("numba-cache"))
+os.environ.setdefault("NUMBA_CACHE_DIR", str(NUMBA_CACHE_DIR))
+
+# Cache for flood depth map responses and flood risks. The celery worker invalidates it
+# after each flood model run, so it must be shared between the web server and celery worker.
+DEPTH_CACHE_BACKEND = env.str(
+    "DEPTH_CACHE_BACKEND", "django.core.cache.backends.filebased.FileBasedCache"
+)
+DEPTH_CACHE_LOCATION = env.str(
+    "DEPTH_CACHE_LOCATION", Path(MEDIA_ROOT).joinpath("depth-cache")
+)
+DEPTH_CACHE_TIMEOUT = env.int("DEPTH_CACHE_TIMEOUT", 24 * 60 * 60)
+# Largest depth predictions response in bytes to cache. Larger responses are streamed
+# without being cached, so they aren't held in memory.
+DEPTH_CACHE_MAX_SIZE = env.int("DEPTH_CACHE_MAX_SIZE", 16 * 1024 * 1024)
+
 # Maximum depth for floods in m (used to determine colour bands for flood depths)
 MAX_FLOOD_DEPTH = env.float("MAX_FLOOD_DEPTH", 2)
 
+# How the map shows flood depths: "tiles" for vector tiles, or "depths" to fetch all
+# predictions in the map extent each time it moves
+DEPTH_OVERLAY = env.str("DEPTH_OVERLAY", "tiles")
+
+# Maximum number of flood depth predictions to show in a map extent: the map shows the
+# finest aggregation level with at most this many predictions in the extent
+DEPTH_MAX_CELLS = env.int("DEPTH_MAX_CELLS", 10000)
+
+# Time in seconds that browsers and proxies may cache flood depth map tiles
+DEPTH_TILE_MAX_AGE = env.int("DEPTH_TILE_MAX_AGE", 600)
+
+# Directory to render PNG flood depth map tiles into after each flood model run, to be
+# served by the web server at DEPTH_TILE_URL. Leave empty to not render tiles.
+DEPTH_TILE_DIR = env.str("DEPTH_TILE_DIR", "")
+DEPTH_TILE_URL = env.str("DEPTH_TILE_URL", "/depth-tiles/")
+# Range of zoom levels to render; the map uses vector tiles for closer zooms
+DEPTH_TILE_MIN_ZOOM = env.int("DEPTH_TILE_MIN_ZOOM", 10)
+DEPTH_TILE_MAX_ZOOM = env.int("DEPTH_TILE_MAX_ZOOM", 18)
+
 # =======================================================================================
 # End of user configurable settings
 # =======================================================================================
@@ -286,6 +357,18 @@ LEAFLET_CONFIG = {
     "TILES": MAP_URL,
 }
 
+# Caches
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "depth_predictions": {
+        "BACKEND": DEPTH_CACHE_BACKEND,
+        "LOCATION": DEPTH_CACHE_LOCATION,
+        "TIMEOUT": DEPTH_CACHE_TIMEOUT,
+    },
+}
+
 # Celery task configuration
 
 CELERY_BEAT_SCHEDULER = "django_celery_beat.schedulers:DatabaseScheduler"
@@ -297,3 +380,5 @@ DATA_UPLOAD_MAX_MEMORY_SIZE = env.int(
     "DATA_UPLOAD_MAX_MEMORY_SIZE", 67108864
 )  # 2^26 or ~ 64MB default
 DATABASE_CHUNK_SIZE = env.int("DATABASE_CHUNK_SIZE", 1000)
+# Number of cells to calculate flood depths for at once
+FLOOD_MODEL_BATCH_SIZE = env.int("FLOOD_MODEL_BATCH_SIZE", 100000)
@@ -1,9 +1,16 @@
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import os
+import threading
+import time
 
 from django.conf import settings
+import requests
+from requests.adapters import HTTPAdapter
 from twilio.rest import Client
 
+from .models import AlertType
+
 logger = logging.getLogger(__name__)
 
 
@@ -43,3 +50,127 @@ class TwilioAlerts:
             )
         except Exception as e:
             logger.error(f"Unable to send message to {to_number}: {e}")
+
+
+class TwilioMessageDispatcher:
+    """
+    Send alert messages through the Twilio Messages API. Messages are sent concurrently
+    over one connection pool, limited to TWILIO_SEND_RATE messages per second by each
+    dispatcher, and retried with exponential backoff after connection errors and 429
+    and 5xx responses. Callers log the report of a whole run with log_dispatch_report.
+    """
+
+    def __init__(
+        self,
+        base_url=None,
+        concurrency=None,
+        rate=None,
+        retries=None,
+        backoff=1,
+        max_backoff=60,
+    ):
+        """
+        @param base_url: base URL of the Twilio REST API, defaults to TWILIO_API_URL
+        @param backoff: seconds to wait before the first retry, doubled for each retry
+        @param max_backoff: most seconds to wait before a retry, including when Twilio
+            asks for longer with a Retry-After header
+        """
+        base_url = base_url or settings.TWILIO_API_URL
+        self.url = (
+            f"{base_url}/2010-04-01/Accounts/{settings.TWILIO_ACCOUNT_SID}"
+            "/Messages.json"
+        )
+        self.concurrency = concurrency or settings.TWILIO_SEND_CONCURRENCY
+        self.interval = 1 / (rate or settings.TWILIO_SEND_RATE)
+        self.retries = settings.TWILIO_SEND_RETRIES if retries is None else retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.session = requests.Session()
+        self.session.auth = (settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+        adapter = HTTPAdapter(pool_maxsize=self.concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._lock = threading.Lock()
+        self._next_send = time.monotonic()
+
+    def _wait_for_rate_limit(self):
+        with self._lock:
+            now = time.monotonic()
+            send_at = max(now, self._next_send)
+            self._next_send = send_at + self.interval
+        if send_at > now:
+            time.sleep(send_at - now)
+
+    def _retry_delay(self, response, attempt):
+        retry_after = (
+            response.headers.get("Retry-After") if response is not None else None
+        )
+        if retry_after and retry_after.isdigit():
+            return min(int(retry_after), self.max_backoff)
+        return min(self.backoff * 2**attempt, self.max_backoff)
+
+    def send_message(self, phone_number, alert_type, message):
+        """
+        Send a message, retrying after connection errors, rate limiting and server errors
+        @return: True if the message was accepted by Twilio
+        """
+        if alert_type == AlertType.SMS:
+            from_number, to_number = settings.TWILIO_PHONE_NUMBER, phone_number
+        else:
+            from_number = f"whatsapp:{settings.TWILIO_PHONE_NUMBER}"
+            to_number = f"whatsapp:{phone_number}"
+
+        for attempt in range(self.retries + 1):
+            self._wait_for_rate_limit()
+            response = None
+            try:
+                response = self.session.post(
+                    self.url,
+                    data={"Body": message, "From": from_number, "To": to_number},
+                    timeout=30,
+                )
+                if response.ok:
+                    return True
+                error = f"{response.status_code} {response.text}"
+                retry = response.status_code == 429 or response.status_code >= 500
+            except (requests.ConnectionError, requests.ConnectTimeout) as e:
+                # The message may not have reached Twilio, so it is safe to resend
+                error = e
+                retry = True
+            except requests.RequestException as e:
+                # Twilio may have accepted the message, e.g. before a read timeout,
+                # so resending could send it twice
+                error = e
+                retry = False
+
+            if not retry or attempt == self.retries:
+                logger.error(f"Unable to send message to {to_number}: {error}")
+                return False
+            time.sleep(self._retry_delay(response, attempt))
+
+    def send(self, messages):
+        """
+        Send messages concurrently
+        @param messages: list of (phone number, alert type, message)
+        @return: tuple of (list of whether each message was sent, dict of the number of
+            messages sent and failed, and the seconds taken)
+        """
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            results = list(executor.map(lambda m: self.send_message(*m), messages))
+        report = {
+            "sent": results.count(True),
+            "failed": results.count(False),
+            "seconds": time.monotonic() - start,
+        }
+        return results, report
+
+
+def log_dispatch_report(report):
+    rate = report["sent"] / report["seconds"] if report["seconds"] else 0
+    logger.info(
+        f"Sent {report['sent']} alert messages in {report['seconds']:.1f}s"
+        f" ({rate:.1f} messages/s), {report['failed']} failed"
+    )
@@ -1,52 +1,263 @@
 import $ from 'jquery';
+import 'leaflet.vectorgrid/dist/Leaflet.VectorGrid.bundled.js';
 import {interpolateYlGnBu} from 'd3-scale-chromatic';
 
-var floodOverlayLayerGroup = L.layerGroup();
+var floodTileLayer = null;
+var floodRasterLayer = null;
+var floodDepthLayer = null;
+var floodDepthRequest = null;
+var floodTooltip = L.tooltip();
 var currentDay = 0;
 var currentHour = 0;
 
-function getFloodOverlays(map, day, hour) {
-  currentDay = day;
-  currentHour = hour;
+function getFloodOverlayStyle(depth, lowerCentile, upperCentile, maxDepth) {
+  var colorVal = depth > maxDepth ? 1 : depth/maxDepth;
+  var spread = upperCentile - lowerCentile;
+  var opacity = spread > maxDepth ? 0 : 1 - spread/maxDepth;
+  return {
+    stroke: false,
+    fill: true,
+    color: null,
+    fillColor: interpolateYlGnBu(colorVal),
+    fillOpacity: opacity
+  };
+}
+
+function getFloodTooltipContent(depth, lowerCentile, upperCentile) {
+  return "Depth: " + depth.toFixed(2) + "m<br>Lower centile: " + lowerCentile.toFixed(2) +
+      "m<br>Upper centile: " + upperCentile.toFixed(2) + "m";
+}
+
+// Decode the binary format of /depths/: a header of the number of predictions (uint32),
+// the maximum depth (float32) and the x and y origin (float64), followed by float32
+// columns of xmin, ymin, xmax and ymax relative to the origin, depth, lower centile
+// and upper centile. All values are little-endian.
+function decodeFloodDepths(buffer) {
+  var view = new DataView(buffer);
+  var count = view.getUint32(0, true);
+  var column = function(i) {
+    return new Float32Array(buffer, 24 + i * count * 4, count);
+  };
+  return {
+    count: count,
+    maxDepth: view.getFloat32(4, true),
+    originX: view.getFloat64(8, true),
+    originY: view.getFloat64(16, true),
+    xmin: column(0),
+    ymin: column(1),
+    xmax: column(2),
+    ymax: column(3),
+    depth: column(4),
+    lowerCentile: column(5),
+    upperCentile: column(6)
+  };
+}
+
+// Draws all depth predictions on a single canvas, with a tooltip for the prediction under the mouse
+var FloodDepthCanvasLayer = L.Layer.extend({
+  onAdd: function(map) {
+    this._canvas = L.DomUtil.create('canvas', 'leaflet-zoom-hide');
+    this._canvas.style.pointerEvents = 'none';
+    map.getPanes().overlayPane.appendChild(this._canvas);
+    this._reset();
+  },
+
+  onRemove: function(map) {
+    L.DomUtil.remove(this._canvas);
+    map.closeTooltip(floodTooltip);
+  },
+
+  getEvents: function() {
+    return {
+      moveend: this._reset,
+      resize: this._reset,
+      mousemove: this._showTooltip,
+      mouseout: this._hideTooltip
+    };
+  },
+
+  setData: function(data) {
+    this._data = data;
+    if (this._map) {
+      this._reset();
+    }
+  },
+
+  clear: function() {
+    this.setData(null);
+  },
+
+  _reset: function() {
+    var map = this._map;
+    var size = map.getSize();
+    var ratio = window.devicePixelRatio || 1;
+    L.DomUtil.setPosition(this._canvas, map.containerPointToLayerPoint([0, 0]));
+    this._canvas.width = size.x * ratio;
+    this._canvas.height = size.y * ratio;
+    this._canvas.style.width = size.x + 'px';
+    this._canvas.style.height = size.y + 'px';
+
+    var ctx = this._canvas.getContext('2d');
+    ctx.setTransform(ratio, 0, 0, ratio, 0, 0);
+    ctx.clearRect(0, 0, size.x, size.y);
+    var data = this._data;
+    if (!data) {
+      return;
+    }
+    for (var i = 0; i < data.count; i++) {
+      var style = getFloodOverlayStyle(data.depth[i], data.lowerCentile[i], data.upperCentile[i], data.maxDepth);
+      var topLeft = map.latLngToContainerPoint([data.originY + data.ymax[i], data.originX + data.xmin[i]]);
+      var bottomRight = map.latLngToContainerPoint([data.originY + data.ymin[i], data.originX + data.xmax[i]]);
+      ctx.globalAlpha = style.fillOpacity;
+      ctx.fillStyle = style.fillColor;
+      ctx.fillRect(topLeft.x, topLeft.y, bottomRight.x - topLeft.x, bottomRight.y - topLeft.y);
+    }
+  },
+
+  _findPrediction: function(latlng) {
+    var data = this._data;
+    if (!data) {
+      return -1;
+    }
+    var x = latlng.lng - data.originX;
+    var y = latlng.lat - data.originY;
+    for (var i = 0; i < data.count; i++) {
+      if (x >= data.xmin[i] && x <= data.xmax[i] && y >= data.ymin[i] && y <= data.ymax[i]) {
+        return i;
+      }
+    }
+    return -1;
+  },
+
+  _showTooltip: function(e) {
+    var i = this._findPrediction(e.latlng);
+    if (i < 0) {
+      this._hideTooltip();
+      return;
+    }
+    var data = this._data;
+    floodTooltip.setContent(getFloodTooltipContent(data.depth[i], data.lowerCentile[i], data.upperCentile[i]))
+      .setLatLng(e.latlng);
+    this._map.openTooltip(floodTooltip);
+  },
+
+  _hideTooltip: function() {
+    this._map.closeTooltip(floodTooltip);
+  }
+});
+
+function getFloodDepthOverlays(map, minZoom) {
+  // Cancel any request for the previous map extent
+  if (floodDepthRequest) {
+    floodDepthRequest.abort();
+    floodDepthRequest = null;
+  }
+  if (!floodDepthLayer) {
+    floodDepthLayer = new FloodDepthCanvasLayer();
+    floodDepthLayer.addTo(map);
+  }
+  if (map.getZoom() < minZoom) {
+    floodDepthLayer.clear();
+    return;
+  }
+
   var bounding_box = map.getBounds();
   var dataUrl = '/depths/' + currentDay + '/'  + currentHour + '/' + bounding_box.getWest() + ',' + bounding_box.getSouth() + ','
-    + bounding_box.getEast() + ',' + bounding_box.getNorth();
-  fetch(dataUrl)
+    + bounding_box.getEast() + ',' + bounding_box.getNorth() + '?format=binary';
+  var request = new AbortController();
+  floodDepthRequest = request;
+  fetch(dataUrl, {signal: request.signal})
     .then(function(resp) {
-      return resp.json();
+      if (!resp.ok) {
+        // Don't leave depths for another time or extent on the map
+        floodDepthLayer.clear();
+        throw new Error('Flood depths request failed with status ' + resp.status);
+      }
+      return resp.arrayBuffer();
     })
-    .then(function(data) {
-      floodOverlayLayerGroup.clearLayers();
-      data["items"].forEach(i => {
-        var colorVal = i.depth > data["max_depth"] ? 1 : i.depth/data["max_depth"];
-        var opacity = (i.upper_centile - i.lower_centile) > data["max_depth"] ? 0 : 1 - (i.upper_centile - i.lower_centile)/data["max_depth"];
-        var layer = L.rectangle(i.bounds,
-          {
-            color: null,
-            fillColor: interpolateYlGnBu(colorVal),
-            fillOpacity: opacity
-          }
-        );
-        layer.bindTooltip(
-          "Depth: " + i.depth.toFixed(2) + "m<br>Lower centile: " + i.lower_centile.toFixed(2) +
-              "m<br>Upper centile: " + i.upper_centile.toFixed(2) + "m"
-        );
-        floodOverlayLayerGroup.addLayer(layer);
-      });
-      floodOverlayLayerGroup.addTo(map);
+    .then(function(buffer) {
+      floodDepthLayer.setData(decodeFloodDepths(buffer));
+    })
+    .catch(function(error) {
+      if (error.name != 'AbortError') {
+        throw error;
+      }
+    })
+    .finally(function() {
+      if (floodDepthRequest === request) {
+        floodDepthRequest = null;
+      }
+    });
+}
+
+function getFloodTileOverlays(map, minZoom, maxDepth) {
+  floodTileLayer = L.vectorGrid.protobuf('/tiles/' + currentDay + '/' + currentHour + '/{z}/{x}/{y}.mvt', {
+    rendererFactory: L.canvas.tile,
+    interactive: true,
+    minZoom: minZoom,
+    maxZoom: map.getMaxZoom(),
+    vectorTileLayerStyles: {
+      depths: function(p) {
+        return getFloodOverlayStyle(p.depth, p.lower_centile, p.upper_centile, maxDepth);
+      }
+    }
+  });
+  floodTileLayer.on('mouseover', function(e) {
+    var p = e.layer.properties;
+    floodTooltip.setContent(getFloodTooltipContent(p.depth, p.lower_centile, p.upper_centile))
+      .setLatLng(e.latlng);
+    map.openTooltip(floodTooltip);
+  });
+  floodTileLayer.on('mouseout', function() {
+    map.closeTooltip(floodTooltip);
+  });
+  floodTileLayer.addTo(map);
+}
+
+function getFloodOverlays(map, day, hour, options) {
+  currentDay = day;
+  currentHour = hour;
+  if (floodTileLayer) {
+    map.removeLayer(floodTileLayer);
+    floodTileLayer = null;
+  }
+  if (floodRasterLayer) {
+    map.removeLayer(floodRasterLayer);
+    floodRasterLayer = null;
+  }
+
+  // Use pre-rendered tiles where available, and live overlays for closer zooms
+  options.overlayMinZoom = map.getMinZoom();
+  if (options.rasterTileUrl) {
+    floodRasterLayer = L.tileLayer(options.rasterTileUrl + options.rasterTileKey + '/{z}/{x}/{y}.png', {
+      maxZoom: options.rasterTileMaxZoom
     });
+    floodRasterLayer.addTo(map);
+    options.overlayMinZoom = options.rasterTileMaxZoom + 1;
+  }
+
+  if (options.overlay == 'depths') {
+    getFloodDepthOverlays(map, options.overlayMinZoom);
+  } else {
+    getFloodTileOverlays(map, options.overlayMinZoom, options.maxDepth);
+  }
 }
 
-export function initialiseDepthMap() {
+export function initialiseDepthMap(options) {
   window.addEventListener("map:init", function (e) {
     var detail = e.detail;
-    getFloodOverlays(detail.map, currentDay, currentHour);
-    detail.map.on('moveend', function() {
-      getFloodOverlays(detail.map, currentDay, currentHour);
-    });
+    options.rasterTileKey = $('.risk').first().attr('data-tile-key');
+    getFloodOverlays(detail.map, currentDay, currentHour, options);
+
+    if (options.overlay == 'depths') {
+      detail.map.on('moveend', function() {
+        getFloodDepthOverlays(detail.map, options.overlayMinZoom);
+      });
+    }
 
     $('.risk').click(function(e) {
-      getFloodOverlays(detail.map, $(this).attr('data-day'), $(this).attr('data-hour'));
+      options.rasterTileKey = $(this).attr('data-tile-key');
+      getFloodOverlays(detail.map, $(this).attr('data-day'), $(this).attr('data-hour'), options);
       $('.risk').removeClass('current');
       $(this).addClass('current');
     });
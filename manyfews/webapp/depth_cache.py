@@ -0,0 +1,114 @@
+from collections import Counter
+import logging
+import math
+import time
+
+from django.contrib.gis.geos import Polygon
+from django.core.cache import caches
+from django.utils import timezone
+
+from calculations.models import AggregationLevelStats
+
+logger = logging.getLogger(__name__)
+
+# Size in degrees of the grid that bounding boxes are snapped to at each aggregation level
+SNAP_GRID_SIZES = {32: 0.01, 64: 0.005, 128: 0.0025, 256: 0.001, -1: 0.0005}
+
+# Number of requests between logging the hit rate
+LOG_INTERVAL = 100
+
+stats = Counter()
+
+
+def get_depth_cache():
+    return caches["depth_predictions"]
+
+
+def _date_key(date):
+    if timezone.is_naive(date):
+        date = timezone.make_aware(date)
+    return date.astimezone(timezone.utc).isoformat()
+
+
+def _generation_key(date):
+    return f"depths-generation:{_date_key(date)}"
+
+
+def snap_bounding_box(bounding_box, aggregation_level):
+    """
+    Expand a bounding box to the grid for an aggregation level, so that nearby map
+    extents share cached responses
+    @return: tuple of (grid indices of (xmin, ymin, xmax, ymax), snapped Polygon)
+    """
+    grid_size = SNAP_GRID_SIZES[aggregation_level]
+    xmin, ymin, xmax, ymax = bounding_box.extent
+    indices = (
+        math.floor(xmin / grid_size),
+        math.floor(ymin / grid_size),
+        math.ceil(xmax / grid_size),
+        math.ceil(ymax / grid_size),
+    )
+    return indices, Polygon.from_bbox([i * grid_size for i in indices])
+
+
+def _get_generation(date):
+    return get_depth_cache().get_or_set(_generation_key(date), time.time_ns(), None)
+
+
+def get_cache_key(date, aggregation_level, indices, response_format="json"):
+    """
+    Get the key for a depth predictions response. Keys include a generation for the
+    date, so all responses for a date are invalidated by changing its generation.
+    """
+    generation = _get_generation(date)
+    return (
+        f"depths:{_date_key(date)}:{generation}:{response_format}:{aggregation_level}:"
+        + ",".join(str(i) for i in indices)
+    )
+
+
+def get_level_stats(date):
+    """
+    Get the AggregationLevelStats for a date, cached until the date is invalidated
+    """
+    return get_depth_cache().get_or_set(
+        f"depths-stats:{_date_key(date)}:{_get_generation(date)}",
+        lambda: list(AggregationLevelStats.objects.filter(date=date)),
+    )
+
+
+def get_daily_risks(today, build):
+    """
+    Get the daily risks for the home page from today, cached until the risks are invalidated
+    @param build: function to build the daily risks if they are not cached
+    """
+    generation = get_depth_cache().get_or_set("risks-generation", time.time_ns(), None)
+    return get_depth_cache().get_or_set(f"risks:{_date_key(today)}:{generation}", build)
+
+
+def invalidate_daily_risks():
+    """
+    Invalidate the cached daily risks for all days
+    """
+    get_depth_cache().set("risks-generation", time.time_ns(), None)
+
+
+def record_cache_lookup(hit):
+    """
+    Count a cache lookup, logging the hit rate every LOG_INTERVAL requests
+    """
+    stats["requests"] += 1
+    if hit:
+        stats["hits"] += 1
+    if stats["requests"] % LOG_INTERVAL == 0:
+        logger.info(
+            f"Depth predictions cache hit rate {stats['hits'] / stats['requests']:.1%}"
+            f" over {stats['requests']} requests"
+        )
+
+
+def invalidate_depth_predictions(date):
+    """
+    Invalidate all cached depth predictions responses for a forecast time
+    """
+    get_depth_cache().set(_generation_key(date), time.time_ns(), None)
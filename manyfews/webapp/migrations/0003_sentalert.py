@@ -0,0 +1,48 @@
+# Generated by Django 4.2 on 2026-10-18 16:10
+
+from django.db import migrations, models
+import phonenumber_field.modelfields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("webapp", "0002_useralert_verified_alter_useralert_alert_type"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SentAlert",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "phone_number",
+                    phonenumber_field.modelfields.PhoneNumberField(
+                        max_length=128, region=None
+                    ),
+                ),
+                (
+                    "alert_type",
+                    models.CharField(
+                        choices=[("sms", "SMS")], default="sms", max_length=8
+                    ),
+                ),
+                ("message_hash", models.CharField(max_length=64)),
+                ("sent_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="sentalert",
+            constraint=models.UniqueConstraint(
+                fields=("phone_number", "alert_type"), name="unique_sent_alert"
+            ),
+        ),
+    ]
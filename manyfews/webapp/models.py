@@ -47,3 +47,24 @@ class UserAlert(models.Model):
 
         super().save(force_insert, force_update, *args, **kwargs)
         self.__original_phone_number_id = self.phone_number_id
+
+
+class SentAlert(models.Model):
+    """
+    Hash of the flood event in the last alert message sent to a phone number, so alerts
+    for the same event are not sent again
+    """
+
+    phone_number = PhoneNumberField()
+    alert_type = models.CharField(
+        max_length=8, choices=AlertType.choices, default=AlertType.SMS
+    )
+    message_hash = models.CharField(max_length=64)
+    sent_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["phone_number", "alert_type"], name="unique_sent_alert"
+            )
+        ]
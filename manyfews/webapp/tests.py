@@ -1,11 +1,22 @@
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import math
 import re
-from time import sleep
+import struct
+import threading
+from time import monotonic, sleep
+from urllib.parse import parse_qs
 from unittest import mock
 
 from django.contrib.gis.geos import Polygon
 from django.contrib.staticfiles.testing import StaticLiveServerTestCase
 from django.core import mail
-from django.test import TestCase, LiveServerTestCase
+from django.test import TestCase, LiveServerTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+import numpy as np
+import requests
 from selenium import webdriver
 from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.common.by import By
@@ -14,8 +25,23 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait, Select
 from selenium.common.exceptions import WebDriverException
 
-from .alerts import TwilioAlerts
+from calculations.depth_tiles import get_depth_predictions
+from calculations.models import (
+    AggregatedDepthPrediction,
+    AggregationLevelStats,
+    DepthPrediction,
+    ModelVersion,
+    PercentageFloodRisk,
+)
+from .alerts import TwilioAlerts, TwilioMessageDispatcher
+from .depth_cache import (
+    get_depth_cache,
+    invalidate_daily_risks,
+    invalidate_depth_predictions,
+    snap_bounding_box,
+)
 from .converters import BoundingBoxUrlParameterConverter
+from .models import AlertType
 
 import logging
 
@@ -47,6 +73,357 @@ class ConverterTestCase(TestCase):
         assert not re.fullmatch(converter.regex, "not,a,valid,coordinate")
 
 
+# Use local memory caches in tests, rather than the file system
+TEST_CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "depth_predictions": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "depth-predictions-tests",
+    },
+}
+
+
+@override_settings(CACHES=TEST_CACHES)
+class IndexTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        get_depth_cache().clear()
+        self.today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+    def test_daily_risks(self):
+        PercentageFloodRisk.objects.create(
+            date=self.today + timedelta(days=1, hours=6), risk=0.5
+        )
+        PercentageFloodRisk.objects.create(
+            date=self.today + timedelta(days=10), risk=0.9
+        )
+
+        # Risks are fetched with a single query, then cached
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("index"))
+        daily_risks = response.context["daily_risks"]
+        assert len(daily_risks) == 10
+        for day in daily_risks:
+            assert [r["hour"] for r in day["risks"]] == [0, 6, 12, 18]
+            for r in day["risks"]:
+                expected = 0.5 if (day["day_number"], r["hour"]) == (1, 6) else 0
+                assert r["risk"] == expected
+
+        PercentageFloodRisk.objects.create(date=self.today, risk=0.25)
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse("index"))
+        assert response.context["daily_risks"][0]["risks"][0]["risk"] == 0
+
+        # Invalidating the risks shows the new risk
+        invalidate_daily_risks()
+        response = self.client.get(reverse("index"))
+        assert response.context["daily_risks"][0]["risks"][0]["risk"] == 0.25
+
+
+@override_settings(CACHES=TEST_CACHES)
+class DepthPredictionsTestCase(TestCase):
+    fixtures = ["ModelVersion", "FloodModelParameters"]
+
+    def setUp(self):
+        super().setUp()
+        get_depth_cache().clear()
+        self.date = timezone.now().replace(
+            hour=0, minute=0, second=0, microsecond=0
+        ) + timedelta(days=1, hours=6)
+        model_version = ModelVersion.objects.first()
+        for param_id in range(1, 5):
+            DepthPrediction.objects.create(
+                date=self.date,
+                parameters_id=param_id,
+                lower_centile=0.5,
+                median_depth=1,
+                mid_lower_centile=0.7,
+                upper_centile=1.5,
+                model_version=model_version,
+            )
+        AggregatedDepthPrediction.objects.create(
+            date=self.date,
+            model_version=model_version,
+            lower_centile=0.5,
+            median_depth=1,
+            mid_lower_centile=0.7,
+            upper_centile=1.5,
+            aggregation_level=32,
+            bounding_box=Polygon.from_bbox((107.7, -7.1, 107.8, -7.0)),
+        )
+
+    def get_depths(self, bounding_box):
+        response = self.client.get(
+            reverse("depths", args=(1, 6, ",".join(str(v) for v in bounding_box)))
+        )
+        self.assertEqual(response.status_code, 200)
+        if response.streaming:
+            content = b"".join(response.streaming_content)
+        else:
+            content = response.content
+        return json.loads(content)["items"]
+
+    def test_depth_predictions_cells(self):
+        # Cell predictions and their bounds are fetched with a single query,
+        # after the statistics for choosing the aggregation level
+        with self.assertNumQueries(2):
+            items = self.get_depths((107.7559, -7.0651, 107.7566, -7.0643))
+        assert len(items) == 4
+        for item in items:
+            (ymin, xmin), (ymax, xmax) = item["bounds"]
+            assert xmin < xmax and ymin < ymax
+            assert item["depth"] == 1
+            assert item["lower_centile"] == 0.5
+            assert item["upper_centile"] == 1.5
+
+    def test_depth_predictions_binary(self):
+        bounding_box = "107.7559,-7.0651,107.7566,-7.0643"
+        json_items = self.get_depths([float(v) for v in bounding_box.split(",")])
+        responses = [
+            self.client.get(
+                reverse("depths", args=(1, 6, bounding_box)), {"format": "binary"}
+            ),
+            self.client.get(
+                reverse("depths", args=(1, 6, bounding_box)),
+                HTTP_ACCEPT="application/octet-stream",
+            ),
+        ]
+        for response in responses:
+            self.assertEqual(response["Content-Type"], "application/octet-stream")
+            content = response.content
+            count, max_depth, origin_x, origin_y = struct.unpack("<If2d", content[:24])
+            assert count == len(json_items) == 4
+            assert max_depth == 2
+            columns = np.frombuffer(content[24:], dtype="<f4").reshape(7, count)
+
+            # Values should match the JSON response to float32 precision
+            expected = sorted(
+                (
+                    xmin,
+                    ymin,
+                    xmax,
+                    ymax,
+                    i["depth"],
+                    i["lower_centile"],
+                    i["upper_centile"],
+                )
+                for i in json_items
+                for ((ymin, xmin), (ymax, xmax)) in [i["bounds"]]
+            )
+            values = columns.astype(float)
+            values[:4] += np.array([origin_x, origin_y, origin_x, origin_y])[:, None]
+            actual = sorted(map(tuple, values.T))
+            np.testing.assert_allclose(actual, expected, rtol=1e-6, atol=1e-9)
+
+        response = self.client.get(
+            reverse("depths", args=(1, 6, bounding_box)), {"format": "xml"}
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_depth_predictions_snapped_level(self):
+        # The requested extent fits DEPTH_MAX_CELLS cells, but the extent snapped
+        # to the cell grid doesn't, so the aggregated predictions are shown
+        AggregationLevelStats.objects.create(
+            date=self.date,
+            aggregation_level=-1,
+            count=10**6,
+            block_size=0.0001,
+            bounding_box=Polygon.from_bbox((107.7, -7.1, 107.8, -7.0)),
+        )
+        AggregationLevelStats.objects.create(
+            date=self.date,
+            aggregation_level=32,
+            count=1,
+            block_size=0.1,
+            bounding_box=Polygon.from_bbox((107.7, -7.1, 107.8, -7.0)),
+        )
+        with self.settings(DEPTH_MAX_CELLS=20), mock.patch(
+            "webapp.views.get_depth_predictions", wraps=get_depth_predictions
+        ) as predictions:
+            items = self.get_depths((107.75512, -7.06488, 107.75528, -7.06472))
+        assert predictions.call_args.args[1] == 32
+        assert len(items) == 1
+
+    def test_snap_bounding_box(self):
+        indices, snapped = snap_bounding_box(
+            Polygon.from_bbox((107.7512, -7.0688, 107.7643, -7.0501)), 32
+        )
+        assert indices == (10775, -707, 10777, -705)
+        np.testing.assert_almost_equal(snapped.extent, (107.75, -7.07, 107.77, -7.05))
+
+    def test_depth_predictions_cache(self):
+        assert len(self.get_depths((107.7512, -7.0688, 107.7643, -7.0501))) == 1
+
+        # Responses are cached for extents snapping to the same grid
+        AggregatedDepthPrediction.objects.create(
+            date=self.date,
+            model_version=ModelVersion.objects.first(),
+            lower_centile=0.5,
+            median_depth=1,
+            mid_lower_centile=0.7,
+            upper_centile=1.5,
+            aggregation_level=32,
+            bounding_box=Polygon.from_bbox((107.76, -7.06, 107.77, -7.05)),
+        )
+        assert len(self.get_depths((107.7513, -7.0687, 107.7642, -7.0502))) == 1
+
+        # Invalidating the date clears the cached responses
+        invalidate_depth_predictions(self.date)
+        assert len(self.get_depths((107.7513, -7.0687, 107.7642, -7.0502))) == 2
+
+        # Responses larger than DEPTH_CACHE_MAX_SIZE aren't cached
+        invalidate_depth_predictions(self.date)
+        with self.settings(DEPTH_CACHE_MAX_SIZE=10):
+            assert len(self.get_depths((107.7513, -7.0687, 107.7642, -7.0502))) == 2
+            AggregatedDepthPrediction.objects.latest("id").delete()
+            assert len(self.get_depths((107.7513, -7.0687, 107.7642, -7.0502))) == 1
+
+    def get_tile(self, day, hour, z, lon=107.75625, lat=-7.06465):
+        # Web Mercator tile containing the location
+        n = 2**z
+        x = int((lon + 180) / 360 * n)
+        y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+        return self.client.get(reverse("tiles", args=(day, hour, z, x, y)))
+
+    def test_depth_tiles(self):
+        # Aggregated and cell predictions give non-empty tiles
+        for z in (12, 22):
+            response = self.get_tile(1, 6, z)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                response["Content-Type"], "application/vnd.mapbox-vector-tile"
+            )
+            assert b"depths" in response.content
+            assert "max-age" in response["Cache-Control"]
+
+        # Other times and locations give empty tiles
+        assert self.get_tile(2, 6, 12).content == b""
+        assert self.get_tile(1, 6, 12, lon=0, lat=0).content == b""
+
+        # Tiles outside the map's zoom levels or the tile grid don't exist
+        for z, x, y in ((2, 0, 0), (30, 0, 0), (12, 4096, 0), (12, 0, 4096)):
+            response = self.client.get(reverse("tiles", args=(1, 6, z, x, y)))
+            self.assertEqual(response.status_code, 404)
+
+
+class FakeTwilioHandler(BaseHTTPRequestHandler):
+    """
+    Responds to Twilio Messages API requests with the server's list of statuses for
+    each To number in turn, or 201 Created
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        data = parse_qs(self.rfile.read(length).decode())
+        to_number = data["To"][0]
+        with self.server.lock:
+            self.server.requests.append((self.path, data))
+            statuses = self.server.statuses.setdefault(to_number, [])
+            status = statuses.pop(0) if statuses else 201
+
+        body = b"{}"
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@override_settings(TWILIO_ACCOUNT_SID="AC123", TWILIO_PHONE_NUMBER="+15550000")
+class TwilioMessageDispatcherTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeTwilioHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.statuses = {}
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def get_attempts(self, to_number):
+        return sum(1 for _, data in self.server.requests if data["To"][0] == to_number)
+
+    def test_send(self):
+        self.server.statuses = {
+            "+4401": [429],
+            "+4402": [500, 503],
+            "+4403": [400],
+            "+4404": [500, 500, 500],
+        }
+        messages = [(f"+440{i}", AlertType.SMS, f"Message {i}") for i in range(5)]
+        messages.append(("+4405", "whatsapp", "Message 5"))
+        dispatcher = TwilioMessageDispatcher(
+            base_url=self.base_url, concurrency=4, rate=1000, retries=2, backoff=0.01
+        )
+        results, report = dispatcher.send(messages)
+
+        # Rate limited and server errors are retried, other errors fail at once
+        assert report["sent"] == 4
+        assert report["failed"] == 2
+        assert results == [True, True, True, False, False, True]
+        assert [self.get_attempts(f"+440{i}") for i in range(5)] == [1, 2, 3, 1, 3]
+
+        for path, data in self.server.requests:
+            assert path == "/2010-04-01/Accounts/AC123/Messages.json"
+            if data["Body"] == ["Message 5"]:
+                assert data["To"] == ["whatsapp:+4405"]
+                assert data["From"] == ["whatsapp:+15550000"]
+            else:
+                assert data["From"] == ["+15550000"]
+
+    def test_send_errors(self):
+        dispatcher = TwilioMessageDispatcher(
+            base_url=self.base_url, rate=1000, retries=2, backoff=0.01
+        )
+
+        # Messages are resent after connection errors, as they weren't sent
+        for error in (requests.ConnectionError, requests.ConnectTimeout):
+            with mock.patch.object(
+                dispatcher.session, "post", side_effect=error
+            ) as post:
+                assert not dispatcher.send_message("+4401", AlertType.SMS, "Message")
+            assert post.call_count == 3
+
+        # Other errors may come after Twilio accepted the message, so aren't resent
+        with mock.patch.object(
+            dispatcher.session, "post", side_effect=requests.ReadTimeout
+        ) as post:
+            assert not dispatcher.send_message("+4401", AlertType.SMS, "Message")
+        assert post.call_count == 1
+
+    def test_retry_delay(self):
+        dispatcher = TwilioMessageDispatcher(
+            base_url=self.base_url, backoff=1, max_backoff=10
+        )
+        response = requests.Response()
+
+        # Backoff doubles for each retry up to the maximum
+        assert [dispatcher._retry_delay(None, i) for i in range(5)] == [1, 2, 4, 8, 10]
+
+        # Retry-After is honoured, but capped at the maximum backoff
+        response.headers["Retry-After"] = "5"
+        assert dispatcher._retry_delay(response, 0) == 5
+        response.headers["Retry-After"] = "3600"
+        assert dispatcher._retry_delay(response, 0) == 10
+
+    def test_send_rate_limit(self):
+        messages = [(f"+440{i}", AlertType.SMS, "Message") for i in range(10)]
+        dispatcher = TwilioMessageDispatcher(
+            base_url=self.base_url, concurrency=10, rate=20
+        )
+        start = monotonic()
+        results, report = dispatcher.send(messages)
+        assert report["sent"] == 10
+        assert monotonic() - start >= 9 / 20
+
+
 class WebAppTestCase(StaticLiveServerTestCase):
     @classmethod
     def setUpClass(cls):
@@ -11,6 +11,11 @@ urlpatterns = [
         views.depth_predictions,
         name="depths",
     ),
+    path(
+        "tiles/<int:day>/<int:hour>/<int:z>/<int:x>/<int:y>.mvt",
+        views.depth_tiles,
+        name="tiles",
+    ),
     path("alerts/verify", views.verify_alert, name="verify"),
     path(
         "alerts/resend-verification/<int:id>", views.resend_verification, name="verify"
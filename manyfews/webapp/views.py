@@ -1,23 +1,43 @@
 from datetime import date, timedelta
+import json
 import logging
 import random
+import struct
 
 from django.conf import settings
+from django.db import connection
 from django.forms import ValidationError
-from django.http import HttpResponse, JsonResponse
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    StreamingHttpResponse,
+)
 from django.shortcuts import redirect
 from django.template import loader
 from django.utils import timezone
+from django.utils.cache import patch_cache_control, patch_vary_headers
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
+import numpy as np
 
-from calculations.models import (
-    AggregatedDepthPrediction,
-    DepthPrediction,
-    PercentageFloodRisk,
+from calculations.depth_tiles import (
+    get_depth_predictions,
+    get_depth_tile_key,
+    get_tile_aggregation_level,
+    plan_aggregation_level,
 )
+from calculations.models import PercentageFloodRisk
 from .alerts import TwilioAlerts
+from .depth_cache import (
+    get_cache_key,
+    get_daily_risks,
+    get_depth_cache,
+    get_level_stats,
+    record_cache_lookup,
+    snap_bounding_box,
+)
 from .forms import UserAlertForm
 from .models import UserAlert, UserPhoneNumber
 
@@ -32,23 +52,50 @@ def index(request):
 
     # Prepare risk data for the home page
     today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    daily_risks = get_daily_risks(today, lambda: get_risks_from(today))
+
+    return HttpResponse(
+        template.render(
+            {
+                "daily_risks": daily_risks,
+                "map_options": {
+                    "maxDepth": settings.MAX_FLOOD_DEPTH,
+                    "overlay": settings.DEPTH_OVERLAY,
+                    "rasterTileUrl": settings.DEPTH_TILE_URL
+                    if settings.DEPTH_TILE_DIR
+                    else "",
+                    "rasterTileMaxZoom": settings.DEPTH_TILE_MAX_ZOOM,
+                },
+            },
+            request,
+        )
+    )
+
+
+def get_risks_from(today):
+    """
+    Get the six-hourly flood risks for the 10 days from today, with a single query
+    """
+    risks = dict(
+        PercentageFloodRisk.objects.filter(
+            date__gte=today, date__lt=today + timedelta(days=10)
+        ).values_list("date", "risk")
+    )
+
     daily_risks = []
     for i in range(10):
         six_hour_risks = []
         date = today + timedelta(days=i)
         for j in range(4):
-
-            percentage_flood_risk = PercentageFloodRisk.objects.filter(
-                date=date + timedelta(hours=j * 6)
-            ).first()
-
-            if percentage_flood_risk:
-                risk = percentage_flood_risk.risk
-            else:
-                risk = 0
+            risk = risks.get(date + timedelta(hours=j * 6), 0)
 
             six_hour_risks.append(
-                {"hour": j * 6, "risk": risk, "percentage_risk": risk * 100}
+                {
+                    "hour": j * 6,
+                    "risk": risk,
+                    "percentage_risk": risk * 100,
+                    "tile_key": get_depth_tile_key(date + timedelta(hours=j * 6)),
+                }
             )
 
         daily_risks.append(
@@ -59,60 +106,210 @@ def index(request):
             }
         )
 
-    return HttpResponse(template.render({"daily_risks": daily_risks}, request))
+    return daily_risks
+
+
+# Number of predictions in each chunk of a streamed depth_predictions response
+STREAM_CHUNK_ITEMS = 1000
+
+DEPTH_BINARY_CONTENT_TYPE = "application/octet-stream"
+DEPTH_CONTENT_TYPES = {
+    "json": "application/json",
+    "binary": DEPTH_BINARY_CONTENT_TYPE,
+}
 
 
 def depth_predictions(request, day, hour, bounding_box):
     # Get the depth predictions for this bounding box and day days ahead
     today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
-
-    # Determine aggregation level by current extent
-    total_width = bounding_box.extent[2] - bounding_box.extent[0]
-    total_height = bounding_box.extent[3] - bounding_box.extent[1]
-
-    aggregation_level = 32
-    objects_to_fetch = AggregatedDepthPrediction
-
-    size = min(total_height, total_width)
-
-    if size < 0.001:
-        aggregation_level = -1
-        objects_to_fetch = DepthPrediction
-    elif size < 0.0025:
-        aggregation_level = 256
-    elif size < 0.005:
-        aggregation_level = 128
-    elif size < 0.01:
-        aggregation_level = 64
-
-    if aggregation_level > 0:
-        predictions = AggregatedDepthPrediction.objects.filter(
-            date=today + timedelta(days=day, hours=hour),
-            aggregation_level=aggregation_level,
-            bounding_box__intersects=bounding_box,
-        )
+    date = today + timedelta(days=day, hours=hour)
+
+    # Determine aggregation level by the number of predictions in the extent that
+    # is queried, which is the current extent snapped to a grid for the level. The
+    # snapped extent can need a coarser level, whose grid is coarser in turn.
+    level_stats = get_level_stats(date)
+    aggregation_level = plan_aggregation_level(level_stats, bounding_box)
+    while True:
+        grid_indices, snapped_box = snap_bounding_box(bounding_box, aggregation_level)
+        snapped_level = plan_aggregation_level(level_stats, snapped_box)
+        if snapped_level == aggregation_level:
+            break
+        aggregation_level = snapped_level
+    bounding_box = snapped_box
+
+    # Use the binary format if requested by the format parameter or Accept header
+    response_format = request.GET.get("format")
+    if response_format is None:
+        accept = request.headers.get("Accept", "")
+        response_format = "binary" if DEPTH_BINARY_CONTENT_TYPE in accept else "json"
+    if response_format not in DEPTH_CONTENT_TYPES:
+        return HttpResponseBadRequest(f"Unknown format {response_format}")
+    content_type = DEPTH_CONTENT_TYPES[response_format]
+
+    # Responses are cached for the bounding box snapped to a grid
+    cache_key = get_cache_key(date, aggregation_level, grid_indices, response_format)
+    content = get_depth_cache().get(cache_key)
+    record_cache_lookup(content is not None)
+    predictions = get_depth_predictions(date, aggregation_level, bounding_box)
+    if content is not None:
+        response = HttpResponse(content, content_type=content_type)
+    elif response_format == "binary":
+        content = encode_depth_predictions(predictions)
+        if len(content) <= settings.DEPTH_CACHE_MAX_SIZE:
+            get_depth_cache().set(cache_key, content)
+        response = HttpResponse(content, content_type=content_type)
     else:
-        predictions = DepthPrediction.objects.filter(
-            date=today + timedelta(days=day, hours=hour),
-            parameters__bounding_box__intersects=bounding_box,
+        response = StreamingHttpResponse(
+            stream_depth_predictions(predictions, cache_key),
+            content_type=content_type,
         )
 
+    patch_vary_headers(response, ["Accept"])
+    return response
+
+
+def encode_depth_predictions(predictions):
+    """
+    Encode depth predictions in a compact binary format of little-endian values: a
+    header of the number of predictions (uint32), MAX_FLOOD_DEPTH (float32) and the
+    x and y origin (float64), followed by float32 columns of xmin, ymin, xmax and
+    ymax relative to the origin, depth, lower centile and upper centile
+    @param predictions: values_list QuerySet from get_depth_predictions
+    @return: bytes
+    """
+    data = np.array(list(predictions), dtype=np.float64).reshape(-1, 7)
+    origin = data[:, :2].min(axis=0) if len(data) else np.zeros(2)
+
+    # Coordinates are relative to the origin so they keep their precision as float32
+    columns = np.empty((7, len(data)), dtype="<f4")
+    columns[:4] = (data[:, :4] - np.tile(origin, 2)).T
+    columns[4] = data[:, 5]
+    columns[5] = data[:, 4]
+    columns[6] = data[:, 6]
+
+    header = struct.pack(
+        "<If2d", len(data), settings.MAX_FLOOD_DEPTH, origin[0], origin[1]
+    )
+    return header + columns.tobytes()
+
+
+def stream_depth_predictions(predictions, cache_key):
+    """
+    Generate the JSON for depth_predictions in chunks, caching the whole response
+    once it has all been generated unless it is larger than DEPTH_CACHE_MAX_SIZE
+    """
+    chunks = []
+    size = 0
+
+    def chunk(text):
+        nonlocal chunks, size
+        data = text.encode()
+        size += len(data)
+        if chunks is not None:
+            chunks.append(data)
+            if size > settings.DEPTH_CACHE_MAX_SIZE:
+                # Too large to cache, so stop holding the chunks
+                chunks = None
+        return data
+
+    yield chunk('{"items": [')
+    separator = ""
     items = []
-    for p in predictions:
-        bounding_box = (
-            p.bounding_box if aggregation_level > 0 else p.parameters.bounding_box
-        )
-        bb_extent = bounding_box.extent
+    for xmin, ymin, xmax, ymax, lower, median, upper in predictions.iterator(
+        chunk_size=settings.DATABASE_CHUNK_SIZE
+    ):
         items.append(
+            json.dumps(
+                {
+                    # Bounding box is (xmin, ymin, xmax, ymax) but leaflet expects [[lat, lon], [lat, lon]]
+                    "bounds": [[ymin, xmin], [ymax, xmax]],
+                    "depth": median,
+                    "lower_centile": lower,
+                    "upper_centile": upper,
+                }
+            )
+        )
+        if len(items) == STREAM_CHUNK_ITEMS:
+            yield chunk(separator + ", ".join(items))
+            separator = ", "
+            items = []
+    if items:
+        yield chunk(separator + ", ".join(items))
+    yield chunk(f'], "max_depth": {json.dumps(settings.MAX_FLOOD_DEPTH)}}}')
+
+    if chunks is not None:
+        get_depth_cache().set(cache_key, b"".join(chunks))
+
+
+# Vector tiles of AggregatedDepthPredictions, or DepthPredictions with the
+# cell bounds from their FloodModelParameters at the finest level
+DEPTH_TILE_SQL = """
+    WITH bounds AS (
+        SELECT ST_TileEnvelope(%(z)s, %(x)s, %(y)s) AS geom
+    ),
+    features AS (
+        SELECT
+            ST_AsMVTGeom(ST_Transform({bounding_box}, 3857), bounds.geom) AS geom,
+            d.median_depth AS depth,
+            d.lower_centile,
+            d.upper_centile
+        FROM {predictions}, bounds
+        WHERE d.date = %(date)s
+            AND {bounding_box} && ST_Transform(bounds.geom, 4326)
+            {filter}
+    )
+    SELECT ST_AsMVT(features, 'depths') FROM features
+"""
+
+AGGREGATED_DEPTH_TILE_SQL = DEPTH_TILE_SQL.format(
+    bounding_box="d.bounding_box",
+    predictions="calculations_aggregateddepthprediction d",
+    filter="AND d.aggregation_level = %(aggregation_level)s",
+)
+
+CELL_DEPTH_TILE_SQL = DEPTH_TILE_SQL.format(
+    bounding_box="p.bounding_box",
+    predictions="calculations_depthprediction d "
+    "JOIN calculations_floodmodelparameters p ON p.id = d.parameters_id",
+    filter="",
+)
+
+
+def depth_tiles(request, day, hour, z, x, y):
+    """
+    Get a Mapbox Vector Tile of the depth predictions for day days ahead, with a
+    'depths' layer of one polygon per prediction with its depth, lower_centile
+    and upper_centile
+    """
+    if not (
+        settings.LEAFLET_CONFIG["MIN_ZOOM"] <= z <= settings.LEAFLET_CONFIG["MAX_ZOOM"]
+    ):
+        raise Http404(f"Zoom {z} is outside the map's zoom levels")
+    if x >= 2**z or y >= 2**z:
+        raise Http404(f"Tile {z}/{x}/{y} does not exist")
+
+    today = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+    aggregation_level = get_tile_aggregation_level(z)
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            AGGREGATED_DEPTH_TILE_SQL if aggregation_level > 0 else CELL_DEPTH_TILE_SQL,
             {
-                # Bounding box is (xmin, ymin, xmax, ymax) but leaflet expects [[lat, lon], [lat, lon]]
-                "bounds": [[bb_extent[1], bb_extent[0]], [bb_extent[3], bb_extent[2]]],
-                "depth": p.median_depth,
-                "lower_centile": p.lower_centile,
-                "upper_centile": p.upper_centile,
-            }
+                "z": z,
+                "x": x,
+                "y": y,
+                "date": today + timedelta(days=day, hours=hour),
+                "aggregation_level": aggregation_level,
+            },
         )
-    return JsonResponse({"items": items, "max_depth": settings.MAX_FLOOD_DEPTH})
+        tile = cursor.fetchone()[0]
+
+    response = HttpResponse(
+        bytes(tile or b""), content_type="application/vnd.mapbox-vector-tile"
+    )
+    patch_cache_control(response, public=True, max_age=settings.DEPTH_TILE_MAX_AGE)
+    return response
 
 
 @login_required